@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+# Benchmark for the pooled VastClient: runs a 20-poll wait loop (the same /instances fetch that
+# _get_instance does while waiting for an instance) against vast_dev's local stand-in server, once with
+# one-shot requests.get calls and once through VastClient, and reports how many TCP connections
+# (handshakes) the server accepted and the wall time of each loop.
+#
+# Usage: './benchmarks/bench_client.py [--polls N] [--latency SECONDS]'
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import vast  # noqa: E402
+import vast_dev  # noqa: E402
+
+
+def run_loop(server, get, url, polls):
+    server.connections = 0
+    start = time.perf_counter()
+    for _ in range(polls):
+        r = get(url)
+        r.raise_for_status()
+        r.json()
+    return server.connections, time.perf_counter() - start
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--polls", type=int, default=20)
+    ap.add_argument("--latency", type=float, default=0.0, help="server-side delay per request, in seconds")
+    opts = ap.parse_args()
+
+    server = vast_dev.StandInServer(latency=opts.latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    args = argparse.Namespace(url=server.url, api_key="bench")
+    url = vast.apiurl(args, "/instances", {"owner": "me"})
+
+    conns, secs = run_loop(server, requests.get, url, opts.polls)
+    print("requests.get: {:3d} polls  {:3d} handshakes  {:8.2f} ms".format(opts.polls, conns, secs * 1e3))
+    client = vast.VastClient(server.url, "bench")
+    conns, secs = run_loop(server, client.get, url, opts.polls)
+    print("VastClient:   {:3d} polls  {:3d} handshakes  {:8.2f} ms".format(opts.polls, conns, secs * 1e3))
+    client.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+# Benchmark for copy2's upload compression: builds a synthetic mixed tree (Python sources, a text log,
+# random-weight .pt checkpoints and opaque high-entropy .bin blobs) and, for a range of link speeds, reports
+# how long sending it would take uncompressed, with every file deflated, and with the adaptive policy (files
+# split by extension and entropy sample, codec and level from choose_codec). Compression is measured for
+# real; the link is simulated. As in the uploader, compression on --workers threads overlaps sending, so a
+# stream takes the longer of its compression time / workers and its wire time.
+#
+# Usage: './benchmarks/bench_compression.py [--mb N] [--links MBIT,MBIT,...] [--workers N]'
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import vast  # noqa: E402
+
+
+def make_tree(root, mb):
+    """About mb megabytes: 20% source, 10% log, 40% checkpoints, 30% opaque blobs."""
+    rnd = random.Random(0)
+    source = open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "vast.py"), "rb").read()
+    budget = mb * 1000000
+    os.makedirs(os.path.join(root, "src"))
+    os.makedirs(os.path.join(root, "data"))
+    for i in range(int(budget * 0.2) // 50000):
+        start = rnd.randrange(len(source) - 50000)
+        with open(os.path.join(root, "src", "m{}.py".format(i)), "wb") as f:
+            f.write(source[start:start + 50000])
+    with open(os.path.join(root, "data", "train.log"), "w") as f:
+        size = 0
+        while size < budget * 0.1:
+            size += f.write("step {} loss {:.5f} lr {:.2e}\n".format(size, rnd.random(), rnd.random() * 1e-3))
+    for i in range(4):
+        with open(os.path.join(root, "data", "ckpt{}.pt".format(i)), "wb") as f:
+            f.write(os.urandom(int(budget * 0.1)))
+    for i in range(3):
+        with open(os.path.join(root, "data", "blob{}.bin".format(i)), "wb") as f:
+            f.write(os.urandom(int(budget * 0.1)))
+
+
+def compress_cost(root, paths, codec, level):
+    """Seconds to compress the files and the compressed size, or (0, raw size) without a codec."""
+    raw = out = 0
+    seconds = 0.0
+    compressor = vast.new_compressor(codec, level) if codec else None
+    for rel_path in paths:
+        with open(os.path.join(root, rel_path), "rb") as f:
+            data = f.read()
+        raw += len(data)
+        if compressor is None:
+            continue
+        start = time.perf_counter()
+        out += len(compressor.compress(data))
+        seconds += time.perf_counter() - start
+    if compressor is not None:
+        start = time.perf_counter()
+        out += len(compressor.flush())
+        seconds += time.perf_counter() - start
+    return seconds, (out if compressor is not None else raw)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--mb", type=int, default=50, help="size of the synthetic tree in MB")
+    ap.add_argument("--links", default="10,100,1000", help="link speeds to simulate, in Mbit/s")
+    ap.add_argument("--workers", type=int, default=vast.upload_workers, help="compression threads")
+    opts = ap.parse_args()
+
+    root = tempfile.mkdtemp(prefix="vast-bench-")
+    try:
+        make_tree(root, opts.mb)
+        paths = [os.path.relpath(os.path.join(d, f), root) for d, _, files in os.walk(root) for f in files]
+        start = time.perf_counter()
+        packed, stored = vast.split_compressible(root, paths)
+        split_seconds = time.perf_counter() - start
+        print("{} files, {} to compress, {} sent as they are; policy took {:.1f} ms".format(
+            len(paths), len(packed), len(stored), split_seconds * 1e3))
+
+        sample = b""
+        for rel_path in packed:
+            with open(os.path.join(root, rel_path), "rb") as f:
+                sample += f.read(65536)
+            if len(sample) >= vast.codec_sample_bytes:
+                break
+        measurements = vast.measure_codecs(sample[:vast.codec_sample_bytes], vast.local_codecs())
+        for codec, level, ratio, speed in measurements:
+            print("  {:5s} level {:2d}: ratio {:.3f}  {:7.1f} MB/s".format(codec, level, ratio, speed / 1e6))
+
+        _, stored_bytes = compress_cost(root, stored, None, None)
+        all_seconds, all_bytes = compress_cost(root, paths, "gzip", 6)
+        total = sum(os.path.getsize(os.path.join(root, p)) for p in paths)
+        print("{:>10s}  {:>22s}  {:>22s}  {:>30s}".format("link", "uncompressed", "all gzip 6", "adaptive"))
+        for mbit in (float(x) for x in opts.links.split(",")):
+            link = mbit * 1e6 / 8
+            codec, level, _ = vast.choose_codec(measurements, link, opts.workers)
+            packed_seconds, packed_bytes = compress_cost(root, packed, codec, level)
+            plain = total / link
+            deflated = max(all_seconds / opts.workers, all_bytes / link)
+            adaptive = stored_bytes / link + max(packed_seconds / opts.workers, packed_bytes / link)
+            print("{:6.0f} Mb/s  {:7.2f}s {:7.1f} MB/s  {:7.2f}s {:7.1f} MB/s  {:7.2f}s {:7.1f} MB/s {:>8s}".format(
+                mbit, plain, total / plain / 1e6, deflated, total / deflated / 1e6, adaptive,
+                total / adaptive / 1e6, "{} {}".format(codec, level) if codec else "none"))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+import gzip
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import vast  # noqa: E402
+
+
+def offers(n, price):
+    return [{"gpu_name": "RTX 4090", "num_gpus": 1, "dph_total": price, "dlperf": 50.0, "reliability2": 0.99,
+             "geolocation": "US", "min_bid": 0.2} for _ in range(n)]
+
+
+def test_truncated_member_between_samples_is_skipped(tmp_path):
+    path = str(tmp_path / "history.csv.gz")
+    vast.append_offer_history(path, 1000, offers(200, 0.5))
+    broken = gzip.compress(b"".join(b"1500,RTX 4090,1,9.0,50,0.99,US,0.2\n" for _ in range(500)))
+    with open(path, "ab") as f:
+        f.write(broken[:len(broken) // 2])
+    vast.append_offer_history(path, 2000, offers(200, 0.7))
+
+    damaged = []
+    rows = list(vast.read_offer_history(path, damaged.append))
+
+    assert [r["timestamp"] for r in rows] == [1000] * 200 + [2000] * 200
+    assert {r["dph_total"] for r in rows} == {0.5, 0.7}
+    assert len(damaged) == 1
+
+
+def test_truncated_last_member(tmp_path):
+    path = str(tmp_path / "history.csv.gz")
+    vast.append_offer_history(path, 1000, offers(3, 0.5))
+    with open(path, "ab") as f:
+        f.write(gzip.compress(b"1500,RTX 4090,1,9.0,50,0.99,US,0.2\n")[:-6])
+
+    damaged = []
+    assert len(list(vast.read_offer_history(path, damaged.append))) == 3
+    assert len(damaged) == 1
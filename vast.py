@@ -2,38 +2,83 @@
 
 from __future__ import unicode_literals, print_function
 
+import ast
+import asyncio
+import codecs
+import contextlib
+import csv
+import errno
+import fnmatch
+import functools
 import logging
+import math
+import operator
 import re
+import posixpath
+import shlex
+import selectors
 import json
+import socket
+import stat
 import sys
+import tarfile
 import argparse
+import threading
 import os
 import tempfile
 import time
 import typing
 import hashlib
+import io
+import heapq
+import itertools
+import mmap
 import uuid
+import zlib
+from collections import Counter, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
 from tqdm import tqdm
 from datetime import date, datetime
+from email.utils import parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 from random import random
-from zipfile import ZipFile
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
 
-from gitignore_parser import parse_gitignore
 from paramiko import ChannelFile, SSHClient, Channel
-from paramiko.ssh_exception import NoValidConnectionsError
 from scp import SCPClient, SCPException
 
 import paramiko
 import requests
 import getpass
+import gzip
 import subprocess
 from subprocess import PIPE
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # type: ignore[assignment]
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
 
 try:
     from urllib import quote_plus  # Python 2.X
+    from urlparse import urlparse, parse_qsl
 except ImportError:
-    from urllib.parse import quote_plus  # Python 3+
+    from urllib.parse import quote_plus, urlparse, parse_qsl  # Python 3+
 
 try:
     JSONDecodeError = json.JSONDecodeError
@@ -52,6 +97,8 @@ server_url_default = "https://console.vast.ai"
 api_key_file_base = "~/.vast_api_key"
 api_key_file = os.path.expanduser(api_key_file_base)
 api_key_guard = object()
+cache_dir_base = "~/.cache/vast"
+cache_dir = os.path.expanduser(cache_dir_base)
 
 _app_path = '/app'
 
@@ -194,7 +241,7 @@ def translate_null_strings_to_blanks(d: typing.Dict) -> typing.Dict:
     return new_d
 
 
-def apiurl(args: argparse.Namespace, subpath: str, query_args: typing.Dict = None,
+def apiurl(args: argparse.Namespace, subpath: str, query_args: typing.Optional[typing.Dict] = None,
            add_rnd: bool = False) -> str:
     """Creates the endpoint URL for a given combination of parameters.
 
@@ -225,6 +272,905 @@ def apiurl(args: argparse.Namespace, subpath: str, query_args: typing.Dict = Non
         return args.url + "/api/v0" + subpath
 
 
+# (connect, read) timeouts in seconds, by endpoint prefix. Anything not listed uses default_timeout.
+# Searches and billing history can take a while to be computed on the server side.
+endpoint_timeouts = (
+    ("/bundles", (10.0, 120.0)),
+    ("/users/me/invoices", (10.0, 120.0)),
+    ("/users/me/machine-earnings", (10.0, 120.0)),
+    ("/instances", (10.0, 30.0)),
+    ("/machines", (10.0, 30.0)),
+)
+default_timeout = (10.0, 60.0)
+
+# Seconds a cached GET response is served without contacting the server, by endpoint prefix. Endpoints not
+# listed here are never cached. Once an entry is stale it is revalidated with If-None-Match/If-Modified-Since.
+cache_ttls = (
+    ("/bundles", 30.0),
+    ("/instances", 5.0),
+    ("/machines", 10.0),
+    ("/users/current", 60.0),
+    ("/users/me/invoices", 300.0),
+)
+
+
+def _api_subpath(url: str) -> str:
+    """Returns the part of the URL path after /api/v0, or the whole path for non-api URLs."""
+    path = urlparse(url).path
+    head, sep, subpath = path.partition("/api/v0")
+    return subpath if sep else path
+
+
+class ResponseCache(object):
+    """On-disk cache of read-only API responses under cache_dir: for each endpoint+query, the raw body in a .body
+    file and its validators (ETag, Last-Modified) and store time in a .json file.
+
+    Entries are keyed by the endpoint path and the normalized query string (JSON query values re-serialized
+    with sorted keys, the api_key and the '.r' cache-buster dropped), plus a hash of the api key so that
+    different accounts never see each other's data.
+    """
+
+    def __init__(self, path: str = cache_dir, api_key: typing.Optional[str] = None):
+        self.path = os.path.join(path, "responses")
+        self.account = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+
+    @staticmethod
+    def ttl_for(url: str) -> typing.Optional[float]:
+        subpath = _api_subpath(url)
+        for prefix, ttl in cache_ttls:
+            if subpath.startswith(prefix):
+                return ttl
+        return None
+
+    def key(self, url: str) -> str:
+        parsed = urlparse(url)
+        query = []
+        for k, v in parse_qsl(parsed.query, keep_blank_values=True):
+            if k in ("api_key", ".r"):
+                continue
+            try:
+                v = json.dumps(json.loads(v), sort_keys=True)
+            except ValueError:
+                pass
+            query.append((k, v))
+        material = json.dumps([self.account, parsed.netloc, parsed.path, sorted(query)])
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def load(self, key: str) -> typing.Optional[typing.Dict]:
+        try:
+            with open(os.path.join(self.path, key + ".json"), "r") as reader:
+                entry = json.load(reader)
+        except (OSError, ValueError):
+            return None
+        entry["body_path"] = os.path.join(self.path, key + ".body")
+        return entry if os.path.exists(entry["body_path"]) else None
+
+    def _open_tmp(self, key: str, suffix: str):
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+        tmp_path = os.path.join(self.path, "{}.{}.{}.tmp".format(key, os.getpid(), suffix))
+        return tmp_path, os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+
+    def _commit(self, key: str, r: requests.Response, entry: typing.Optional[typing.Dict],
+                body_tmp_path: typing.Optional[str] = None) -> typing.Dict:
+        entry = dict(entry or {"headers": {"Content-Type": r.headers.get("Content-Type", "")}})
+        entry.pop("body_path", None)
+        entry["stored"] = time.time()
+        entry["etag"] = r.headers.get("ETag", entry.get("etag"))
+        entry["last_modified"] = r.headers.get("Last-Modified", entry.get("last_modified"))
+        if body_tmp_path is not None:
+            os.replace(body_tmp_path, os.path.join(self.path, key + ".body"))
+        tmp_path, fd = self._open_tmp(key, "json")
+        with open(fd, "w") as writer:
+            json.dump(entry, writer)
+        os.replace(tmp_path, os.path.join(self.path, key + ".json"))
+        entry["body_path"] = os.path.join(self.path, key + ".body")
+        return entry
+
+    def store(self, key: str, r: requests.Response, entry: typing.Optional[typing.Dict] = None) -> typing.Dict:
+        """Saves a 200 response (or refreshes entry after a 304) and returns the stored entry."""
+        if entry is not None:
+            return self._commit(key, r, entry)
+        tmp_path, fd = self._open_tmp(key, "body")
+        with open(fd, "wb") as writer:
+            writer.write(r.content)
+        return self._commit(key, r, None, tmp_path)
+
+    def tee(self, key: str, r: requests.Response):
+        """Makes a streamed 200 response save its body as it is read. The entry is only committed if the
+        whole body gets read, so a consumer that stops early (e.g. search offers --max) stores nothing.
+        """
+        iter_content = r.iter_content
+
+        def iter_and_store(chunk_size=1, decode_unicode=False):
+            tmp_path, fd = self._open_tmp(key, "body")
+            complete = False
+            try:
+                with open(fd, "wb") as writer:
+                    for chunk in iter_content(chunk_size, decode_unicode):
+                        writer.write(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+                        yield chunk
+                complete = True
+            finally:
+                if complete:
+                    self._commit(key, r, None, tmp_path)
+                else:
+                    os.remove(tmp_path)
+
+        r.iter_content = iter_and_store  # type: ignore[method-assign]
+
+    @staticmethod
+    def response(entry: typing.Dict, url: str) -> requests.Response:
+        """Rebuilds a requests.Response from a cache entry."""
+        r = requests.Response()
+        r.status_code = 200
+        r.url = url
+        r.encoding = "utf-8"
+        r.headers.update(entry.get("headers", {}))
+        with open(entry["body_path"], "rb") as reader:
+            r._content = reader.read()
+        r._content_consumed = True
+        return r
+
+    def clear(self):
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return
+        for name in names:
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+
+class _TokenBucket(object):
+    """Token bucket for one endpoint, kept as a theoretical arrival time (GCRA) so that a waiting request can
+    reserve its slot up front and concurrent callers queue in order. rate is None until a limit is learned.
+    """
+
+    def __init__(self, burst: int = 4):
+        self.rate: typing.Optional[float] = None
+        self.ceiling: typing.Optional[float] = None
+        self.burst = burst
+        self.tat = 0.0
+        self.blocked_until = 0.0
+        self.recent: typing.Deque[float] = deque(maxlen=32)
+
+    def reserve(self, now: float) -> float:
+        """Takes a token and returns how long the caller must wait before sending."""
+        start = max(now, self.blocked_until)
+        if self.rate is not None:
+            interval = 1.0 / self.rate
+            start = max(start, self.tat - (self.burst - 1) * interval)
+            self.tat = max(self.tat, start) + interval
+        self.recent.append(start)
+        return start - now
+
+    def observed_rate(self) -> typing.Optional[float]:
+        if len(self.recent) < 2 or self.recent[-1] <= self.recent[0]:
+            return None
+        return (len(self.recent) - 1) / (self.recent[-1] - self.recent[0])
+
+
+class RateLimiter(object):
+    """Client-side request scheduler shared by every VastClient in the process, including the worker threads of
+    AsyncVastClient. Each endpoint (method plus path with ids collapsed) gets its own token bucket. Buckets
+    start unlimited. When the server answers 429 the bucket is paused for Retry-After, and its rate is
+    halved (or set to half the rate just observed). Successful requests then let it creep back up to just
+    below the rate that was rejected.
+
+    Requests wait for their slot instead of failing. throttled_seconds, throttled_requests and responses_429
+    count the cost.
+    """
+
+    min_rate = 0.1
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self.throttled_seconds = 0.0
+        self.throttled_requests = 0
+        self.responses_429 = 0
+
+    @staticmethod
+    def endpoint(method: str, url: str) -> str:
+        return method + " " + re.sub(r"/\d+(?=/|$)", "/{id}", _api_subpath(url))
+
+    def acquire(self, endpoint: str):
+        with self._lock:
+            bucket = self._buckets.setdefault(endpoint, _TokenBucket())
+            wait = bucket.reserve(time.time())
+            if wait > 0:
+                self.throttled_requests += 1
+                self.throttled_seconds += wait
+        if wait > 0:
+            time.sleep(wait)
+
+    def success(self, endpoint: str):
+        with self._lock:
+            bucket = self._buckets.get(endpoint)
+            if bucket is not None and bucket.rate is not None and bucket.ceiling is not None:
+                bucket.rate = min(bucket.ceiling, bucket.rate * 1.05)
+
+    def rate_limited(self, endpoint: str, retry_after: float):
+        with self._lock:
+            self.responses_429 += 1
+            bucket = self._buckets.setdefault(endpoint, _TokenBucket())
+            now = time.time()
+            # Concurrent requests sent before the pause all come back 429; only the first one lowers the rate.
+            rate = bucket.rate if bucket.rate is not None else bucket.observed_rate()
+            if rate is not None and now >= bucket.blocked_until:
+                bucket.ceiling = max(self.min_rate, rate * 0.9)
+                bucket.rate = max(self.min_rate, rate * 0.5)
+            bucket.blocked_until = max(bucket.blocked_until, now + retry_after)
+            bucket.tat = bucket.blocked_until
+
+    def stats(self) -> typing.Dict:
+        with self._lock:
+            return {
+                "throttled_seconds": self.throttled_seconds,
+                "throttled_requests": self.throttled_requests,
+                "responses_429": self.responses_429,
+                "rates": {k: b.rate for k, b in self._buckets.items() if b.rate is not None},
+            }
+
+
+def _retry_after_seconds(r: requests.Response, attempt: int) -> float:
+    """Parses a Retry-After header (delay in seconds or an HTTP date), falling back to exponential backoff."""
+    value = r.headers.get("Retry-After")
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return min(60.0, 2.0 ** attempt)
+
+
+rate_limiter = RateLimiter()
+
+
+class Tracer(object):
+    """Writes one JSON line per traced operation (HTTP request, SSH operation, wait) to a file, for --trace.
+    Durations are in seconds; HTTP records break them down by phase: resolve, connect, tls (only when a new
+    connection was opened), first_byte (request sent until response headers), body and json.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._writer = open(path, "a")
+
+    def write(self, record: typing.Dict):
+        with self._lock:
+            self._writer.write(json.dumps(record) + "\n")
+            self._writer.flush()
+
+    def close(self):
+        with self._lock:
+            self._writer.close()
+
+
+tracer = None  # type: typing.Optional[Tracer]
+
+# Phase timings of the connection being opened by the current thread, while a traced request is in flight.
+_trace_local = threading.local()
+
+
+@contextlib.contextmanager
+def trace_span(kind: str, op: str, **fields):
+    """Times the enclosed block and writes it to the --trace file, if tracing. Yields a dict that the block can
+    add fields to (e.g. bytes transferred).
+    """
+    extra: typing.Dict[str, typing.Any] = {}
+    if tracer is None:
+        yield extra
+        return
+    ts = time.time()
+    t0 = time.perf_counter()
+    error = None
+    try:
+        yield extra
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        record = {"ts": ts, "type": kind, "op": op, "total": time.perf_counter() - t0}
+        record.update(fields)
+        record.update(extra)
+        if error is not None:
+            record["error"] = error
+        tracer.write(record)
+
+
+class _TracedConnectionMixin(object):
+    """Records DNS resolution and TCP connect time separately, by resolving the host first and handing urllib3 the
+    address (TLS still uses the host name for SNI and certificate checks).
+    """
+
+    def _new_conn(self):
+        phases = getattr(_trace_local, "phases", None)
+        if phases is None:
+            return super()._new_conn()
+        dns_host = self._dns_host
+        t0 = time.perf_counter()
+        try:
+            self._dns_host = socket.getaddrinfo(dns_host, self.port, 0, socket.SOCK_STREAM)[0][4][0]
+        except OSError:
+            pass
+        t1 = time.perf_counter()
+        phases["resolve"] = t1 - t0
+        try:
+            return super()._new_conn()
+        finally:
+            self._dns_host = dns_host
+            phases["connect"] = time.perf_counter() - t1
+
+
+class _TracedHTTPConnection(_TracedConnectionMixin, HTTPConnection):
+    pass
+
+
+class _TracedHTTPSConnection(_TracedConnectionMixin, HTTPSConnection):
+    def connect(self):
+        phases = getattr(_trace_local, "phases", None)
+        t0 = time.perf_counter()
+        super().connect()
+        if phases is not None:
+            phases["tls"] = time.perf_counter() - t0 - phases.get("resolve", 0.0) - phases.get("connect", 0.0)
+
+
+class _TracedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TracedHTTPConnection
+
+
+class _TracedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TracedHTTPSConnection
+
+
+class _TracedHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _TracedHTTPConnectionPool,
+                                                   "https": _TracedHTTPSConnectionPool}
+
+
+class VastClient(object):
+    """Shared HTTP client for the REST api. Owns a pooled keep-alive requests.Session so repeated calls
+    (e.g. polling /instances while waiting for an instance) reuse one TCP+TLS connection instead of
+    paying a new handshake every time.
+
+    Connection failures are retried for every method. Reads that fail after the request went out
+    (e.g. a reset on a stale keep-alive socket) are only retried for idempotent methods, since
+    retrying a PUT to /asks/ could rent a second instance.
+
+    With a ResponseCache, GETs of the endpoints in cache_ttls are answered from disk while fresh (max_age
+    overrides the per-endpoint TTL) and any non-GET request invalidates the whole cache.
+
+    Every request is scheduled through a RateLimiter (the process-wide rate_limiter by default). A 429 is
+    retried after waiting, until max_throttle_wait seconds have been spent on that request.
+
+    With a Tracer, every request (including cache hits and 429 retries) is written to the trace file.
+    """
+
+    def __init__(self, url: str = server_url_default, api_key: typing.Optional[str] = None,
+                 pool_size: int = 16, retries: int = 3, cache: typing.Optional[ResponseCache] = None,
+                 max_age: typing.Optional[float] = None, limiter: typing.Optional[RateLimiter] = None,
+                 max_throttle_wait: float = 600.0, tracer: typing.Optional[Tracer] = None):
+        self.url = url
+        self.api_key = api_key
+        self.cache = cache
+        self.max_age = max_age
+        self.limiter = limiter or rate_limiter
+        self.max_throttle_wait = max_throttle_wait
+        self.recorder = None
+        self.tracer = tracer
+        self._instances: typing.Optional[InstanceRegistry] = None
+        self.session = requests.Session()
+        retry = Retry(total=retries, connect=retries, read=retries, status=0, backoff_factor=0.25,
+                      allowed_methods=frozenset(["GET", "HEAD", "DELETE", "OPTIONS"]),
+                      raise_on_status=False)
+        adapter_cls = _TracedHTTPAdapter if tracer is not None else HTTPAdapter
+        adapter = adapter_cls(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def timeout_for(self, url: str) -> typing.Tuple[float, float]:
+        """Returns the (connect, read) timeout to use for the endpoint addressed by url.
+
+        :param str url: full request URL, as made by apiurl().
+        :rtype Tuple[float, float]:
+        """
+        subpath = _api_subpath(url)
+        for prefix, timeout in endpoint_timeouts:
+            if subpath.startswith(prefix):
+                return timeout
+        return default_timeout
+
+    def endpoint_url(self, subpath: str, query_args: typing.Optional[typing.Dict] = None) -> str:
+        """Makes the URL of an endpoint on this client's server, with its api key, as apiurl() does for args.
+
+        :param str subpath: endpoint path, e.g. "/instances/".
+        :param Dict query_args: query parameters.
+        :rtype str:
+        """
+        return apiurl(argparse.Namespace(url=self.url, api_key=self.api_key), subpath, query_args)
+
+    def _send(self, method: str, url: str, **kwargs) -> requests.Response:
+        endpoint = self.limiter.endpoint(method, url)
+        waited = 0.0
+        attempt = 0
+        while True:
+            self.limiter.acquire(endpoint)
+            if self.tracer is not None:
+                r = self._traced_request(self.tracer, endpoint, method, url, **kwargs)
+            else:
+                r = self.session.request(method, url, **kwargs)
+            if r.status_code != 429:
+                self.limiter.success(endpoint)
+                return r
+            delay = _retry_after_seconds(r, attempt)
+            if waited + delay > self.max_throttle_wait:
+                return r
+            waited += delay
+            attempt += 1
+            r.close()
+            self.limiter.rate_limited(endpoint, delay)
+
+    def _traced_request(self, tracer: Tracer, endpoint: str, method: str, url: str, stream: bool = False,
+                        **kwargs) -> requests.Response:
+        """session.request, timing each phase. The body is always fetched as a stream so that waiting for the
+        first byte and reading the body can be told apart; non-streamed responses are then read (and JSON
+        bodies decoded) here, so the record is complete by the time the caller gets the response.
+        """
+        phases: typing.Dict[str, float] = {}
+        record = {"ts": time.time(), "type": "http", "method": method, "endpoint": endpoint.partition(" ")[2],
+                  "url": urlparse(url).path, "phases": phases}
+        _trace_local.phases = phases
+        t0 = time.perf_counter()
+        try:
+            r = self.session.request(method, url, stream=True, **kwargs)
+        except requests.exceptions.RequestException as e:
+            record.update(status=None, bytes=0, total=time.perf_counter() - t0, error=repr(e))
+            tracer.write(record)
+            raise
+        finally:
+            _trace_local.phases = None
+        t1 = time.perf_counter()
+        phases["first_byte"] = t1 - t0 - sum(phases.values())
+        record["status"] = r.status_code
+
+        if stream:
+            iter_content = r.iter_content
+
+            def iter_and_trace(chunk_size=1, decode_unicode=False):
+                size = 0
+                try:
+                    for chunk in iter_content(chunk_size, decode_unicode):
+                        size += len(chunk)
+                        yield chunk
+                finally:
+                    t2 = time.perf_counter()
+                    phases["body"] = t2 - t1
+                    record.update(bytes=size, total=t2 - t0, streamed=True)
+                    tracer.write(record)
+
+            r.iter_content = iter_and_trace  # type: ignore[method-assign]
+            return r
+
+        content = r.content
+        t2 = time.perf_counter()
+        phases["body"] = t2 - t1
+        if "json" in r.headers.get("Content-Type", ""):
+            try:
+                parsed = json.loads(content)
+                phases["json"] = time.perf_counter() - t2
+                r.json = lambda **kw: parsed  # type: ignore[method-assign]
+            except ValueError:
+                pass
+        record.update(bytes=len(content), total=time.perf_counter() - t0)
+        tracer.write(record)
+        return r
+
+    def request(self, method: str, url: str, max_age: typing.Optional[float] = None, **kwargs) -> requests.Response:
+        """Sends a request through the pooled session.
+
+        :param str method: HTTP method.
+        :param str url: full request URL, as made by apiurl().
+        :param float max_age: for cacheable GETs, the oldest cached response (in seconds) the caller accepts.
+        :rtype requests.Response:
+        """
+        if self.recorder is None:
+            return self._request(method, url, max_age, **kwargs)
+        # Record what the caller gets, cache hits included; bodies are read in full so they can be written out.
+        kwargs["stream"] = False
+        r = self._request(method, url, max_age, **kwargs)
+        if r.status_code != 429:
+            self.recorder.record(method, url, r)
+        return r
+
+    def _request(self, method: str, url: str, max_age: typing.Optional[float] = None, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout_for(url))
+        if method != "GET" and self._instances is not None:
+            self._instances.invalidate()
+        if self.cache is None:
+            return self._send(method, url, **kwargs)
+        if method != "GET":
+            self.cache.clear()
+            return self._send(method, url, **kwargs)
+        ttl = self.cache.ttl_for(url)
+        if ttl is None:
+            return self._send(method, url, **kwargs)
+        if max_age is None:
+            max_age = self.max_age if self.max_age is not None else ttl
+        if "&.r=" in url or "?.r=" in url:
+            max_age = 0
+
+        key = self.cache.key(url)
+        entry = self.cache.load(key)
+        if entry is not None and time.time() - entry["stored"] < max_age:
+            r = self.cache.response(entry, url)
+            if self.tracer is not None:
+                self.tracer.write({"ts": time.time(), "type": "http", "method": method,
+                                   "endpoint": self.limiter.endpoint(method, url).partition(" ")[2],
+                                   "url": urlparse(url).path, "status": 200, "bytes": len(r.content),
+                                   "cached": True, "total": 0.0, "phases": {}})
+            return r
+        if entry is not None:
+            headers = dict(kwargs.get("headers") or {})
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+            kwargs["headers"] = headers
+        r = self._send(method, url, **kwargs)
+        if r.status_code == 304 and entry is not None:
+            try:
+                cached = self.cache.response(entry, url)
+            except OSError:
+                cached = None  # another vast process cleared the cache since load()
+            if cached is not None:
+                self.cache.store(key, r, entry)
+                return cached
+            for name in ("If-None-Match", "If-Modified-Since"):
+                kwargs["headers"].pop(name, None)
+            r = self._send(method, url, **kwargs)
+        if r.status_code == 200:
+            if kwargs.get("stream"):
+                self.cache.tee(key, r)
+            else:
+                self.cache.store(key, r)
+        return r
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def put(self, url: str, **kwargs) -> requests.Response:
+        return self.request("PUT", url, **kwargs)
+
+    def delete(self, url: str, **kwargs) -> requests.Response:
+        return self.request("DELETE", url, **kwargs)
+
+    @property
+    def instances(self) -> "InstanceRegistry":
+        """The InstanceRegistry of this client's account, created on first use."""
+        if self._instances is None:
+            self._instances = InstanceRegistry(self)
+        return self._instances
+
+    def close(self):
+        self.session.close()
+
+
+class InstanceRegistry(object):
+    """Per-process index of the account's instances by id, built from one /instances fetch.
+
+    Callers say how fresh the data must be: max_age=None accepts whatever was fetched before (fetching once if
+    nothing was), max_age=N refetches if the index is older than N seconds, and 0 always refetches. Callers
+    that need a refresh while one is already in flight wait for that request instead of sending their own; its
+    answer is no older than the wait. Any non-GET request through the owning VastClient (start, stop,
+    create...) marks the index stale, and a fetch already in flight then no longer counts.
+    """
+
+    def __init__(self, client: VastClient):
+        self.client = client
+        self._lock = threading.Lock()
+        self._by_id: typing.Dict[int, typing.Dict] = {}
+        self._fetched: typing.Optional[float] = None  # time.monotonic() when the current index was requested
+        self._inflight: typing.Optional[typing.Tuple[float, Future]] = None  # (start time, Future) of the running fetch
+        self._stale_before = 0.0  # fetches requested before this may predate a change
+        self.fetches = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._fetched = None
+            self._stale_before = time.monotonic()
+
+    def index(self, max_age: typing.Optional[float] = None) -> typing.Dict[int, typing.Dict]:
+        """Returns the id -> instance dict, refetching it if it is older than max_age seconds.
+
+        :param float max_age: None to accept any previously fetched index.
+        :rtype Dict[int, Dict]:
+        """
+        now = time.monotonic()
+        future: Future
+        with self._lock:
+            if self._fetched is not None and (max_age is None or now - self._fetched <= max_age):
+                return self._by_id
+            if self._inflight is not None and self._inflight[0] >= self._stale_before:
+                future, owner = self._inflight[1], False
+            else:
+                future, owner = Future(), True
+                self._inflight = (now, future)
+        if not owner:
+            return future.result()
+        try:
+            r = self.client.get(self.client.endpoint_url("/instances", {"owner": "me"}), max_age=0)
+            r.raise_for_status()
+            by_id = {row["id"]: row for row in r.json()["instances"]}
+        except BaseException as e:
+            with self._lock:
+                if self._inflight is not None and self._inflight[1] is future:
+                    self._inflight = None
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self.fetches += 1
+            if now >= self._stale_before and (self._fetched is None or self._fetched <= now):
+                self._by_id, self._fetched = by_id, now
+            if self._inflight is not None and self._inflight[1] is future:
+                self._inflight = None
+        future.set_result(by_id)
+        return by_id
+
+    def get(self, instance_id: int, max_age: typing.Optional[float] = None) -> typing.Dict:
+        """Returns one instance. An id missing from an index older than the call is looked up again with a fresh
+        fetch, in case the instance was just created.
+
+        :raises ValueError: if the account has no instance with that id.
+        """
+        started = time.monotonic()
+        instance = self.index(max_age).get(instance_id)
+        if instance is None and (self._fetched is None or self._fetched < started):
+            instance = self.index(0).get(instance_id)
+        if instance is None:
+            raise ValueError(f'No instances with ID {instance_id}')
+        return instance
+
+    def all(self, max_age: typing.Optional[float] = None) -> typing.List[typing.Dict]:
+        return list(self.index(max_age).values())
+
+
+def get_client(args: argparse.Namespace) -> VastClient:
+    """Returns the VastClient attached to args, creating it from --url/--api-key on first use.
+
+    :param argparse.Namespace args: should supply the url and api_key options.
+    :rtype VastClient:
+    """
+    client = getattr(args, "client", None)
+    if client is None:
+        client = VastClient(args.url, args.api_key)
+        args.client = client
+    return client
+
+
+def http_get(args: argparse.Namespace, req_url: str, **kwargs) -> requests.Response:
+    return get_client(args).get(req_url, **kwargs)
+
+
+def http_put(args: argparse.Namespace, req_url: str, **kwargs) -> requests.Response:
+    return get_client(args).put(req_url, **kwargs)
+
+
+def http_delete(args: argparse.Namespace, req_url: str, **kwargs) -> requests.Response:
+    return get_client(args).delete(req_url, **kwargs)
+
+
+# Outcome of one item in a bulk operation. msg is the server's message or the error text on failure.
+BulkResult = namedtuple("BulkResult", ["id", "ok", "msg"])
+
+
+class AsyncVastClient(object):
+    """asyncio front end for fanning out many API calls, e.g. stopping or destroying hundreds of
+    instances at once. Requests run on a pooled VastClient in a thread pool, at most `concurrency`
+    at a time.
+
+    Example:
+        client = AsyncVastClient(api_key=key, concurrency=16)
+        results = asyncio.run(client.destroy_instances([123, 456]))
+    """
+
+    def __init__(self, url: str = server_url_default, api_key: typing.Optional[str] = None,
+                 concurrency: int = 8, client: typing.Optional[VastClient] = None):
+        self.concurrency = max(1, concurrency)
+        self._owns_client = client is None
+        self.client = client or VastClient(url, api_key, pool_size=max(16, self.concurrency))
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+    async def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor,
+                                          functools.partial(self.client.request, method, url, **kwargs))
+
+    async def get(self, url: str, **kwargs) -> requests.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def put(self, url: str, **kwargs) -> requests.Response:
+        return await self.request("PUT", url, **kwargs)
+
+    async def delete(self, url: str, **kwargs) -> requests.Response:
+        return await self.request("DELETE", url, **kwargs)
+
+    async def bulk(self, ids: typing.Iterable[int], method: str, subpath: str,
+                   json_body: typing.Optional[typing.Dict] = None,
+                   on_result: typing.Optional[typing.Callable[[BulkResult], None]] = None) -> typing.List[BulkResult]:
+        """Runs one request per id, with subpath formatted with the id, and reports each outcome.
+
+        :param Iterable[int] ids: instance ids to act on.
+        :param str method: HTTP method.
+        :param str subpath: endpoint path with an {id} placeholder, e.g. "/instances/{id}/".
+        :param Dict json_body: request body sent for every id.
+        :param Callable on_result: called with each BulkResult as soon as it completes.
+        :rtype List[BulkResult]: results in the same order as ids.
+        """
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async def one(id_):
+            async with sem:
+                url = self.client.endpoint_url(subpath.format(id=id_))
+                try:
+                    r = await self.request(method, url, json=json_body if json_body is not None else {})
+                    r.raise_for_status()
+                    rj = r.json()
+                    result = BulkResult(id_, bool(rj.get("success", True)), rj.get("msg", ""))
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    result = BulkResult(id_, False, str(e))
+            if on_result is not None:
+                on_result(result)
+            return result
+
+        return list(await asyncio.gather(*[one(id_) for id_ in ids]))
+
+    async def start_instances(self, ids, **kwargs) -> typing.List[BulkResult]:
+        return await self.bulk(ids, "PUT", "/instances/{id}/", {"state": "running"}, **kwargs)
+
+    async def stop_instances(self, ids, **kwargs) -> typing.List[BulkResult]:
+        return await self.bulk(ids, "PUT", "/instances/{id}/", {"state": "stopped"}, **kwargs)
+
+    async def reboot_instances(self, ids, **kwargs) -> typing.List[BulkResult]:
+        return await self.bulk(ids, "PUT", "/instances/reboot/{id}/", {}, **kwargs)
+
+    async def label_instances(self, ids, label: str, **kwargs) -> typing.List[BulkResult]:
+        return await self.bulk(ids, "PUT", "/instances/{id}/", {"label": label}, **kwargs)
+
+    async def destroy_instances(self, ids, **kwargs) -> typing.List[BulkResult]:
+        return await self.bulk(ids, "DELETE", "/instances/{id}/", {}, **kwargs)
+
+    async def search_offers(self, queries: typing.List[typing.Dict]) -> typing.List:
+        """Runs several /bundles searches at once.
+
+        :param List[Dict] queries: query dicts as made by parse_query, with order and type.
+        :rtype List: per query, in order, the list of matching offers, or the exception that query raised.
+        """
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async def one(query):
+            server_query, client_query = _split_offer_query(query)
+            async with sem:
+                r = await self.get(self.client.endpoint_url("/bundles", {"q": server_query}))
+            r.raise_for_status()
+            offers = r.json()["offers"]
+            return list(client_query.filter(offers)) if client_query else offers
+
+        return list(await asyncio.gather(*[one(q) for q in queries], return_exceptions=True))
+
+    def close(self):
+        """Shuts down the worker threads, and the VastClient too unless it was passed in by the caller."""
+        self._executor.shutdown(wait=True)
+        if self._owns_client:
+            self.client.close()
+
+
+_json_ws = re.compile(r"[ \t\n\r]*")
+
+
+def iter_json_array(r: requests.Response, key: str, chunk_size: int = 1 << 16) -> typing.Generator[typing.Any, None, None]:
+    """Incrementally decodes a streamed response shaped like {..., key: [elem, elem, ...], ...} and yields the
+    elements of that array as soon as each one has arrived, without holding the whole body in memory. Other
+    top-level values are decoded and skipped. Closing the generator early closes the response (and so the
+    connection), which is how callers stop a large download once they have enough rows.
+
+    :param requests.Response r: response made with stream=True.
+    :param str key: top-level key of the array to iterate.
+    :param int chunk_size: bytes to read from the socket at a time.
+    :rtype Iterator: decoded array elements.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    chunks = r.iter_content(chunk_size)
+    buf = ""
+    pos = 0
+    eof = False
+
+    def fill():
+        nonlocal buf, pos, eof
+        if pos > 0:
+            buf = buf[pos:]
+            pos = 0
+        for chunk in chunks:
+            text = utf8.decode(chunk)
+            if text:
+                buf += text
+                return
+        buf += utf8.decode(b"", final=True)
+        eof = True
+
+    def peek() -> str:
+        nonlocal pos
+        while True:
+            ws = _json_ws.match(buf, pos)
+            pos = ws.end() if ws else pos
+            if pos < len(buf):
+                return buf[pos]
+            if eof:
+                raise ValueError("Truncated JSON response")
+            fill()
+
+    def value():
+        # A number cut short by a chunk boundary still decodes (e.g. '-4.' as -4), so a value is only accepted
+        # once the character after it shows it is complete, or the stream has ended.
+        nonlocal pos
+        while True:
+            peek()
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+                if eof or (end < len(buf) and buf[end] in " \t\n\r,:]}"):
+                    pos = end
+                    return obj
+            except JSONDecodeError:
+                if eof:
+                    raise
+            fill()
+
+    try:
+        if peek() != "{":
+            raise ValueError("Expected a JSON object")
+        pos += 1
+        while True:
+            c = peek()
+            if c == ",":
+                pos += 1
+                continue
+            if c == "}":
+                # Read to the end so that a response being saved by the cache is complete.
+                for _ in chunks:
+                    pass
+                return
+            name = value()
+            if peek() != ":":
+                raise ValueError("Expected ':' after object key")
+            pos += 1
+            if name != key:
+                value()
+                continue
+            if peek() != "[":
+                raise ValueError("Expected {} to be a JSON array".format(key))
+            pos += 1
+            while True:
+                c = peek()
+                if c == ",":
+                    pos += 1
+                elif c == "]":
+                    pos += 1
+                    break
+                else:
+                    yield value()
+    finally:
+        r.close()
+
+
 def deindent(message: str) -> str:
     """
     Deindent a quoted string. Scans message and finds the smallest number of whitespace characters in any line and
@@ -337,136 +1283,413 @@ user_fields = (
 )
 
 
+query_op_names = {
+    ">=": "gte",
+    ">": "gt",
+    "gt": "gt",
+    "gte": "gte",
+    "<=": "lte",
+    "<": "lt",
+    "lt": "lt",
+    "lte": "lte",
+    "!=": "neq",
+    "==": "eq",
+    "=": "eq",
+    "eq": "eq",
+    "neq": "neq",
+    "noteq": "neq",
+    "not eq": "neq",
+    "notin": "notin",
+    "not in": "notin",
+    "nin": "notin",
+    "in": "in",
+}
+
+query_field_alias = {
+    "cuda_vers": "cuda_max_good",
+    "display_active": "gpu_display_active",
+    "reliability": "reliability2",
+    "dlperf_usd": "dlperf_per_dphtotal",
+    "dph": "dph_total",
+    "flops_usd": "flops_per_dphtotal",
+}
+
+query_field_multiplier = {
+    "cpu_ram": 1000,
+    "gpu_ram": 1000,
+    "duration": 1.0 / (24.0 * 60.0 * 60.0),
+}
+
+query_fields = {
+    "bw_nvlink",
+    "compute_cap",
+    "cpu_cores",
+    "cpu_cores_effective",
+    "cpu_ram",
+    "cuda_max_good",
+    "direct_port_count",
+    "driver_version",
+    "disk_bw",
+    "disk_space",
+    "dlperf",
+    "dlperf_per_dphtotal",
+    "dph_total",
+    "duration",
+    "external",
+    "flops_per_dphtotal",
+    "gpu_display_active",
+    # "gpu_ram_free_min",
+    "gpu_mem_bw",
+    "gpu_name",
+    "gpu_ram",
+    "has_avx",
+    "host_id",
+    "id",
+    "inet_down",
+    "inet_down_cost",
+    "inet_up",
+    "inet_up_cost",
+    "machine_id",
+    "min_bid",
+    "mobo_name",
+    "num_gpus",
+    "pci_gen",
+    "pcie_bw",
+    "reliability2",
+    "rentable",
+    "rented",
+    "storage_cost",
+    "total_flops",
+    "verification",
+    "verified",
+}
+
+_query_re = re.compile(r"([a-zA-Z0-9_]+)( *[=><!]+| +(?:[lg]te?|nin|neq|eq|not ?eq|not ?in|in) )?( *)(\[[^\]]+\]|[^ ]+)?( *)")
+
+_score_functions = {"abs": abs, "min": min, "max": max, "log": math.log, "sqrt": math.sqrt}
+_score_nodes = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod,
+                ast.USub, ast.UAdd, ast.Name, ast.Load, ast.Constant, ast.Call)
+
+
+@functools.lru_cache(maxsize=64)
+def compile_score(expr: str) -> typing.Callable[[typing.Dict], typing.Optional[float]]:
+    """Compiles an arithmetic expression over offer fields, like 'gpu_ram*num_gpus/dph_total', into a function of
+    an offer dict. The function returns None where the expression can't be evaluated: a missing or non-numeric
+    field, division by zero, log of zero and so on. Only arithmetic, numbers, field names (or their query aliases)
+    and the functions in _score_functions are allowed.
+
+    :param str expr:
+    :rtype Callable[[Dict], Optional[float]]:
+    """
+    try:
+        tree = ast.parse(expr.strip(), mode="eval")
+    except SyntaxError as e:
+        raise ValueError("Invalid score expression {!r}: {}".format(expr, e.msg))
+    names = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, _score_nodes):
+            raise ValueError("Score expressions can't contain {!r}: {!r}".format(type(node).__name__, expr))
+        if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+            raise ValueError("Score expressions can only contain numbers: {!r}".format(expr))
+        if isinstance(node, ast.Call) and not (isinstance(node.func, ast.Name) and node.func.id in _score_functions
+                                               and not node.keywords):
+            raise ValueError("Score expressions can only call {}: {!r}".format(", ".join(_score_functions), expr))
+        if isinstance(node, ast.Name) and node.id not in _score_functions:
+            names.add(node.id)
+    code = compile(tree, "<score>", "eval")
+    fields = [(name, query_field_alias.get(name, name)) for name in sorted(names)]
+    env: typing.Dict[str, typing.Any] = {"__builtins__": {}}
+    env.update(_score_functions)
+
+    def score(offer: typing.Dict) -> typing.Optional[float]:
+        values = {}
+        for name, field in fields:
+            v = offer.get(field)
+            if not isinstance(v, (int, float)):
+                return None
+            values[name] = v
+        try:
+            result = eval(code, env, values)
+        except (ArithmeticError, ValueError, TypeError):
+            return None
+        if not isinstance(result, (int, float)) or result != result:
+            return None
+        return float(result)
+    return score
+
+
+def pareto_frontier(rows: typing.Iterable[typing.Dict], fields: typing.Sequence[str]) -> typing.List[typing.Dict]:
+    """Returns the rows no other row dominates, i.e. is at least as good on every field and better on one. Fields
+    prefixed with '-' are better when lower. Rows missing a field are left out. The result is ordered best first
+    on the first field.
+
+    Sort-filter skyline: after sorting best-first lexicographically, a row can only be dominated by rows before it,
+    so one pass comparing each row against the frontier found so far is enough.
+
+    :param Iterable[Dict] rows:
+    :param Sequence[str] fields:
+    :rtype List[Dict]:
+    """
+    signs = []
+    for f in fields:
+        f = f.strip()
+        sign = -1.0 if f.startswith("-") else 1.0
+        f = f.lstrip("-")
+        signs.append((query_field_alias.get(f, f), sign))
+    points: typing.List[typing.Tuple[typing.Tuple[float, ...], typing.Dict]] = []
+    for row in rows:
+        vals: typing.List[typing.Any] = [row.get(f) for f, _ in signs]
+        if all(isinstance(v, (int, float)) for v in vals):
+            points.append((tuple(v * sign for v, (_, sign) in zip(vals, signs)), row))
+    points.sort(key=lambda p: p[0], reverse=True)
+    frontier: typing.List[typing.Tuple[typing.Tuple[float, ...], typing.Dict]] = []
+    for p, row in points:
+        dominated = False
+        for q, _ in frontier:
+            if all(a >= b for a, b in zip(q, p)) and q != p:
+                dominated = True
+                break
+        if not dominated:
+            frontier.append((p, row))
+    return [row for _, row in frontier]
+
+
+def rank_offers(rows: typing.Iterable[typing.Dict], score: typing.Optional[str] = None, top: typing.Optional[int] = None,
+                pareto: typing.Optional[str] = None) -> typing.Iterable[typing.Dict]:
+    """Applies the search offers ranking options to offers: --pareto keeps the Pareto frontier on its fields, then
+    --score orders by the expression, highest first, storing the value as 'rank_score', and --top keeps the best K
+    (with a heap, in O(n log K)). With none of them, rows are returned untouched.
+
+    :param Iterable[Dict] rows:
+    :param str score: expression for compile_score.
+    :param int top:
+    :param str pareto: comma-separated fields for pareto_frontier.
+    :rtype Iterable[Dict]:
+    """
+    if pareto:
+        rows = pareto_frontier(rows, [f for f in pareto.split(",") if f.strip()])
+    if not score:
+        return rows
+    score_of = compile_score(score)
+    scored = ((score_of(row), n, row) for n, row in enumerate(rows))
+    scored = ((v, -n, row) for v, n, row in scored if v is not None)
+    if top is not None:
+        best = heapq.nlargest(max(top, 0), scored, key=lambda t: t[:2])
+    else:
+        best = sorted(scored, key=lambda t: t[:2], reverse=True)
+    return [dict(row, rank_score=v) for v, _, row in best]
+
+
+# Value type of each offer field, used to evaluate queries client-side (see CompiledQuery and OfferIndex).
+# "version" values are dotted strings like driver versions, compared as tuples of ints.
+offer_field_types = {
+    "bw_nvlink": "float",
+    "compute_cap": "int",
+    "cpu_cores": "int",
+    "cpu_cores_effective": "float",
+    "cpu_ram": "float",
+    "cuda_max_good": "float",
+    "direct_port_count": "int",
+    "disk_bw": "float",
+    "disk_space": "float",
+    "dlperf": "float",
+    "dlperf_per_dphtotal": "float",
+    "dph_total": "float",
+    "driver_version": "version",
+    "duration": "float",
+    "external": "bool",
+    "flops_per_dphtotal": "float",
+    "geolocation": "str",
+    "gpu_display_active": "bool",
+    "gpu_frac": "float",
+    "gpu_mem_bw": "float",
+    "gpu_name": "str",
+    "gpu_ram": "float",
+    "has_avx": "bool",
+    "host_id": "int",
+    "id": "int",
+    "inet_down": "float",
+    "inet_down_cost": "float",
+    "inet_up": "float",
+    "inet_up_cost": "float",
+    "machine_id": "int",
+    "min_bid": "float",
+    "mobo_name": "str",
+    "num_gpus": "int",
+    "pci_gen": "float",
+    "pcie_bw": "float",
+    "reliability2": "float",
+    "rentable": "bool",
+    "rented": "bool",
+    "storage_cost": "float",
+    "total_flops": "float",
+    "verification": "str",
+    "verified": "bool",
+}
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_version(version: str) -> typing.Tuple[int, ...]:
+    """Parses a dotted version string like '535.54.03' into a tuple of ints, (535, 54, 3), that compares correctly.
+
+    :param str version:
+    :rtype Tuple[int, ...]:
+    """
+    return tuple(int(part) for part in re.findall(r"\d+", str(version)))
+
+
 def version_string_sort(a, b) -> int:
     """
     Accepts two version strings and decides whether a > b, a == b, or a < b.
-    This is meant as a sort function to be used for the driver versions in which only
-    the == operator currently works correctly. Not quite finished...
+    This is meant as a sort function to be used for the driver versions, e.g. with functools.cmp_to_key.
 
     :param str a:
     :param str b:
-    :return int:
+    :return int: 1 if a > b, 0 if a == b, -1 if a < b
     """
-    a_parts = a.split(".")
-    b_parts = b.split(".")
+    a_parts = parse_version(a)
+    b_parts = parse_version(b)
+    return (a_parts > b_parts) - (a_parts < b_parts)
 
-    return 0
 
+def _parse_bool(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ("true", "1", "yes", "t")
+    return bool(value)
 
-def parse_query(query_str: str, res: typing.Dict = None) -> typing.Dict:
+
+def _query_value(field: str, value):
+    """Converts a query value as sent to the server (a string, or a bool in the default query) to the type of
+    field, so it can be compared with the values in offer dicts.
     """
-    Basically takes a query string (like the ones in the examples of commands for the search__offers function) and
-    processes it into a dict of URL parameters to be sent to the server.
+    kind = offer_field_types.get(field, "str")
+    if kind == "version":
+        return parse_version(value)
+    if kind == "bool":
+        return _parse_bool(value)
+    if kind in ("int", "float"):
+        return float(value)
+    return str(value)
+
+
+class CompiledQuery(object):
+    """A search query compiled once into a list of clauses, (field, op, value) with value as sent to the server
+    or None for a 'field=any' wildcard, plus a predicate over offer dicts with every value already converted to
+    its field's type. Offers missing a field never satisfy a condition on it.
+
+    apply() produces the server query dict exactly as parse_query always has; calling the object tests an offer.
+    """
+
+    _ops: typing.Dict[str, typing.Callable[[typing.Any, typing.Any], bool]] = {
+        "eq": operator.eq,
+        "neq": operator.ne,
+        "gt": operator.gt,
+        "gte": operator.ge,
+        "lt": operator.lt,
+        "lte": operator.le,
+    }
+
+    def __init__(self, clauses: typing.Sequence[typing.Tuple[str, str, typing.Any]]):
+        self.clauses = tuple(clauses)
+        self._tests = tuple(self._compile(field, op, value) for field, op, value in self.clauses if value is not None)
+
+    @classmethod
+    def from_query(cls, query: typing.Dict) -> "CompiledQuery":
+        """Compiles the conditions of a server query dict (as made by parse_query). Non-condition keys such as
+        order and type are ignored.
+        """
+        return cls([(field, op, value) for field, ops in query.items() if isinstance(ops, dict)
+                    for op, value in ops.items()])
+
+    def _compile(self, field: str, op: str, value):
+        kind = offer_field_types.get(field, "str")
+        key = parse_version if kind == "version" else None
+        if op in ("in", "notin"):
+            values = frozenset(_query_value(field, v) for v in value)
+            if op == "in":
+                test = values.__contains__
+            else:
+                test = lambda x: x not in values
+        else:
+            compare, target = self._ops[op], _query_value(field, value)
+            test = lambda x: compare(x, target)
+
+        def matches(offer: typing.Dict) -> bool:
+            x = offer.get(field)
+            if x is None:
+                return False
+            if key is not None:
+                x = key(x)
+            return test(x)
+        return matches
+
+    def __len__(self) -> int:
+        return len(self.clauses)
+
+    def __call__(self, offer: typing.Dict) -> bool:
+        for test in self._tests:
+            if not test(offer):
+                return False
+        return True
+
+    def filter(self, offers: typing.Iterable[typing.Dict]) -> typing.Iterator[typing.Dict]:
+        return filter(self, offers)
+
+    def apply(self, res: typing.Dict) -> typing.Dict:
+        """Adds the clauses to the server query dict res, merging with the conditions already in it.
+
+        :param Dict res:
+        :rtype Dict:
+        """
+        for field, op, value in self.clauses:
+            if value is None:
+                res.pop(field, None)
+                continue
+            res.setdefault(field, {})[op] = list(value) if isinstance(value, tuple) else value
+        return res
+
+    def split(self) -> typing.Tuple[typing.Dict, "CompiledQuery"]:
+        """Separates the comparisons the server can't evaluate (ordering comparisons on version fields, which it
+        compares as strings) from the rest.
+
+        :return Tuple[Dict, CompiledQuery]: server query dict of the remaining clauses, and a query of the
+            separated ones to evaluate client-side.
+        """
+        server, local = [], []
+        for clause in self.clauses:
+            field, op, value = clause
+            if value is not None and op in ("gt", "gte", "lt", "lte") and offer_field_types.get(field) == "version":
+                local.append(clause)
+            else:
+                server.append(clause)
+        return CompiledQuery(server).apply({}), CompiledQuery(local)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_query(query_str: str) -> CompiledQuery:
+    """Compiles a query string (like the ones in the examples of commands for the search__offers function) into
+    a CompiledQuery. Compiled queries are cached by query string.
 
     :param str query_str:
-    :param Dict res:
-    :return Dict:
+    :rtype CompiledQuery:
     """
-    if res is None: res = {}
-    if type(query_str) == list:
-        query_str = " ".join(query_str)
     query_str = query_str.strip()
-    opts = re.findall("([a-zA-Z0-9_]+)( *[=><!]+| +(?:[lg]te?|nin|neq|eq|not ?eq|not ?in|in) )?( *)(\[[^\]]+\]|[^ ]+)?( *)", query_str)
-
-    #print(opts)
-    # res = {}
-    op_names = {
-        ">=": "gte",
-        ">": "gt",
-        "gt": "gt",
-        "gte": "gte",
-        "<=": "lte",
-        "<": "lt",
-        "lt": "lt",
-        "lte": "lte",
-        "!=": "neq",
-        "==": "eq",
-        "=": "eq",
-        "eq": "eq",
-        "neq": "neq",
-        "noteq": "neq",
-        "not eq": "neq",
-        "notin": "notin",
-        "not in": "notin",
-        "nin": "notin",
-        "in": "in",
-    };
-
-    field_alias = {
-        "cuda_vers": "cuda_max_good",
-        "display_active": "gpu_display_active",
-        "reliability": "reliability2",
-        "dlperf_usd": "dlperf_per_dphtotal",
-        "dph": "dph_total",
-        "flops_usd": "flops_per_dphtotal",
-    };
-
-    field_multiplier = {
-        "cpu_ram": 1000,
-        "gpu_ram": 1000,
-        "duration": 1.0 / (24.0 * 60.0 * 60.0),
-    }
-
-    fields = {
-        "bw_nvlink",
-        "compute_cap",
-        "cpu_cores",
-        "cpu_cores_effective",
-        "cpu_ram",
-        "cuda_max_good",
-        "direct_port_count",
-        "driver_version",
-        "disk_bw",
-        "disk_space",
-        "dlperf",
-        "dlperf_per_dphtotal",
-        "dph_total",
-        "duration",
-        "external",
-        "flops_per_dphtotal",
-        "gpu_display_active",
-        # "gpu_ram_free_min",
-        "gpu_mem_bw",
-        "gpu_name",
-        "gpu_ram",
-        "has_avx",
-        "host_id",
-        "id",
-        "inet_down",
-        "inet_down_cost",
-        "inet_up",
-        "inet_up_cost",
-        "machine_id",
-        "min_bid",
-        "mobo_name",
-        "num_gpus",
-        "pci_gen",
-        "pcie_bw",
-        "reliability2",
-        "rentable",
-        "rented",
-        "storage_cost",
-        "total_flops",
-        "verification",
-        "verified",
-
-    };
+    opts = _query_re.findall(query_str)
 
     joined = "".join("".join(x) for x in opts)
     if joined != query_str:
         raise ValueError(
             "Unconsumed text. Did you forget to quote your query? " + repr(joined) + " != " + repr(query_str))
+    clauses = []
     for field, op, _, value, _ in opts:
         value = value.strip(",[]")
-        v = res.setdefault(field, {})
         op = op.strip()
-        op_name = op_names.get(op)
+        op_name = query_op_names.get(op)
 
-        if field in field_alias:
-            field = field_alias[field];
+        field = query_field_alias.get(field, field)
 
-        if not field in fields:
-            print("Warning: Unrecognized field: {}, see list of recognized fields.".format(field), file=sys.stderr);
+        if not field in query_fields:
+            print("Warning: Unrecognized field: {}, see list of recognized fields.".format(field), file=sys.stderr)
         if not op_name:
             raise ValueError("Unknown operator. Did you forget to quote your query? " + repr(op).strip("u"))
         if op_name in ["in", "notin"]:
@@ -478,67 +1701,316 @@ def parse_query(query_str: str, res: typing.Dict = None) -> typing.Dict:
         if value in ["?", "*", "any"]:
             if op_name != "eq":
                 raise ValueError("Wildcard only makes sense with equals.")
-            if field in v:
-                del v[field]
-            if field in res:
-                del res[field]
+            clauses.append((field, op_name, None))
             continue
 
-        if field in field_multiplier:
-            value = str(float(value) * field_multiplier[field]);
+        if isinstance(value, list):
+            if field in query_field_multiplier:
+                value = [str(float(x) * query_field_multiplier[field]) for x in value]
+            value = tuple(x.replace('_', ' ') for x in value)
+        else:
+            if field in query_field_multiplier:
+                value = str(float(value) * query_field_multiplier[field])
+            value = value.replace('_', ' ')
+        clauses.append((field, op_name, value))
+    return CompiledQuery(clauses)
+
+
+def parse_query(query_str: str, res: typing.Dict = None) -> typing.Dict:
+    """
+    Basically takes a query string (like the ones in the examples of commands for the search__offers function) and
+    processes it into a dict of URL parameters to be sent to the server.
+
+    :param str query_str:
+    :param Dict res:
+    :return Dict:
+    """
+    if res is None: res = {}
+    if type(query_str) == list:
+        query_str = " ".join(query_str)
+    return compile_query(query_str).apply(res)
+
+
+class OfferIndex(object):
+    """Columnar snapshot of offers for searching without the server: one NumPy array per field. Numbers and
+    bools are float64 columns with NaN for missing values, strings and versions are fixed-width unicode columns
+    with '' for missing; a missing value never satisfies a condition. Queries (dicts made by parse_query) become
+    boolean masks and orderings an np.lexsort, so searching 100k offers takes milliseconds.
+    """
+
+    def __init__(self, columns: typing.Dict, types: typing.Dict[str, str], meta: typing.Optional[typing.Dict] = None):
+        self.columns = columns
+        self.types = types
+        self.meta = meta or {}
+        self.size = len(next(iter(columns.values()))) if columns else 0
+        self._keys: typing.Dict[str, typing.Any] = {}
+
+    def __len__(self) -> int:
+        return self.size
+
+    @classmethod
+    def from_offers(cls, offers: typing.Iterable[typing.Dict], meta: typing.Optional[typing.Dict] = None) -> "OfferIndex":
+        rows = list(offers)
+        types = {}
+        for row in rows:
+            for k, v in row.items():
+                if k in types or v is None or isinstance(v, (dict, list)):
+                    continue
+                if k in offer_field_types:
+                    types[k] = offer_field_types[k]
+                elif isinstance(v, bool):
+                    types[k] = "bool"
+                elif isinstance(v, int):
+                    types[k] = "int"
+                elif isinstance(v, float):
+                    types[k] = "float"
+                else:
+                    types[k] = "str"
+        columns = {}
+        for k, kind in types.items():
+            values = [row.get(k) for row in rows]
+            if kind in ("str", "version"):
+                columns[k] = np.array(["" if v is None else str(v) for v in values], dtype=str)
+            else:
+                columns[k] = np.array([np.nan if v is None or isinstance(v, (dict, list, str)) else float(v)
+                                       for v in values], dtype=np.float64)
+        return cls(columns, types, meta)
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        tmp_path = "{}.{}.tmp.npz".format(path, os.getpid())
+        meta = dict(self.meta, types=self.types)
+        np.savez_compressed(tmp_path, _meta=np.array(json.dumps(meta)),
+                            **{"c_" + k: v for k, v in self.columns.items()})
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "OfferIndex":
+        with np.load(path) as data:
+            meta = json.loads(str(data["_meta"]))
+            columns = {name[2:]: data[name] for name in data.files if name.startswith("c_")}
+        return cls(columns, meta.pop("types"), meta)
+
+    @staticmethod
+    def _pack_version(version: typing.Tuple[int, ...]) -> float:
+        # The first three parts, 16 bits each, fit exactly in a float64 and order the same way as the tuples.
+        parts = (tuple(min(p, 0xFFFF) for p in version[:3]) + (0, 0, 0))[:3]
+        return float((parts[0] << 32) | (parts[1] << 16) | parts[2])
+
+    def _key(self, field: str):
+        """The column for field in comparable form: version strings are packed into numbers (parsed once per
+        distinct value), other columns are returned as stored.
+        """
+        if self.types[field] != "version":
+            return self.columns[field]
+        if field not in self._keys:
+            values, inverse = np.unique(self.columns[field], return_inverse=True)
+            packed = np.array([self._pack_version(parse_version(v)) if v else np.nan for v in values.tolist()],
+                              dtype=np.float64)
+            self._keys[field] = packed[inverse]
+        return self._keys[field]
+
+    def _typed(self, field: str, value):
+        kind = self.types[field]
+        if kind == "version":
+            return self._pack_version(parse_version(value))
+        if kind == "str":
+            return str(value)
+        if kind == "bool":
+            return 1.0 if _parse_bool(value) else 0.0
+        return float(value)
+
+    def _compare(self, field: str, op: str, value):
+        col = self._key(field)
+        present = col != "" if col.dtype.kind == "U" else ~np.isnan(col)
+        if op in ("in", "notin"):
+            hits = np.isin(col, [self._typed(field, v) for v in value])
+            return hits if op == "in" else ~hits & present
+        compare = CompiledQuery._ops.get(op)
+        if compare is None:
+            raise ValueError("Unknown operator: {}".format(op))
+        with np.errstate(invalid="ignore"):
+            return compare(col, self._typed(field, value)) & present
+
+    def mask(self, query: typing.Dict):
+        """Boolean array selecting the offers that satisfy every condition in the query dict. Conditions on fields
+        the snapshot has no column for are ignored.
+        """
+        m = np.ones(self.size, dtype=bool)
+        for field, ops in query.items():
+            if not isinstance(ops, dict) or field not in self.columns:
+                continue
+            for op, value in ops.items():
+                m &= self._compare(field, op, value)
+        return m
+
+    def sort(self, idx, order: typing.List) -> typing.Any:
+        """Reorders the offer indices idx by a list of [field, 'asc'|'desc'] pairs, first pair most significant."""
+        keys = []
+        for field, direction in reversed(order):
+            if field not in self.columns:
+                continue
+            col = self._key(field)[idx]
+            if self.types[field] == "str":
+                col = np.unique(col, return_inverse=True)[1]
+            keys.append(-col if direction == "desc" else col)
+        if not keys:
+            return idx
+        return idx[np.lexsort(keys)]
+
+    def rows(self, idx) -> typing.List[typing.Dict]:
+        """Materializes the offers at idx as dicts, with missing values as None."""
+        names = list(self.columns)
+        cols = []
+        for name in names:
+            values = self.columns[name][idx].tolist()
+            kind = self.types[name]
+            if kind in ("str", "version"):
+                values = [v if v != "" else None for v in values]
+            elif kind == "int":
+                values = [int(v) if v == v else None for v in values]
+            elif kind == "bool":
+                values = [bool(v) if v == v else None for v in values]
+            else:
+                values = [v if v == v else None for v in values]
+            cols.append(values)
+        return [dict(zip(names, vals)) for vals in zip(*cols)]
+
+    def search(self, query: typing.Dict, max_count: typing.Optional[int] = None) -> typing.List[typing.Dict]:
+        idx = self.sort(np.flatnonzero(self.mask(query)), query.get("order") or [])
+        if max_count is not None:
+            idx = idx[:max_count]
+        return self.rows(idx)
+
+
+output_formats = ("table", "csv", "tsv", "ndjson", "markdown")
+
+# display_table sizes its columns from this many rows and then prints the rest as they come, so a huge listing
+# starts printing right away and isn't held in memory. A rare wider cell later on just sticks out.
+table_sample_rows = 1000
 
-        v[op_name] = value.replace('_', ' ')
-        res[field] = v;
 
-    #print(res)
-    return res
+class TableRenderer(object):
+    """Prints rows described by display_table's 5-tuple fields in one of output_formats, streaming: rows are
+    formatted and written as they are read instead of being collected first.
 
+    The per-column formatters (conv, then the format string, then ' ' to '_') are built once per renderer rather
+    than per cell. "table" pads columns to widths given up front, or measured on the first sample_rows rows.
+    csv and tsv write a header of field names and the converted but unformatted values, ndjson writes each row
+    dict whole, and markdown writes a pipe table of the formatted cells.
+    """
 
-def display_table(rows: list, fields: typing.Tuple, max_count: typing.Optional[int] = None) -> None:
+    def __init__(self, fields: typing.Sequence[typing.Tuple], fmt: str = "table", widths: typing.Optional[typing.Sequence[int]] = None,
+                 sample_rows: int = table_sample_rows, out: typing.Optional[typing.TextIO] = None):
+        if fmt not in output_formats:
+            raise ValueError("Unknown output format: {}".format(fmt))
+        self.fields = list(fields)
+        self.fmt = fmt
+        self.widths = list(widths) if widths is not None else None
+        self.sample_rows = max(1, sample_rows)
+        self.out = out or sys.stdout
+        self.keys = [key for key, _, _, _, _ in self.fields]
+        self.names = [name for _, name, _, _, _ in self.fields]
+        self.ljusts = [ljust for _, _, _, _, ljust in self.fields]
+        self.formatters = [self._formatter(fmt_str, conv) for _, _, fmt_str, conv, _ in self.fields]
+        self.converters = [conv for _, _, _, conv, _ in self.fields]
+
+    @staticmethod
+    def _formatter(fmt_str: str, conv: typing.Optional[typing.Callable]) -> typing.Callable:
+        format = fmt_str.format
+        if conv is None:
+            def cell(val):
+                return "-" if val is None else format(val).replace(" ", "_")
+        else:
+            def cell(val):
+                return "-" if val is None else format(conv(val)).replace(" ", "_")
+        return cell
+
+    def cells(self, row: typing.Dict) -> typing.List[str]:
+        """Formats the values of one row as the table shows them."""
+        get = row.get
+        return [f(get(k)) for k, f in zip(self.keys, self.formatters)]
+
+    def render(self, rows: typing.Iterable[typing.Dict], max_count: typing.Optional[int] = None) -> None:
+        rows = itertools.islice(rows, max_count)
+        getattr(self, "_render_" + self.fmt)(rows)
+        self.out.flush()
+
+    def _line(self, cells: typing.List[str], widths: typing.Sequence[int]) -> str:
+        return "  ".join(c.ljust(w) if lj else c.rjust(w) for c, w, lj in zip(cells, widths, self.ljusts)) + "\n"
+
+    def _render_table(self, rows: typing.Iterator[typing.Dict]):
+        write = self.out.write
+        sample = [self.cells(row) for row in itertools.islice(rows, 0 if self.widths else self.sample_rows)]
+        widths = self.widths
+        if widths is None:
+            widths = [max([len(name)] + [len(c[i]) for c in sample]) for i, name in enumerate(self.names)]
+        write(self._line(self.names, widths))
+        for cells in sample:
+            write(self._line(cells, widths))
+        for row in rows:
+            write(self._line(self.cells(row), widths))
+
+    def _render_markdown(self, rows: typing.Iterator[typing.Dict]):
+        write = self.out.write
+        write("| " + " | ".join(self.names) + " |\n")
+        write("|" + "|".join(":---" if lj else "---:" for lj in self.ljusts) + "|\n")
+        for row in rows:
+            write("| " + " | ".join(c.replace("|", "\\|") for c in self.cells(row)) + " |\n")
+
+    def _render_csv(self, rows: typing.Iterator[typing.Dict], delimiter: str = ","):
+        writer = csv.writer(self.out, delimiter=delimiter, lineterminator="\n")
+        writer.writerow(self.keys)
+        keyed = list(zip(self.keys, self.converters))
+        for row in rows:
+            values = []
+            for key, conv in keyed:
+                val = row.get(key)
+                values.append("" if val is None else (conv(val) if conv is not None else val))
+            writer.writerow(values)
+
+    def _render_tsv(self, rows: typing.Iterator[typing.Dict]):
+        self._render_csv(rows, delimiter="\t")
+
+    def _render_ndjson(self, rows: typing.Iterator[typing.Dict]):
+        write = self.out.write
+        for row in rows:
+            write(json.dumps(row, sort_keys=True) + "\n")
+
+
+def display_table(rows: typing.Iterable[typing.Dict], fields: typing.Sequence[typing.Tuple], max_count: typing.Optional[int] = None, fmt: str = "table") -> None:
     """Basically takes a set of field names and rows containing the corresponding data and prints a nice tidy table
     of it.
 
-    :param list rows: Each row is a dict with keys corresponding to the field names (first element) in the fields tuple.
+    :param Iterable[Dict] rows: Each row is a dict with keys corresponding to the field names (first element) in the fields tuple. Rows are printed as they are read.
 
     :param Tuple fields: 5-tuple describing a field. First element is field name, second is human readable version, third is format string, fourth is a lambda function run on the data in that field, fifth is a bool determining text justification. True = left justify, False = right justify. Here is an example showing the tuples in action.
 
     :param int max_count: The maximum number of table entries to show.
 
+    :param str fmt: one of output_formats, as chosen with --format.
+
     :rtype None:
 
     Example of 5-tuple: ("cpu_ram", "RAM", "{:0.1f}", lambda x: x / 1000, False)
     """
-    header = [name for _, name, _, _, _ in fields]
-    out_rows = [header]
-    lengths = [len(x) for x in header]
-    count = 0
-    for instance in rows:
-        row = []
-        out_rows.append(row)
-        for key, name, fmt, conv, _ in fields:
-            conv = conv or (lambda x: x)
-            val = instance.get(key, None)
-            if val is None:
-                s = "-"
-            else:
-                val = conv(val)
-                s = fmt.format(val)
-            s = s.replace(' ', '_')
-            idx = len(row)
-            lengths[idx] = max(len(s), lengths[idx])
-            row.append(s)
-        count += 1
-        if max_count is not None and count >= max_count:
-            break
+    TableRenderer(fields, fmt).render(rows, max_count)
+
+
+def print_aligned(out_rows: typing.List[typing.List[str]], ljusts: typing.Sequence[bool], widths: typing.Optional[typing.Sequence[int]] = None) -> None:
+    """Prints rows of already formatted cells as columns padded to the widest cell, or to widths (which should
+    exclude any invisible escape sequences in the cells).
+
+    :param List[List[str]] out_rows:
+    :param Sequence[bool] ljusts: per column, True = left justify, False = right justify.
+    :param Sequence[int] widths:
+    """
+    if widths is None:
+        widths = [max(len(row[i]) for row in out_rows) for i in range(len(ljusts))]
     for row in out_rows:
         out = []
-        for l, s, f in zip(lengths, row, fields):
-            _, _, _, _, ljust = f
-            if ljust:
-                s = s.ljust(l)
-            else:
-                s = s.rjust(l)
-            out.append(s)
+        for l, s, ljust in zip(widths, row, ljusts):
+            out.append(s.ljust(l) if ljust else s.rjust(l))
         print("  ".join(out))
 
 
@@ -620,7 +2092,7 @@ def copy(args: argparse.Namespace):
         "src_path": src_path,
         "dst_path": dst_path,
     }
-    r = requests.put(url, json=req_json)
+    r = http_put(args, url, json=req_json)
     r.raise_for_status()
     if (r.status_code == 200):
         rj = r.json()
@@ -660,12 +2132,29 @@ def copy(args: argparse.Namespace):
     argument("src", help="path to source directory to copy.", type=str),
     argument("dst", help="instance_id:/path to target of copy operation.", type=str),
     argument("-i", "--identity", help="Location of ssh private key", type=str),
-    argument("-g", "--gitignore", help="Do not copy files matching .gitignore paths", action="store_true"),
+    argument("-g", "--gitignore", help="Do not copy files matching .vastignore / .gitignore paths, nor .git",
+             action="store_true"),
+    argument("--delete", help="Delete files in dst that were copied by an earlier copy2 and no longer exist in src",
+             action="store_true"),
+    argument("--full", help="Copy every file, not only those changed since the last copy2 to dst",
+             action="store_true"),
+    argument("--compress", help="how to compress files that compress well. auto (default) picks the codec and "
+                                "level that are fastest for the measured link speed",
+             choices=["auto", "none", "gzip", "zstd", "lz4"], default="auto"),
     usage="./vast copy2 src dst",
     help="Copy a directory from local to instance using Python-based scp",
     epilog=deindent("""
+        Only files that are new or changed since the last copy2 to the same instance:/path are sent. copy2
+        leaves a .vast-manifest.json listing what it copied in dst and caches it in ~/.cache/vast/sync; if the
+        two disagree (e.g. the instance was recreated) the remote one wins.
+
+        Files that don't compress (by extension, e.g. .jpg .npz .pt .parquet, or by sampling) are sent as
+        they are; the rest are compressed with gzip, or zstd / lz4 when both the zstandard / lz4 Python
+        packages and the instance's zstd / lz4 commands are there.
+
         Examples:
          vast copy2 . 11824:/root
+         vast copy2 --delete . 11824:/root
     """),
 )
 def copy2(args: argparse.Namespace):
@@ -687,11 +2176,11 @@ def copy2(args: argparse.Namespace):
     if not os.path.isdir(src_path):
         print('Error: source path must be a directory')
         return 1
-    rel_paths = _relative_paths(src_path)
+    walker = TreeWalker(src_path, use_ignore_files=args.gitignore)
+    rel_paths = walker.walk()
     print(f'Copying {len(rel_paths)} files from {src_path} to {dst_path} in instance {dst_id}...')
-    check_gitignore = args.gitignore
     instance = _get_instance(args, dst_id)
-    _scp_files(args, src_path, rel_paths, instance, dst_path, check_gitignore=check_gitignore)
+    return _scp_files(args, walker, rel_paths, instance, dst_path)
 
 
 @parser.command(
@@ -751,16 +2240,57 @@ def launch(args: argparse.Namespace):
 )
 def start__run(args: argparse.Namespace):
     instance_id = args.id
-    _start_instance(args)
-    print(f'Started instance {instance_id}.')
     try:
-        _launch_job(args, instance_id)
+        instance, ssh_client = _start_instance(args)
+        print(f'Started instance {instance_id}.')
+        _launch_job_in_ready_instance(args, instance, ssh_client)
     finally:
         _stop_instance(args)
 
 
+def _build_offer_query(args: argparse.Namespace, query_str=None, offer_type: typing.Optional[str] = None) -> typing.Dict:
+    """Builds the /bundles query dict from the search options: default query, query string, order and type.
+
+    :param argparse.Namespace args: should supply all the command-line options
+    :param query_str: query to use instead of args.query.
+    :param str offer_type: type to use instead of args.type.
+    :rtype Dict:
+    """
+    query: typing.Dict[str, typing.Any]
+    if args.no_default:
+        query = {}
+    else:
+        query = {"verified": {"eq": True}, "external": {"eq": False}, "rentable": {"eq": True}}
+
+    if query_str is None:
+        query_str = args.query
+    if query_str is not None:
+        query = parse_query(query_str, query)
+
+    order = []
+    for name in getattr(args, "order", "").split(","):
+        name = name.strip()
+        if not name:
+            continue
+        direction = "asc"
+        if name.strip("-") != name:
+            direction = "desc"
+        field = name.strip("-")
+        field = query_field_alias.get(field, field)
+        order.append([field, direction])
+
+    query["order"] = order
+    query["type"] = offer_type or args.type
+    # For backwards compatibility, support --type=interruptible option
+    if query["type"] == 'interruptible':
+        query["type"] = 'bid'
+    if args.disable_bundling:
+        query["disable_bundling"] = True
+    return query
+
+
 @parser.command(
-    argument("-t", "--type", default="on-demand", help="Show 'bid'(interruptible) or 'on-demand' offers. default: on-demand"),
+    argument("-t", "--type", default="on-demand", help="Show 'bid'(interruptible) or 'on-demand' offers, or both as 'bid,on-demand'. default: on-demand"),
     argument("-i", "--interruptible", dest="type", const="bid", action="store_const", help="Alias for --type=bid"),
     argument("-b", "--bid", dest="type", const="bid", action="store_const", help="Alias for --type=bid"),
     argument("-d", "--on-demand", dest="type", const="on-demand", action="store_const", help="Alias for --type=on-demand"),
@@ -770,6 +2300,15 @@ def start__run(args: argparse.Namespace):
     argument("-o", "--order", type=str, help="Comma-separated list of fields to sort on. postfix field with - to sort desc. ex: -o 'num_gpus,total_flops-'.  default='score-'", default='score-'),
     argument("-f", "--fields", type=str, default=None, help="Comma-separated list of fields to show in the table."),
     argument("-m", "--max", type=int, default=None, help="Maximum number of table entries to show."),
+    argument("--local", action="store_true", help="Search the local snapshot made by 'offers sync' instead of the server"),
+    argument("--ndjson", dest="format", action="store_const", const="ndjson", default=argparse.SUPPRESS, help=argparse.SUPPRESS),
+    argument("-q", "--query", dest="queries", action="append", metavar="QUERY", help="Run another query and merge its offers into the same table. Repeatable."),
+    argument("--query-file", metavar="FILE", help="Read more queries from FILE, one per line ('-' for stdin). Blank lines and lines starting with '#' are skipped."),
+    argument("--dedupe", choices=["id", "machine_id"], default="id", help="When merging queries, show one offer per id or per machine_id. default: id"),
+    argument("--score", metavar="EXPR", help="Rank offers by an arithmetic expression of their fields, highest first, e.g. 'dlperf/dph_total'. Shown as the Score column."),
+    argument("--top", type=int, metavar="K", help="Keep only the K best offers by --score (default --score: dlperf_per_dphtotal)"),
+    argument("--pareto", metavar="FIELDS", help="Keep only offers not beaten on every one of these comma-separated fields by another offer; prefix a field with - to prefer low values, e.g. 'dlperf,-dph_total,reliability2' (write --pareto=-dph_total,... when the first one has a -)"),
+    argument("--watch", type=float, metavar="SECONDS", help="Poll every SECONDS and print only the offers added, removed or changed since the last poll. Ctrl-C to stop."),
     argument("query", help="Query to search for. default: 'external=false rentable=true verified=true', pass -n to ignore default", nargs="*", default=None),
     usage="./vast search offers [--help] [--api-key API_KEY] [--raw] <query>",
     help="Search for instance types using custom query",
@@ -792,6 +2331,22 @@ def start__run(args: argparse.Namespace):
             ./vast search offers 'reliability > 0.99  num_gpus>=4' -o 'num_gpus-'
             ./vast search offers 'rentable = any'
             ./vast search offers 'reliability > 0.98 num_gpus=1 gpu_name=RTX_3090'
+            ./vast search offers 'driver_version >= 535.54 gpu_name in [RTX_4090,RTX_3090]'
+            ./vast search offers 'gpu_name=RTX_4090 dph<0.5' --watch 60
+            ./vast search offers -q 'gpu_name=RTX_4090 num_gpus>=2' -q 'gpu_name=A100_SXM4' -t bid,on-demand -o 'dph' --dedupe machine_id
+
+        Ranking (done locally, over every offer the query returns):
+
+            ./vast search offers 'num_gpus>=2' --top 10 --score 'gpu_ram*num_gpus/dph_total'
+            ./vast search offers 'reliability>0.98' --pareto 'dlperf,-dph_total,reliability2'
+
+        --score and --pareto expressions use the field names below (and their aliases, e.g. dph), numbers,
+        + - * / ** %, and the functions abs, min, max, log and sqrt. Offers an expression can't be evaluated on
+        (a missing field, division by zero) are left out.
+
+        With several queries (-q, --query-file, or more than one --type), all of them run concurrently and
+        their offers are merged into one table ordered by -o. The Q column lists the queries each offer
+        matched, numbered as printed on stderr.
 
         Available fields:
 
@@ -809,7 +2364,7 @@ def start__run(args: argparse.Namespace):
             dlperf:                 float     DL-perf score  (see FAQ for explanation)
             dlperf_usd:             float     DL-perf/$
             dph:                    float     $/hour rental cost
-            driver_version          string    driver version in use on a host.
+            driver_version          version   driver version in use on a host, compared numerically (ie: 535.54.03 > 470.86)
             duration:               float     max rental duration in days
             external:               bool      show external offers in addition to datacenter offers
             flops_usd:              float     TFLOPs/$
@@ -842,84 +2397,661 @@ def search__offers(args):
 
     :param argparse.Namespace args: should supply all the command-line options
     """
-    field_alias = {
-        "cuda_vers": "cuda_max_good",
-        "reliability": "reliability2",
-        "dlperf_usd": "dlperf_per_dphtotal",
-        "dph": "dph_total",
-        "flops_usd": "flops_per_dphtotal",
-    }
-
+    searches = _offer_searches(args)
+    if searches is None:
+        return 1
+    if args.top is not None and not args.score:
+        args.score = "dlperf_per_dphtotal"
+    if args.watch and (args.score or args.pareto):
+        print("Error: --watch can't be combined with --score, --top or --pareto.")
+        return 1
+    if len(searches) > 1:
+        if args.local or args.watch:
+            print("Error: --local and --watch take a single query and type.")
+            return 1
+        return _search_offers_merged(args, searches)
+    query_str, offer_type = searches[0]
     try:
-
-        if args.no_default:
-            query = {}
-        else:
-            query = {"verified": {"eq": True}, "external": {"eq": False}, "rentable": {"eq": True}}
-
-        if args.query is not None:
-            query = parse_query(args.query, query)
-
-        order = []
-        for name in args.order.split(","):
-            name = name.strip()
-            if not name:
-                continue
-            direction = "asc"
-            if name.strip("-") != name:
-                direction = "desc"
-            field = name.strip("-")
-            if field in field_alias:
-                field = field_alias[field]
-            order.append([field, direction])
-
-        query["order"] = order
-        query["type"] = args.type
-        # For backwards compatibility, support --type=interruptible option
-        if query["type"] == 'interruptible':
-            query["type"] = 'bid'
-        if args.disable_bundling:
-            query["disable_bundling"] = True
+        query = _build_offer_query(args, query_str, offer_type)
     except ValueError as e:
         print("Error: ", e)
         return 1
 
-    url = apiurl(args, "/bundles", {"q": query})
-    r = requests.get(url)
+    if args.local:
+        if args.watch:
+            print("Error: --watch polls the server and can't be combined with --local.")
+            return 1
+        return _search_offers_local(args, query)
+    if args.watch:
+        if args.watch <= 0:
+            print("Error: --watch needs a positive number of seconds.")
+            return 1
+        return _watch_offers(args, query)
+
+    # The server compares versions as strings, so 'driver_version >= 535.54' is evaluated here instead.
+    server_query, client_query = _split_offer_query(query)
+    url = apiurl(args, "/bundles", {"q": server_query})
+    r = http_get(args, url, stream=True)
     r.raise_for_status()
-    rows = r.json()["offers"]
-    if args.raw:
-        print(json.dumps(rows, indent=1, sort_keys=True))
-    else:
-        shown_fields = displayable_fields
-        if args.fields is not None:
-            fields_set = set([f.strip() for f in args.fields.split(',')])
-            shown_fields = [f for f in displayable_fields if f[0] in fields_set]
-            if len(shown_fields) == 0:
-                print('Error: Fields requested not found.')
-                return 1
-        display_table(rows, shown_fields, max_count=args.max)
+    rows = iter_json_array(r, "offers")
+    try:
+        return _print_offers(args, client_query.filter(rows) if client_query else rows)
+    finally:
+        rows.close()
 
 
-@parser.command(
-    usage="./vast show instances [--api-key API_KEY] [--raw]",
-    help="Display user's current instances"
-)
-def show__instances(args):
+def _offer_searches(args: argparse.Namespace) -> typing.Optional[typing.List[typing.Tuple[typing.Any, str]]]:
+    """Lists the (query, type) pairs search offers should run: each query given positionally, with -q or in
+    --query-file, for each type in the comma-separated --type. Returns None after printing an error.
     """
-    Shows the stats on the machine the user is renting.
-
-    :param argparse.Namespace args: should supply all the command-line options
-    :rtype:
+    queries = []
+    if args.query:
+        queries.append(args.query)
+    queries.extend(getattr(args, "queries", None) or [])
+    if getattr(args, "query_file", None):
+        try:
+            f = sys.stdin if args.query_file == "-" else open(args.query_file)
+            with f:
+                queries.extend(line.strip() for line in f if line.strip() and not line.lstrip().startswith("#"))
+        except OSError as e:
+            print("Error: can't read --query-file: {}".format(e))
+            return None
+    if not queries:
+        queries.append(None)
+    types = [t.strip() for t in args.type.split(",") if t.strip()] or ["on-demand"]
+    return [(q, t) for q in queries for t in types]
+
+
+def _offer_sort_key(field: str):
+    kind = offer_field_types.get(field)
+
+    def key(row):
+        val = row.get(field)
+        if val is None:
+            return (1, 0)
+        return (0, parse_version(val) if kind == "version" else val)
+    return key
+
+
+def sort_offers(rows: typing.List[typing.Dict], order: typing.List) -> typing.List[typing.Dict]:
+    """Sorts offers in place by a list of [field, 'asc'|'desc'] pairs, first pair most significant, as the
+    server orders /bundles. Offers missing a field sort after the rest either way.
     """
-    req_url = apiurl(args, "/instances", {"owner": "me"})
-    r = requests.get(req_url)
-    r.raise_for_status()
-    rows = r.json()["instances"]
-    if args.raw:
-        print(json.dumps(rows, indent=1, sort_keys=True))
-    else:
-        display_table(rows, instance_fields)
+    for field, direction in reversed(order):
+        key = _offer_sort_key(field)
+        if direction == "desc":
+            present = [r for r in rows if r.get(field) is not None]
+            present.sort(key=key, reverse=True)
+            rows[:] = present + [r for r in rows if r.get(field) is None]
+        else:
+            rows.sort(key=key)
+    return rows
+
+
+def _search_offers_merged(args: argparse.Namespace, searches: typing.List[typing.Tuple[typing.Any, str]]) -> typing.Optional[int]:
+    """search offers with several queries or types: runs them all concurrently, merges the offers keeping the
+    first of each --dedupe key, and prints them as one table in the -o order with a column of the queries
+    that matched each offer.
+    """
+    queries = []
+    try:
+        for query_str, offer_type in searches:
+            queries.append(_build_offer_query(args, query_str, offer_type))
+    except ValueError as e:
+        print("Error: ", e)
+        return 1
+    for n, ((query_str, _), query) in enumerate(zip(searches, queries), 1):
+        if isinstance(query_str, list):
+            query_str = " ".join(query_str)
+        print("Query {} ({}): {}".format(n, query["type"], query_str or "(default)"), file=sys.stderr)
+
+    client = AsyncVastClient(client=get_client(args), concurrency=min(len(queries), getattr(args, "concurrency", None) or 8))
+    try:
+        results = asyncio.run(client.search_offers(queries))
+    finally:
+        client.close()
+
+    merged: typing.Dict[typing.Any, typing.Dict] = {}
+    failed = 0
+    for n, result in enumerate(results, 1):
+        if isinstance(result, Exception):
+            print("Query {} failed: {}".format(n, result), file=sys.stderr)
+            failed += 1
+            continue
+        for offer in result:
+            key = offer.get(args.dedupe)
+            if key in merged:
+                if n not in merged[key]["queries"]:
+                    merged[key]["queries"].append(n)
+            else:
+                merged[key] = dict(offer, queries=[n])
+    if failed == len(results):
+        return 1
+    rows = sort_offers(list(merged.values()), queries[0]["order"])
+
+    return _print_offers(args, rows, [("queries", "Q", "{}", lambda x: ",".join(map(str, x)), True)])
+
+
+def _split_offer_query(query: typing.Dict) -> typing.Tuple[typing.Dict, CompiledQuery]:
+    """Splits a /bundles query dict into what to send to the server and a CompiledQuery of the conditions the
+    server can't evaluate.
+
+    :param Dict query: as made by _build_offer_query.
+    :rtype Tuple[Dict, CompiledQuery]:
+    """
+    conditions, client_query = CompiledQuery.from_query(query).split()
+    if not client_query:
+        return query, client_query
+    server_query = {k: conditions[k] if isinstance(v, dict) else v for k, v in query.items()
+                    if not isinstance(v, dict) or k in conditions}
+    return server_query, client_query
+
+
+def _print_offers(args: argparse.Namespace, rows: typing.Iterable[typing.Dict], extra_fields: typing.Sequence[typing.Tuple] = ()) -> typing.Optional[int]:
+    """Prints offers as search offers does, ranked by --score/--top/--pareto if given: a table of the --fields
+    columns in the --format format (ndjson streams whole offers as they are decoded), or json with --raw.
+
+    :param argparse.Namespace args: should supply all the command-line options
+    :param Iterable[Dict] rows: offers, possibly still being decoded.
+    :param Sequence[Tuple] extra_fields: table columns to show before the --fields ones.
+    """
+    try:
+        rows = rank_offers(rows, getattr(args, "score", None), getattr(args, "top", None), getattr(args, "pareto", None))
+    except ValueError as e:
+        print("Error: ", e)
+        return 1
+    if getattr(args, "score", None):
+        extra_fields = list(extra_fields) + [("rank_score", "Score", "{:0.3f}", None, False)]
+    if args.raw:
+        print(json.dumps(list(rows), indent=1, sort_keys=True))
+    else:
+        shown_fields = _shown_offer_fields(args)
+        if not shown_fields:
+            print('Error: Fields requested not found.')
+            return 1
+        display_table(rows, list(extra_fields) + list(shown_fields), max_count=args.max, fmt=args.format)
+    return 0
+
+
+def _shown_offer_fields(args: argparse.Namespace) -> typing.Sequence[typing.Tuple]:
+    """The displayable_fields selected with --fields, or all of them."""
+    if args.fields is None:
+        return displayable_fields
+    fields_set = set([f.strip() for f in args.fields.split(',')])
+    return [f for f in displayable_fields if f[0] in fields_set]
+
+
+def _watch_offers(args: argparse.Namespace, query: typing.Dict) -> typing.Optional[int]:
+    """search offers --watch: polls the query and prints only the offers added, removed or changed since the last
+    poll, compared by a hash of each offer's shown fields. The interval stretches (up to 8x --watch) while
+    nothing changes and snaps back on the first change.
+
+    :param argparse.Namespace args: should supply all the command-line options
+    :param Dict query: as made by _build_offer_query.
+    """
+    shown_fields = _shown_offer_fields(args)
+    if not shown_fields:
+        print('Error: Fields requested not found.')
+        return 1
+    server_query, client_query = _split_offer_query(query)
+    url = apiurl(args, "/bundles", {"q": server_query})
+
+    try:
+        _poll_offer_changes(args, url, client_query, shown_fields)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def _poll_offer_changes(args: argparse.Namespace, url: str, client_query: CompiledQuery, shown_fields: typing.Sequence[typing.Tuple]) -> None:
+    keys = [f[0] for f in shown_fields]
+    as_json = args.raw or args.format == "ndjson"
+    highlight = sys.stdout.isatty() and not as_json
+    previous = None  # id -> (hash of shown values, shown values, offer)
+    interval = args.watch
+    while True:
+        started = time.monotonic()
+        try:
+            r = http_get(args, url, stream=True, max_age=0)
+            r.raise_for_status()
+            rows = iter_json_array(r, "offers")
+            try:
+                current = {}
+                for offer in itertools.islice(client_query.filter(rows) if client_query else rows, args.max):
+                    values = tuple(offer.get(k) for k in keys)
+                    current[offer.get("id")] = (hash(values), values, offer)
+            finally:
+                rows.close()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print("Warning: poll failed: {}".format(e), file=sys.stderr)
+            current = None
+
+        if current is not None:
+            changes: typing.List[typing.Tuple[str, typing.Dict, typing.Sequence[int]]]
+            if previous is None:
+                changes = [("+", offer, ()) for _, _, offer in current.values()]
+            else:
+                changes = [("-", offer, ()) for id, (_, _, offer) in previous.items() if id not in current]
+                for id, (h, values, offer) in current.items():
+                    old = previous.get(id)
+                    if old is None:
+                        changes.append(("+", offer, ()))
+                    elif old[0] != h:
+                        changes.append(("~", offer, [i for i, (a, b) in enumerate(zip(old[1], values)) if a != b]))
+            previous = current
+            _print_offer_changes(changes, shown_fields, as_json, highlight, len(current))
+            interval = args.watch if changes else min(interval * 1.5, args.watch * 8)
+
+        time.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+
+def _print_offer_changes(changes: typing.List, fields: typing.Sequence[typing.Tuple], as_json: bool, highlight: bool, total: int) -> None:
+    """Prints one --watch delta: a summary line and a table of '+' added, '-' removed and '~' changed offers, with
+    the changed cells in reverse video (or marked with '*' when stdout isn't a terminal). With as_json, prints
+    one json line per change instead.
+    """
+    if as_json:
+        kinds = {"+": "added", "-": "removed", "~": "changed"}
+        for mark, offer, changed in changes:
+            print(json.dumps({"change": kinds[mark], "fields": [fields[i][0] for i in changed], "offer": offer}, sort_keys=True))
+        sys.stdout.flush()
+        return
+    counts = Counter(mark for mark, _, _ in changes)
+    print("{}  {} offers  +{} added  -{} removed  ~{} changed".format(
+        time.strftime("%H:%M:%S"), total, counts["+"], counts["-"], counts["~"]))
+    if changes:
+        renderer = TableRenderer(fields)
+        out_rows = [[""] + renderer.names]
+        widths = [1] + [len(c) for c in out_rows[0][1:]]
+        for mark, offer, changed in changes:
+            cells = renderer.cells(offer)
+            for i, c in enumerate(cells):
+                widths[i + 1] = max(widths[i + 1], len(c) + (i in changed and not highlight))
+            for i in changed:
+                cells[i] = cells[i] + "*" if not highlight else "\033[7m" + cells[i] + "\033[0m"
+            out_rows.append([mark] + cells)
+        if highlight:
+            # Pad by hand: the escape sequences take no room on screen.
+            for row in out_rows[1:]:
+                for i in range(1, len(row)):
+                    pad = widths[i] - len(row[i].replace("\033[7m", "").replace("\033[0m", ""))
+                    row[i] = row[i] + " " * pad if fields[i - 1][4] else " " * pad + row[i]
+        print_aligned(out_rows, [True] + [f[4] for f in fields], widths)
+    sys.stdout.flush()
+
+
+def _offer_index_path(offer_type: str) -> str:
+    return os.path.join(cache_dir, "offers-{}.npz".format(offer_type))
+
+
+def _search_offers_local(args: argparse.Namespace, query: typing.Dict) -> typing.Optional[int]:
+    """search offers --local: evaluates the query against the snapshot saved by 'offers sync'."""
+    if np is None:
+        print("Error: --local needs numpy. To install it do 'pip3 install numpy'.")
+        return 1
+    path = _offer_index_path(query["type"])
+    if not os.path.exists(path):
+        print("Error: no local snapshot of {} offers. Run 'vast offers sync --type {}' first.".format(query["type"], query["type"]))
+        return 1
+    index = OfferIndex.load(path)
+    age = time.time() - index.meta.get("synced", 0)
+    print("Searching {} offers synced {:.0f} minutes ago.".format(len(index), age / 60), file=sys.stderr)
+    ranked = args.score or args.pareto
+    return _print_offers(args, index.search(query, max_count=None if ranked else args.max))
+
+
+@parser.command(
+    argument("-t", "--type", default="on-demand", help="Snapshot 'bid'(interruptible) or 'on-demand' offers. default: on-demand"),
+    argument("-n", "--no-default", action="store_true", help="Disable default query"),
+    argument("--disable-bundling", action="store_true", help="Snapshot identical offers too. This request is more heavily rate limited."),
+    argument("query", help="Query to restrict the snapshot to. default: 'external=false rentable=true verified=true', pass -n to ignore default", nargs="*", default=None),
+    usage="./vast offers sync [--type TYPE] [-n] [query]",
+    help="Save a local snapshot of offers for 'search offers --local'",
+    epilog=deindent("""
+        Downloads every offer matching the query and stores it as a columnar index (one NumPy array per
+        field) in {}. 'search offers --local' then evaluates queries and orderings against the
+        snapshot in memory, with no network round trip. Requires numpy.
+
+        Examples:
+         vast offers sync
+         vast search offers --local 'num_gpus>=4 reliability>0.99' -o 'dlperf_usd-'
+    """.format(cache_dir_base)),
+)
+def offers__sync(args):
+    """Snapshots the offers matching the query into an OfferIndex.
+
+    :param argparse.Namespace args: should supply all the command-line options
+    """
+    if np is None:
+        print("Error: 'offers sync' needs numpy. To install it do 'pip3 install numpy'.")
+        return 1
+    try:
+        query = _build_offer_query(args)
+    except ValueError as e:
+        print("Error: ", e)
+        return 1
+    query, _ = _split_offer_query(query)
+    start_time = time.time()
+    r = http_get(args, apiurl(args, "/bundles", {"q": query}), stream=True, max_age=0)
+    r.raise_for_status()
+    rows = iter_json_array(r, "offers")
+    try:
+        index = OfferIndex.from_offers(rows, meta={"synced": time.time(), "query": query})
+    finally:
+        rows.close()
+    index.save(_offer_index_path(query["type"]))
+    print("Synced {} {} offers in {:.1f}s.".format(len(index), query["type"], time.time() - start_time))
+
+
+# Columns of the offer price history kept by 'offers record', in file order.
+offer_history_fields = ("timestamp", "gpu_name", "num_gpus", "dph_total", "dlperf", "reliability2", "geolocation", "min_bid")
+offer_history_path_base = "~/.cache/vast/offer-history.csv.gz"
+offer_history_read_bytes = 1 << 20
+
+
+def _history_cell(val) -> str:
+    if val is None:
+        return ""
+    if isinstance(val, float):
+        return "{:.6g}".format(val)
+    return str(val)
+
+
+def append_offer_history(path: str, timestamp: int, offers: typing.Iterable[typing.Dict]) -> int:
+    """Appends one sample of offers to the history store: a gzip member of headerless CSV rows in
+    offer_history_fields order, written with a single unbuffered append so that concurrent recorders don't
+    interleave. A member cut short by an interrupted write is skipped by read_offer_history, which resyncs at
+    the next member, so only that sample is lost.
+
+    :param str path: store file.
+    :param int timestamp: sample time, in Unix seconds.
+    :param Iterable[Dict] offers:
+    :return int: number of rows written.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    count = 0
+    for offer in offers:
+        writer.writerow([timestamp] + [_history_cell(offer.get(f)) for f in offer_history_fields[1:]])
+        count += 1
+    with open(path, "ab", buffering=0) as f:
+        f.write(gzip.compress(buf.getvalue().encode("utf-8")))
+    return count
+
+
+def _offer_history_samples(path: str, on_damage: typing.Optional[typing.Callable[[int], None]] = None
+                           ) -> typing.Iterator[bytes]:
+    """Yields the decompressed contents of each gzip member of a history store, i.e. one sample at a time. A
+    member that doesn't decode to the end with a good CRC (cut short by an interrupted write, or corrupted) is
+    dropped whole: on_damage is called with its byte offset and reading resumes at the next gzip header.
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return
+        with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as data:
+            pos = 0
+            while pos < size:
+                decoder = zlib.decompressobj(31)
+                parts = []
+                end = pos
+                try:
+                    while not decoder.eof and end < size:
+                        chunk = data[end:end + offer_history_read_bytes]
+                        end += len(chunk)
+                        parts.append(decoder.decompress(chunk))
+                    if not decoder.eof:
+                        raise zlib.error("truncated member")
+                except zlib.error:
+                    if on_damage is not None:
+                        on_damage(pos)
+                    resync = data.find(b"\x1f\x8b\x08", pos + 1)
+                    pos = resync if resync >= 0 else size
+                    continue
+                yield b"".join(parts)
+                pos = end - len(decoder.unused_data)
+
+
+def read_offer_history(path: str, on_damage: typing.Optional[typing.Callable[[int], None]] = None
+                       ) -> typing.Iterator[typing.Dict]:
+    """Yields the rows of a history store one at a time, oldest first, with numbers parsed and blanks as None.
+    Damaged samples are skipped whole, reporting their byte offset to on_damage.
+    """
+    numeric = {"timestamp": int, "num_gpus": int, "dph_total": float, "dlperf": float, "reliability2": float, "min_bid": float}
+    for sample in _offer_history_samples(path, on_damage):
+        for values in csv.reader(io.StringIO(sample.decode("utf-8"), newline="")):
+            if len(values) != len(offer_history_fields):
+                continue
+            row: typing.Dict[str, typing.Any] = {}
+            for name, val in zip(offer_history_fields, values):
+                if val == "":
+                    row[name] = None
+                elif name in numeric:
+                    row[name] = numeric[name](val)
+                else:
+                    row[name] = val
+            yield row
+
+
+class LogHistogram(object):
+    """Streaming quantile sketch for positive values: counts values in logarithmic bins, each (1 + alpha) times
+    wider than the last, so any quantile is estimated within a relative error of about alpha / 2 while memory
+    grows only with the range of the values, not their number.
+    """
+
+    def __init__(self, alpha: float = 0.01):
+        self.gamma = math.log1p(alpha)
+        self.bins: typing.Counter[int] = Counter()
+        self.count = 0
+        self.min: typing.Optional[float] = None
+        self.max: typing.Optional[float] = None
+
+    def add(self, value: float):
+        if value is None or not value > 0:
+            return
+        self.bins[int(math.floor(math.log(value) / self.gamma))] += 1
+        self.count += 1
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantiles(self, qs: typing.Sequence[float]) -> typing.List[typing.Optional[float]]:
+        """Estimates several quantiles (each 0..1) in one pass over the bins."""
+        lo, hi = self.min, self.max
+        if not self.count or lo is None or hi is None:
+            return [None] * len(qs)
+        targets = sorted((q * (self.count - 1), n) for n, q in enumerate(qs))
+        out: typing.List[typing.Optional[float]] = [None] * len(qs)
+        seen = 0
+        t = 0
+        for b in sorted(self.bins):
+            seen += self.bins[b]
+            while t < len(targets) and targets[t][0] < seen:
+                # Geometric middle of the bin, kept within the observed range.
+                out[targets[t][1]] = min(hi, max(lo, math.exp((b + 0.5) * self.gamma)))
+                t += 1
+        return out
+
+
+offer_stats_fields = (
+    ("gpu_name", "Model", "{}", None, True),
+    ("count", "Samples", "{}", None, False),
+    ("min", "Min", "{:0.4f}", None, False),
+    ("p10", "P10", "{:0.4f}", None, False),
+    ("p25", "P25", "{:0.4f}", None, False),
+    ("p50", "Median", "{:0.4f}", None, False),
+    ("p75", "P75", "{:0.4f}", None, False),
+    ("p90", "P90", "{:0.4f}", None, False),
+    ("max", "Max", "{:0.4f}", None, False),
+)
+
+offer_trend_fields = (
+    ("bucket", "Period", "{}", None, True),
+    ("gpu_name", "Model", "{}", None, True),
+    ("count", "Samples", "{}", None, False),
+    ("p50", "Median", "{:0.4f}", None, False),
+)
+
+
+@parser.command(
+    argument("-t", "--type", default="on-demand", help="Record 'bid'(interruptible) or 'on-demand' offers. default: on-demand"),
+    argument("-n", "--no-default", action="store_true", help="Disable default query"),
+    argument("--disable-bundling", action="store_true", help="Record identical offers too. This request is more heavily rate limited."),
+    argument("--interval", type=float, default=900, metavar="SECONDS", help="Time between samples. default: 900"),
+    argument("--samples", type=int, default=0, help="Stop after this many samples; 0 (default) records until interrupted. Use 1 from cron."),
+    argument("--store", default=offer_history_path_base, metavar="PATH", help="History file to append to. default: {}".format(offer_history_path_base)),
+    argument("query", help="Query of the offers to record. default: 'external=false rentable=true verified=true', pass -n to ignore default", nargs="*", default=None),
+    usage="./vast offers record [--interval SECONDS] [--samples N] [query]",
+    help="Sample offer prices into a local history for 'offers stats'",
+    epilog=deindent("""
+        Every --interval seconds, fetches the offers matching the query and appends one compressed row per offer
+        ({}) to the history file. Each sample is one gzip member written with a single append, so several
+        recorders or a cron job ('vast offers record --samples 1') can feed the same history. A sample cut short
+        by an interrupted recorder is skipped when reading; the samples before and after it are kept.
+
+        Examples:
+         vast offers record --interval 600 'num_gpus>=1'
+         vast offers record --samples 1 -t bid --store ~/bid-history.csv.gz
+    """.format(", ".join(offer_history_fields))),
+)
+def offers__record(args):
+    """Appends samples of the offers matching the query to the price history store.
+
+    :param argparse.Namespace args: should supply all the command-line options
+    """
+    try:
+        query = _build_offer_query(args)
+    except ValueError as e:
+        print("Error: ", e)
+        return 1
+    server_query, client_query = _split_offer_query(query)
+    url = apiurl(args, "/bundles", {"q": server_query})
+    path = os.path.expanduser(args.store)
+    taken = 0
+    try:
+        while True:
+            started = time.monotonic()
+            try:
+                r = http_get(args, url, stream=True, max_age=0)
+                r.raise_for_status()
+                rows = iter_json_array(r, "offers")
+                try:
+                    count = append_offer_history(path, int(time.time()),
+                                                 client_query.filter(rows) if client_query else rows)
+                finally:
+                    rows.close()
+                print("{}  recorded {} offers".format(time.strftime("%Y-%m-%d %H:%M:%S"), count), file=sys.stderr)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print("Warning: sample failed: {}".format(e), file=sys.stderr)
+            taken += 1
+            if args.samples and taken >= args.samples:
+                return 0
+            time.sleep(max(0.0, args.interval - (time.monotonic() - started)))
+    except KeyboardInterrupt:
+        return 0
+
+
+@parser.command(
+    argument("--store", default=offer_history_path_base, metavar="PATH", help="History file to read. default: {}".format(offer_history_path_base)),
+    argument("--since", type=float, metavar="DAYS", help="Only use samples from the last DAYS days"),
+    argument("--gpu", metavar="NAME", action="append", help="Only this GPU model, e.g. RTX_4090. Repeatable."),
+    argument("--num-gpus", type=int, help="Only offers with this many GPUs"),
+    argument("--price", choices=["gpu", "offer"], default="gpu", help="Summarize $/hr per GPU (default) or for the whole offer"),
+    argument("--bucket", choices=["hour", "day", "week"], help="Also show the median price of each GPU model per hour, day or week (UTC)"),
+    usage="./vast offers stats [--since DAYS] [--gpu NAME] [--bucket day] ...",
+    help="Price percentiles from the history kept by 'offers record'",
+    epilog=deindent("""
+        Reads the history in one streaming pass, keeping only a small log-scale histogram per GPU model (and per
+        period with --bucket), so weeks of samples don't have to fit in memory. Percentiles are accurate to about
+        half a percent.
+
+        Examples:
+         vast offers stats --since 7
+         vast offers stats --gpu RTX_4090 --gpu RTX_3090 --bucket day
+    """),
+)
+def offers__stats(args):
+    """Prints per-GPU price percentiles, and optionally medians per time bucket, from the price history store.
+
+    :param argparse.Namespace args: should supply all the command-line options
+    """
+    path = os.path.expanduser(args.store)
+    if not os.path.exists(path):
+        print("Error: no price history at {}. Record some with 'vast offers record'.".format(args.store))
+        return 1
+    since = time.time() - args.since * 86400 if args.since is not None else None
+    gpus = {g.replace("_", " ") for g in args.gpu} if args.gpu else None
+    bucket_secs = {"hour": 3600, "day": 86400, "week": 7 * 86400}.get(args.bucket)
+    overall = {}
+    trends = {}
+    damaged: typing.List[int] = []
+    try:
+        for row in read_offer_history(path, damaged.append):
+            gpu, price, ts = row["gpu_name"], row["dph_total"], row["timestamp"]
+            if price is None or ts is None or (since is not None and ts < since):
+                continue
+            if (gpus is not None and gpu not in gpus) or (args.num_gpus is not None and row["num_gpus"] != args.num_gpus):
+                continue
+            if args.price == "gpu":
+                if not row["num_gpus"]:
+                    continue
+                price = price / row["num_gpus"]
+            hist = overall.get(gpu)
+            if hist is None:
+                hist = overall[gpu] = LogHistogram()
+            hist.add(price)
+            if bucket_secs:
+                key = (ts - ts % bucket_secs, gpu)
+                hist = trends.get(key)
+                if hist is None:
+                    hist = trends[key] = LogHistogram()
+                hist.add(price)
+    except (OSError, ValueError) as e:
+        print("Error: can't read the price history: {}".format(e))
+        return 1
+    if damaged:
+        print("Warning: skipped {} damaged sample(s) in the history, at byte {}".format(
+            len(damaged), ", ".join(map(str, damaged))), file=sys.stderr)
+
+    rows = []
+    for gpu, hist in sorted(overall.items(), key=lambda kv: str(kv[0])):
+        p10, p25, p50, p75, p90 = hist.quantiles([0.1, 0.25, 0.5, 0.75, 0.9])
+        rows.append({"gpu_name": gpu, "count": hist.count, "min": hist.min, "p10": p10, "p25": p25, "p50": p50,
+                     "p75": p75, "p90": p90, "max": hist.max})
+    trend_rows = []
+    date_fmt = "%Y-%m-%d %H:00" if args.bucket == "hour" else "%Y-%m-%d"
+    for (start, gpu), hist in sorted(trends.items(), key=lambda kv: (str(kv[0][1]), kv[0][0])):
+        trend_rows.append({"bucket": time.strftime(date_fmt, time.gmtime(start)), "gpu_name": gpu,
+                           "count": hist.count, "p50": hist.quantiles([0.5])[0]})
+    if args.raw:
+        print(json.dumps({"percentiles": rows, "medians": trend_rows}, indent=1, sort_keys=True))
+        return
+    display_table(rows, offer_stats_fields, fmt=args.format)
+    if trend_rows:
+        if args.format == "table":
+            print()
+        display_table(trend_rows, offer_trend_fields, fmt=args.format)
+
+
+@parser.command(
+    usage="./vast show instances [--api-key API_KEY] [--raw]",
+    help="Display user's current instances"
+)
+def show__instances(args):
+    """
+    Shows the stats on the machine the user is renting.
+
+    :param argparse.Namespace args: should supply all the command-line options
+    :rtype:
+    """
+    req_url = apiurl(args, "/instances", {"owner": "me"})
+    r = http_get(args, req_url)
+    r.raise_for_status()
+    rows = r.json()["instances"]
+    if args.raw:
+        print(json.dumps(rows, indent=1, sort_keys=True))
+    else:
+        display_table(rows, instance_fields, fmt=args.format)
 
 
 @parser.command(
@@ -936,180 +3068,1301 @@ def ssh_url(args):
     return _ssh_url(args, "ssh://")
 
 
-@parser.command(
-    argument("--id", help="id of instance", type=int),
-    usage="./vast scp-url",
-    help="scp url helper",
-)
-def scp_url(args):
+@parser.command(
+    argument("--id", help="id of instance", type=int),
+    usage="./vast scp-url",
+    help="scp url helper",
+)
+def scp_url(args):
+    """
+
+    :param argparse.Namespace args: should supply all the command-line options
+    :rtype:
+    """
+    return _ssh_url(args, "scp://")
+
+
+def _ssh_url(args, protocol):
+    if args.id:
+        instance = get_client(args).instances.get(args.id)
+        print(f'{protocol}root@{instance["ssh_host"]}:{instance["ssh_port"]}')
+        return
+    rows = get_client(args).instances.all(max_age=0)
+    if len(rows) > 1:
+        print("Found multiple running instances")
+        return 1
+    else:
+        instance, = rows
+    print(f'{protocol}root@{instance["ssh_host"]}:{instance["ssh_port"]}')
+
+
+def _ssh_url_for_id(args, protocol, id: int):
+    instance = _get_instance(args, id)
+    return f'{protocol}root@{instance["ssh_host"]}:{instance["ssh_port"]}'
+
+
+def _get_instance(args, target_id, max_age: typing.Optional[float] = None) -> typing.Any:
+    """Looks an instance up in the client's InstanceRegistry.
+
+    :param float max_age: how old (in seconds) the instance data may be; None accepts the last fetch.
+    """
+    return get_client(args).instances.get(target_id, max_age)
+
+
+def _is_instance_running(args, target_id):
+    instance = _get_instance(args, target_id, max_age=0)
+    return instance['actual_status'] == 'running'
+
+
+def _is_instance_obj_running(instance):
+    return instance['actual_status'] == 'running'
+
+
+WaitResult = namedtuple("WaitResult", ["id", "ready", "seconds", "instance", "msg"])
+
+
+def probe_ssh_banners(targets: typing.Dict[typing.Any, typing.Tuple[str, int]], timeout: float = 3.0) -> typing.Dict[typing.Any, typing.Optional[str]]:
+    """Checks many ssh servers at once without logging in: opens a non-blocking TCP connection to every
+    (host, port) together, multiplexed with selectors, and reads the server's identification line ('SSH-2.0-...').
+    A server that accepts connections but isn't serving ssh yet (e.g. still booting behind a port forward)
+    closes or stays silent and isn't counted as up.
+
+    :param Dict targets: key -> (host, port). Targets without a host (an instance whose ssh address isn't
+        assigned yet) are skipped.
+    :param float timeout: seconds to wait for all of them.
+    :rtype Dict: key -> identification line, or None for servers that didn't send one in time.
+    """
+    results: typing.Dict[typing.Any, typing.Optional[str]] = {key: None for key in targets}
+    sel = selectors.DefaultSelector()
+
+    def drop(sock):
+        sel.unregister(sock)
+        sock.close()
+
+    try:
+        for key, (host, port) in targets.items():
+            if not host:
+                continue
+            try:
+                family, type_, proto, _, addr = socket.getaddrinfo(host, int(port), type=socket.SOCK_STREAM)[0]
+                sock = socket.socket(family, type_, proto)
+            except (OSError, TypeError, ValueError):
+                continue
+            sock.setblocking(False)
+            err = sock.connect_ex(addr)
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                sock.close()
+                continue
+            sel.register(sock, selectors.EVENT_WRITE, (key, b""))
+        deadline = time.monotonic() + timeout
+        while sel.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            for sk, events in sel.select(remaining):
+                sock, (key, buf) = typing.cast(socket.socket, sk.fileobj), sk.data
+                if events & selectors.EVENT_WRITE:
+                    if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+                        drop(sock)
+                    else:
+                        sel.modify(sock, selectors.EVENT_READ, (key, buf))
+                    continue
+                try:
+                    chunk = sock.recv(1024)
+                except (BlockingIOError, InterruptedError):
+                    continue
+                except OSError:
+                    chunk = b""
+                buf += chunk
+                # The server may send other lines before its identification line (RFC 4253 section 4.2).
+                lines = buf.split(b"\n")
+                banner = next((line for line in lines[:-1] if line.startswith(b"SSH-")), None)
+                if banner is not None:
+                    results[key] = banner.strip().decode("ascii", "replace")
+                    drop(sock)
+                elif not chunk or len(buf) > 8192:
+                    drop(sock)
+                else:
+                    sel.modify(sock, selectors.EVENT_READ, (key, buf))
+    finally:
+        for sk in list(sel.get_map().values()):
+            typing.cast(socket.socket, sk.fileobj).close()
+        sel.close()
+    return results
+
+
+def wait_for_instances(args, ids: typing.Iterable[int], until: str = "running", timeout: float = 600.0,
+                       first_interval: float = 1.0, max_interval: float = 30.0,
+                       on_result: typing.Optional[typing.Callable[[WaitResult], None]] = None) -> typing.List[WaitResult]:
+    """Waits for several instances at once. Each tick makes one /instances fetch (through the InstanceRegistry)
+    that updates every instance still being waited for, then sleeps for an interval that starts at
+    first_interval and grows by half each tick up to max_interval, with +-25% jitter so many waiting clients
+    don't poll in lockstep.
+
+    :param ids: instance ids.
+    :param str until: "running" waits for actual_status running; "ssh" also waits for the ssh server to answer
+        with its banner (all running instances are probed at once with probe_ssh_banners).
+    :param float timeout: seconds to wait in total.
+    :param Callable on_result: called with each WaitResult as soon as it is known.
+    :rtype List[WaitResult]: one per id, in order; seconds is the time from the start of the wait until the
+        instance was seen ready (or given up on).
+    """
+    registry = get_client(args).instances
+    start = time.monotonic()
+    pending = list(dict.fromkeys(ids))
+    results = {}
+    interval = first_interval
+
+    def done(result: WaitResult):
+        results[result.id] = result
+        if on_result is not None:
+            on_result(result)
+
+    while pending:
+        index = registry.index(max_age=0)
+        running = [id_ for id_ in pending if id_ in index and _is_instance_obj_running(index[id_])]
+        if until == "ssh" and running:
+            banners = probe_ssh_banners({id_: _ssh_host_port_for_instance(index[id_]) for id_ in running},
+                                        timeout=min(3.0, max(0.5, timeout - (time.monotonic() - start))))
+            running = [id_ for id_ in running if banners[id_] is not None]
+        ready = set(running)
+        still = []
+        for id_ in pending:
+            instance = index.get(id_)
+            if instance is None:
+                done(WaitResult(id_, False, time.monotonic() - start, None, f'No instances with ID {id_}'))
+            elif id_ in ready:
+                done(WaitResult(id_, True, time.monotonic() - start, instance, until))
+            else:
+                still.append(id_)
+        pending = still
+        elapsed = time.monotonic() - start
+        if pending and elapsed >= timeout:
+            for id_ in pending:
+                status = index[id_].get("actual_status")
+                done(WaitResult(id_, False, elapsed, index[id_], f'not {until} after {elapsed:.1f}s (status: {status})'))
+            break
+        if pending:
+            pause = min(interval * (0.75 + 0.5 * random()), timeout - elapsed)
+            with trace_span("wait", "sleep", instance_ids=pending[:20], waiting=len(pending), reason=f'not {until}'):
+                time.sleep(max(0.0, pause))
+            interval = min(interval * 1.5, max_interval)
+    return [results[id_] for id_ in dict.fromkeys(ids)]
+
+
+def _wait_for_instance_running(args, target_id, timeout: float = 120):
+    print(f'Waiting for instance {target_id}...')
+    result, = wait_for_instances(args, [target_id], "running", timeout=timeout)
+    if result.instance is None:
+        raise ValueError(result.msg)
+    if not result.ready:
+        raise TimeoutError(f'Instance did not start in {result.seconds:.1f} seconds')
+    return result.instance
+
+
+def _wait_for_connected_ssh_client(args, instance: any, timeout: float = 120) -> SSHClient:
+    """Waits until the instance accepts an authenticated ssh session and returns it, still connected. Until
+    the server sends its banner only a cheap probe_ssh_banners check is made; any error from a full
+    connection attempt after that (refused, reset, handshake or authentication failure while the instance is
+    still setting up) is retried until timeout.
+
+    :rtype SSHClient: the caller should close it.
+    """
+    start_time = time.monotonic()
+    pause_time = 0.5
+    last_error = None
+    while True:
+        remaining = timeout - (time.monotonic() - start_time)
+        banner = probe_ssh_banners({0: _ssh_host_port_for_instance(instance)}, timeout=min(3.0, max(0.5, remaining)))[0]
+        if banner is not None:
+            try:
+                return _get_connected_ssh_client(args, instance)
+            except (paramiko.SSHException, OSError, EOFError) as e:
+                last_error = e
+        remaining = timeout - (time.monotonic() - start_time)
+        if remaining <= 0:
+            break
+        with trace_span("wait", "sleep", reason="ssh not ready", banner=banner is not None):
+            time.sleep(min(pause_time * (0.75 + 0.5 * random()), remaining))
+        pause_time = min(pause_time * 1.5, 10.0)
+    raise TimeoutError(f'Could not connect to instance in {time.monotonic() - start_time:.1f} seconds'
+                       + (f' (last error: {last_error})' if last_error is not None else ''))
+
+
+def _ssh_host_port(args, target_id: int):
+    instance = _get_instance(args, target_id)
+    ssh_host = instance['ssh_host']
+    ssh_port = instance['ssh_port']
+    return ssh_host, ssh_port,
+
+
+def _ssh_host_port_for_instance(instance: any):
+    ssh_host = instance['ssh_host']
+    ssh_port = instance['ssh_port']
+    return ssh_host, ssh_port,
+
+
+def _get_connected_ssh_client(args, instance: typing.Any):
+    ssh_host, ssh_port = _ssh_host_port_for_instance(instance)
+    ssh_client = paramiko.SSHClient()
+    ssh_client.load_system_host_keys()
+    ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    with trace_span("ssh", "connect", target=f'{ssh_host}:{ssh_port}'):
+        ssh_client.connect(hostname=ssh_host, username='root', port=ssh_port)
+    return ssh_client
+
+
+class SSHPool(object):
+    """Keeps one authenticated ssh connection (a paramiko Transport) per instance, so the steps of a job (upload,
+    shell, commands, artifact download) open cheap channels on it instead of each doing its own key exchange
+    and authentication.
+
+    client() checks the pooled connection is still alive before handing it out and reconnects if not. run()
+    also reconnects and retries once if the connection dies under the operation, so it should only be given
+    operations that are safe to repeat. Clients from the pool belong to it: don't close them, call close().
+    """
+
+    keepalive_interval = 30
+
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+        self.connects = 0
+
+    @staticmethod
+    def _key(instance: typing.Dict) -> typing.Tuple[str, int]:
+        host, port = _ssh_host_port_for_instance(instance)
+        return host, int(port)
+
+    @staticmethod
+    def healthy(client: SSHClient) -> bool:
+        transport = client.get_transport()
+        if transport is None or not transport.is_active() or not transport.is_authenticated():
+            return False
+        try:
+            transport.send_ignore()
+        except (paramiko.SSHException, EOFError, OSError):
+            return False
+        return True
+
+    def adopt(self, instance: typing.Dict, client: SSHClient):
+        """Pools an already connected client, e.g. the one _wait_for_connected_ssh_client returned."""
+        with self._lock:
+            old = self._clients.get(self._key(instance))
+            self._clients[self._key(instance)] = client
+        if old is not None and old is not client:
+            old.close()
+        transport = client.get_transport()
+        if transport is not None:
+            transport.set_keepalive(self.keepalive_interval)
+
+    def client(self, args, instance: typing.Dict) -> SSHClient:
+        with self._lock:
+            client = self._clients.get(self._key(instance))
+        if client is not None and self.healthy(client):
+            return client
+        if client is not None:
+            logging.info("ssh connection to %s:%s lost, reconnecting", *self._key(instance))
+        self.discard(instance)
+        client = _get_connected_ssh_client(args, instance)
+        self.connects += 1
+        self.adopt(instance, client)
+        return client
+
+    def run(self, args, instance: typing.Dict, fn: typing.Callable[[SSHClient], typing.Any]) -> typing.Any:
+        """Calls fn with the pooled client, reconnecting and calling it again once if the connection died."""
+        client = self.client(args, instance)
+        try:
+            return fn(client)
+        except (paramiko.SSHException, EOFError, OSError):
+            if self.healthy(client):
+                raise
+            return fn(self.client(args, instance))
+
+    def discard(self, instance: typing.Dict):
+        with self._lock:
+            client = self._clients.pop(self._key(instance), None)
+        if client is not None:
+            client.close()
+
+    def close(self):
+        with self._lock:
+            clients, self._clients = list(self._clients.values()), {}
+        for client in clients:
+            client.close()
+
+
+def get_ssh_pool(args: argparse.Namespace) -> SSHPool:
+    """Returns the SSHPool attached to args, creating it on first use."""
+    pool = getattr(args, "ssh_pool", None)
+    if pool is None:
+        pool = SSHPool()
+        args.ssh_pool = pool
+    return pool
+
+
+ignore_file_names = ('.vastignore', '.gitignore')
+
+
+def _glob_segment_regex(segment: str) -> str:
+    """Translates one path segment of a gitignore pattern: * and ? stop at '/', [...] is a class, \\x is x."""
+    out = []
+    i, n = 0, len(segment)
+    while i < n:
+        c = segment[i]
+        i += 1
+        if c == '*':
+            out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '\\' and i < n:
+            out.append(re.escape(segment[i]))
+            i += 1
+        elif c == '[':
+            j = segment.find(']', i + 1 if segment[i:i + 1] in ('!', '^', ']') else i)
+            if j < 0:
+                out.append('\\[')
+                continue
+            body = segment[i:j]
+            if body[:1] in ('!', '^'):
+                body = '^' + body[1:]
+            out.append('[' + body.replace('\\', '\\\\') + ']')
+            i = j + 1
+        else:
+            out.append(re.escape(c))
+    return ''.join(out)
+
+
+@functools.lru_cache(maxsize=4096)
+def ignore_rule(line: str, base: str) -> typing.Optional[typing.Tuple[str, bool, bool]]:
+    """Parses one line of an ignore file in directory base (posix, relative to the walk's root, '' for the
+    root) with gitignore's rules.
+
+    :return: None for blank and comment lines, else a regex over root-relative posix paths, whether the rule
+             re-includes ('!') and whether it only applies to directories (trailing '/').
+    """
+    line = line.rstrip('\n').rstrip('\r')
+    stripped = line.rstrip(' ')
+    if stripped.endswith('\\') and len(stripped) < len(line):
+        stripped += ' '
+    line = stripped
+    if not line or line.startswith('#'):
+        return None
+    negate = line.startswith('!')
+    if negate:
+        line = line[1:]
+    elif line.startswith('\\#') or line.startswith('\\!'):
+        line = line[1:]
+    dir_only = line.endswith('/')
+    line = line.rstrip('/')
+    if not line:
+        return None
+    anchored = '/' in line
+    segments = line.lstrip('/').split('/')
+    rx = ''
+    for k, segment in enumerate(segments):
+        last = k == len(segments) - 1
+        if segment == '**':
+            rx += '.*' if k == 0 and last else '(?:.*/)?' if k == 0 else '/.*' if last else '/(?:.*/)?'
+            continue
+        if k > 0 and segments[k - 1] != '**':
+            rx += '/'
+        rx += _glob_segment_regex(segment)
+    if not anchored and not rx.startswith('.*'):
+        rx = '(?:.*/)?' + rx
+    if base:
+        rx = re.escape(base) + '/' + rx
+    return rx, negate, dir_only
+
+
+class IgnoreMatcher(object):
+    """The ignore rules in effect in one directory: those of its own ignore file after those of its
+    ancestors'. They are compiled into one regex for files and one for directories, with one named group per
+    rule in reverse order, so the first alternative that matches (m.lastgroup) is the last rule in file
+    order, the one gitignore says wins.
+    """
+
+    def __init__(self, rules: typing.Tuple[typing.Tuple[str, bool, bool], ...] = ()):
+        self.rules = rules
+        self._file_re = self._combine(rules, dirs=False)
+        self._dir_re = self._combine(rules, dirs=True)
+
+    @staticmethod
+    def _combine(rules, dirs: bool):
+        alternatives = ['(?P<r{}>{})'.format(i, rx) for i, (rx, _, dir_only) in reversed(list(enumerate(rules)))
+                        if dirs or not dir_only]
+        return re.compile('|'.join(alternatives)) if alternatives else None
+
+    def extend(self, lines: typing.Iterable[str], base: str) -> "IgnoreMatcher":
+        rules = tuple(r for r in (ignore_rule(line, base) for line in lines) if r is not None)
+        return IgnoreMatcher(self.rules + rules) if rules else self
+
+    def ignored(self, rel_path: str, is_dir: bool) -> bool:
+        """:param str rel_path: posix path relative to the walk's root."""
+        regex = self._dir_re if is_dir else self._file_re
+        if regex is None:
+            return False
+        m = regex.fullmatch(rel_path)
+        return m is not None and not self.rules[int(m.lastgroup[1:])][1]
+
+
+class TreeWalker(object):
+    """Lists a directory tree with os.scandir, applying the .vastignore (or, in directories without one,
+    .gitignore) files it finds on the way like git does: rules apply below the directory of their file, and
+    ignored directories are never entered, .git included. Each directory's matcher is built once and
+    shared with subdirectories that have no ignore file of their own.
+    """
+
+    def __init__(self, root: str, use_ignore_files: bool = True):
+        self.root = root
+        self.use_ignore_files = use_ignore_files
+        self.excluded = 0
+        self._matchers: typing.Dict[str, IgnoreMatcher] = {}
+
+    def _matcher(self, rel_dir: str, parent: typing.Optional[IgnoreMatcher],
+                 names: typing.Optional[typing.Iterable[str]] = None) -> IgnoreMatcher:
+        """The matcher for rel_dir. names, when known, are the directory's entries; otherwise the ignore files
+        are looked up on disk."""
+        matcher = self._matchers.get(rel_dir)
+        if matcher is not None:
+            return matcher
+        matcher = parent if parent is not None else IgnoreMatcher()
+        if self.use_ignore_files:
+            dir_path = os.path.join(self.root, rel_dir)
+            names = set(names) if names is not None else None
+            for name in ignore_file_names:
+                if names is not None and name not in names:
+                    continue
+                try:
+                    with open(os.path.join(dir_path, name), errors="replace") as f:
+                        matcher = matcher.extend(f.readlines(), rel_dir)
+                    break
+                except OSError:
+                    continue
+        self._matchers[rel_dir] = matcher
+        return matcher
+
+    def _skip(self, matcher: IgnoreMatcher, rel_path: str, name: str, is_dir: bool) -> bool:
+        return self.use_ignore_files and ((is_dir and name == '.git') or matcher.ignored(rel_path, is_dir))
+
+    def walk(self) -> typing.List[str]:
+        """Returns the posix paths, relative to root, of the directories and files to copy, and counts the
+        ignored ones (an ignored directory counting once) in self.excluded."""
+        paths = []
+        self.excluded = 0
+        stack: typing.List[typing.Tuple[str, typing.Optional[IgnoreMatcher]]] = [('', None)]
+        while stack:
+            rel_dir, parent = stack.pop()
+            with os.scandir(os.path.join(self.root, rel_dir)) as it:
+                entries = list(it)
+            matcher = self._matcher(rel_dir, parent, [e.name for e in entries if e.name in ignore_file_names])
+            prefix = rel_dir + '/' if rel_dir else ''
+            for entry in entries:
+                rel_path = prefix + entry.name
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if self._skip(matcher, rel_path, entry.name, is_dir):
+                    self.excluded += 1
+                    continue
+                paths.append(rel_path)
+                if is_dir:
+                    stack.append((rel_path, matcher))
+        return paths
+
+    def ignored(self, rel_path: str, is_dir: bool = False) -> bool:
+        """Whether walk() would leave out rel_path, which need not exist (e.g. a file deleted locally)."""
+        parts = Path(rel_path).as_posix().split('/')
+        matcher = self._matcher('', None)
+        for i in range(1, len(parts)):
+            rel_dir = '/'.join(parts[:i])
+            if self._skip(matcher, rel_dir, parts[i - 1], True):
+                return True
+            matcher = self._matcher(rel_dir, matcher)
+        return self._skip(matcher, '/'.join(parts), parts[-1], is_dir)
+
+
+def _scp_dowload(args, remote_path: str, local_path: str, instance: any, preserve_times: bool = True):
+    ssh_host, ssh_port = _ssh_host_port_for_instance(instance)
+
+    def download(ssh_client: SSHClient):
+        with trace_span("ssh", "download", target=f'{ssh_host}:{ssh_port}', path=remote_path):
+            with SCPClient(ssh_client.get_transport()) as scp:
+                scp.get(remote_path, local_path, recursive=True, preserve_times=preserve_times)
+
+    get_ssh_pool(args).run(args, instance, download)
+
+
+def _upload_zip(args, instance: typing.Any, src_zip_path: str, remote_path: str):
+    ssh_host, ssh_port = _ssh_host_port_for_instance(instance)
+    file_size = os.path.getsize(src_zip_path)
+    print(f'Uploading zip file of {file_size / 1e6:.4g} Mb...')
+    pool = get_ssh_pool(args)
+    target_zip_path = '/tmp/vast-upload.zip'
+
+    with tqdm(total=file_size, unit='B', unit_scale=True, desc="Uploading") as progress:
+        def progress_fn(filename: bytes, size: int, sent: int, x):
+            progress.update(sent - progress.n)
+
+        def upload(ssh_client: SSHClient):
+            progress.reset()
+            with trace_span("ssh", "upload", target=f'{ssh_host}:{ssh_port}', bytes=file_size):
+                with SCPClient(ssh_client.get_transport(), progress4=progress_fn) as scp:
+                    scp.put([src_zip_path], target_zip_path)
+
+        try:
+            pool.run(args, instance, upload)
+        except SCPException as scp_err:
+            print(f'Error: {scp_err}')
+            return 1
+    install = ('command -v unzip > /dev/null || '
+               '{ echo "Installing unzip..."; apt-get update -qq && apt-get install -y -qq unzip > /dev/null; }')
+    status = pool.run(args, instance, lambda ssh_client: _execute(ssh_client, install))
+    if status:
+        print(f'Error: the instance has neither tar nor unzip, and installing unzip failed (exit status {status}). '
+              'Install tar or unzip in the image, or run as root on an apt-based image.')
+        return status
+    print('Unzipping uploaded files...')
+    status = pool.run(args, instance, lambda ssh_client: _execute(
+        ssh_client, f'unzip -o {target_zip_path} -d {shlex.quote(remote_path)}'))
+    if status:
+        print(f'Error: unzip failed (exit status {status}).')
+    return status
+
+
+sync_manifest_name = '.vast-manifest.json'
+sync_hash_chunk = 1 << 20
+
+
+def _file_digest(path: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(sync_hash_chunk), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_manifest(src_path: str, rel_paths: typing.Iterable[str],
+                  previous: typing.Optional[typing.Dict[str, list]] = None) -> typing.Dict[str, list]:
+    """Describes the tree as {posix relative path: [size, mtime_ns, blake2b hex digest]}, directories as
+    [-1, 0, ""]. Files whose size and mtime match their entry in previous keep its digest without being read,
+    so only files touched since then are hashed.
+
+    :param str src_path: root of the tree.
+    :param rel_paths: paths relative to src_path to describe.
+    :param previous: an earlier manifest of the same tree.
+    :rtype Dict:
+    """
+    previous = previous or {}
+    manifest = {}
+    for rel_path in rel_paths:
+        path = os.path.join(src_path, rel_path)
+        key = Path(rel_path).as_posix()
+        st = os.lstat(path)
+        if stat.S_ISDIR(st.st_mode):
+            manifest[key] = [-1, 0, ""]
+            continue
+        old = previous.get(key)
+        if old is not None and old[0] == st.st_size and old[1] == st.st_mtime_ns:
+            manifest[key] = old
+        elif stat.S_ISLNK(st.st_mode):
+            manifest[key] = [st.st_size, st.st_mtime_ns, hashlib.blake2b(os.fsencode(os.readlink(path)),
+                                                                         digest_size=16).hexdigest()]
+        else:
+            manifest[key] = [st.st_size, st.st_mtime_ns, _file_digest(path)]
+    return manifest
+
+
+def diff_manifests(local: typing.Dict[str, list], remote: typing.Dict[str, list]
+                   ) -> typing.Tuple[typing.List[str], typing.List[str]]:
+    """Returns the paths to upload (new, or content differs from remote) and the paths only on the remote,
+    the latter deepest first so directories come after their contents."""
+    upload = [k for k, v in local.items() if k not in remote or remote[k][0] != v[0] or remote[k][2] != v[2]]
+    removed = sorted((k for k in remote if k not in local), key=lambda k: (-k.count('/'), k))
+    return upload, removed
+
+
+def _sync_cache_path(instance: typing.Dict, remote_path: str) -> str:
+    key = "{}:{}".format(instance["id"], remote_path)
+    return os.path.join(cache_dir, "sync", hashlib.sha256(key.encode("utf-8")).hexdigest()[:16] + ".json")
+
+
+def _load_sync_cache(path: str) -> typing.Dict:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_sync_cache(path: str, state: typing.Dict):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def _exec_output(ssh_client: SSHClient, command: str) -> bytes:
+    with trace_span("ssh", "exec", command=command[:200]):
+        stdin, stdout, stderr = ssh_client.exec_command(command)
+        return stdout.read()
+
+
+def _remote_manifest(args, instance: typing.Dict, remote_path: str, cached: typing.Dict) -> typing.Dict:
+    """Returns the manifest of what the last sync left in remote_path. The remote copy carries a token; when it
+    matches the locally cached one the cache is used as is, otherwise the remote manifest is fetched. An
+    instance without one (never synced, or wiped) gets an empty manifest, i.e. a full upload.
     """
-
-    :param argparse.Namespace args: should supply all the command-line options
-    :rtype:
+    manifest_path = shlex.quote(posixpath.join(remote_path, sync_manifest_name))
+    pool = get_ssh_pool(args)
+    head = pool.run(args, instance, lambda c: _exec_output(c, f'head -c 64 {manifest_path} 2>/dev/null'))
+    m = re.match(rb'\{"token": "([0-9a-f]+)"', head)
+    if m is None:
+        return {"token": None, "files": {}}
+    if cached.get("token") == m.group(1).decode():
+        return cached
+    try:
+        return json.loads(pool.run(args, instance, lambda c: _exec_output(c, f'cat {manifest_path}')))
+    except ValueError:
+        return {"token": None, "files": {}}
+
+
+def _remove_remote_paths(args, instance: typing.Dict, remote_path: str, rel_paths: typing.List[str],
+                         manifest: typing.Dict[str, list], batch_bytes: int = 64 << 10):
+    """Deletes rel_paths under remote_path: files with rm -f, then directories with rmdir (which leaves alone
+    any that still hold files the sync doesn't know about)."""
+    files = [p for p in rel_paths if manifest[p][0] >= 0]
+    dirs = [p for p in rel_paths if manifest[p][0] < 0]
+    pool = get_ssh_pool(args)
+    for cmd, paths in (('rm -f --', files), ('rmdir --ignore-fail-on-non-empty --', dirs)):
+        while paths:
+            batch, size = [], 0
+            while paths and size < batch_bytes:
+                batch.append(shlex.quote(paths[0]))
+                size += len(batch[-1]) + 1
+                paths = paths[1:]
+            pool.run(args, instance, lambda c: _execute(c, f'cd {shlex.quote(remote_path)} && {cmd} {" ".join(batch)}'))
+
+
+def _scp_files(args, walker: TreeWalker, rel_src_paths: typing.List[str], instance: any, remote_path: str):
+    """Uploads the files walker found under its root to remote_path, streaming only what changed since the
+    last sync to the same instance and path (everything with args.full), deleting remote files removed
+    locally with args.delete.
+
+    :return: None or 0 on success.
     """
-    return _ssh_url(args, "scp://")
+    src_path = walker.root
+    rel_paths = [p for p in rel_src_paths if p != sync_manifest_name]
+    excluded = walker.excluded
+
+    cache_path = _sync_cache_path(instance, remote_path)
+    cached = _load_sync_cache(cache_path)
+    remote = {"token": None, "files": {}} if getattr(args, "full", False) else \
+        _remote_manifest(args, instance, remote_path, cached)
+    local = file_manifest(src_path, rel_paths, cached.get("files"))
+    upload, removed = diff_manifests(local, remote["files"])
+    # files left in place (all of them without --delete, ignored ones always) stay in the manifest so a later
+    # --delete still knows about them
+    keep = removed if not getattr(args, "delete", False) else \
+        [k for k in removed if walker.ignored(k, remote["files"][k][0] < 0)]
+    local.update((k, remote["files"][k]) for k in keep)
+    removed = [k for k in removed if k not in local]
+    if not upload and not removed and remote["token"] is not None:
+        _save_sync_cache(cache_path, {"token": remote["token"], "files": local})
+        print(f'{remote_path} is up to date ({len(local)} files, excluded {excluded}).')
+        return
+    if removed:
+        print(f'Deleting {len(removed)} files removed locally...')
+        _remove_remote_paths(args, instance, remote_path, removed, remote["files"])
+
+    state = {"token": uuid.uuid4().hex, "files": local}
+    extra_files = {sync_manifest_name: json.dumps(state).encode("utf-8")}
+    print(f'Sending {len(upload)} changed files. Unchanged {len(local) - len(upload)}, excluded {excluded}.')
+    tools = _remote_commands(args, instance, ("tar", "dd", "sha256sum", "truncate") + tuple(upload_codec_decoders))
+    if "tar" not in tools:
+        print('No tar on the instance, falling back to zip.')
+        status = _upload_files_zip(args, instance, src_path, upload, remote_path, extra_files)
+    else:
+        status = _upload_compressed(args, instance, src_path, upload, remote_path, extra_files, tools)
+    if not status:
+        _save_sync_cache(cache_path, state)
+    return status
+
+
+incompressible_extensions = frozenset("""
+    .7z .avi .bz2 .ckpt .flac .gif .gz .h5 .hdf5 .jpeg .jpg .lz4 .mkv .mov .mp3 .mp4 .npz .ogg .onnx .parquet
+    .png .pt .pth .rar .safetensors .tar.gz .tfrecord .tgz .webm .webp .whl .xz .zip .zst
+""".split())
+compressible_extensions = frozenset("""
+    .c .cc .cfg .cpp .css .csv .cu .go .h .hpp .html .ini .ipynb .java .js .json .jsonl .log .md .py .pyi .rs
+    .rst .sh .sql .svg .toml .ts .tsv .txt .xml .yaml .yml
+""".split())
+entropy_sample_bytes = 32768
+entropy_threshold = 7.2
+codec_sample_bytes = 1 << 20
+default_link_throughput = 12.5e6  # bytes/s, i.e. 100 Mbit/s, until an upload to the host has been measured
+
+upload_codec_decoders = {"gzip": "gzip -dc", "zstd": "zstd -dc", "lz4": "lz4 -dc"}
+upload_codec_levels = {"gzip": (1, 6), "zstd": (1, 3, 9), "lz4": (0, 9)}
+upload_codec_default_level = {"gzip": 6, "zstd": 3, "lz4": 0}
+
+upload_workers = min(8, os.cpu_count() or 1)
+archive_batch_bytes = 1 << 20
+archive_chunk_bytes = 4 << 20
+
+resumable_min_bytes = 64 << 20
+upload_chunk_bytes = 8 << 20
+upload_chunk_retries = 5
+
+TarUpload = namedtuple("TarUpload", "status sent wire seconds")
+
+
+def sample_entropy(path: str, size: int, sample_bytes: int = entropy_sample_bytes) -> float:
+    """Shannon entropy in bits per byte of the start (and, for larger files, the middle) of a file. Text and
+    most binary formats come out well under 7; compressed or encrypted data close to 8."""
+    with open(path, 'rb') as f:
+        data = f.read(sample_bytes)
+        if size > 2 * sample_bytes:
+            f.seek(size // 2)
+            data += f.read(sample_bytes)
+    n = len(data)
+    if not n:
+        return 0.0
+    return -sum(c / n * math.log2(c / n) for c in Counter(data).values())
+
+
+def compressible(path: str, size: int) -> bool:
+    """Whether compressing the file is likely to pay off: by extension where that is conclusive, otherwise by
+    sampling its entropy. Tiny files always count as compressible, sampling them costs more than it saves."""
+    name = path.lower()
+    ext = os.path.splitext(name)[1]
+    if ext in incompressible_extensions or name.endswith(".tar.gz"):
+        return False
+    if ext in compressible_extensions or size < 512:
+        return True
+    return sample_entropy(path, size) < entropy_threshold
+
+
+def split_compressible(src_path: str, rel_paths: typing.List[str]) -> typing.Tuple[typing.List[str], typing.List[str]]:
+    """Splits rel_paths into those worth compressing (directories included) and those to send as they are."""
+    packed, stored = [], []
+    for rel_path in rel_paths:
+        path = os.path.join(src_path, rel_path)
+        if os.path.isfile(path) and not compressible(path, os.path.getsize(path)):
+            stored.append(rel_path)
+        else:
+            packed.append(rel_path)
+    return packed, stored
 
 
-def _ssh_url(args, protocol):
-    req_url = apiurl(args, "/instances", {"owner": "me"})
-    r = requests.get(req_url)
-    r.raise_for_status()
-    rows = r.json()["instances"]
-    if args.id:
-        instance, = [r for r in rows if r['id'] == args.id]
-    elif len(rows) > 1:
-        print("Found multiple running instances")
-        return 1
-    else:
-        instance, = rows
-    print(f'{protocol}root@{instance["ssh_host"]}:{instance["ssh_port"]}')
+def local_codecs() -> typing.List[str]:
+    return ["gzip"] + (["zstd"] if zstandard is not None else []) + (["lz4"] if lz4 is not None else [])
 
 
-def _ssh_url_for_id(args, protocol, id: int):
-    req_url = apiurl(args, "/instances", {"owner": "me"})
-    r = requests.get(req_url)
-    r.raise_for_status()
-    rows = r.json()["instances"]
-    instance, = [r for r in rows if r['id'] == id]
-    return f'{protocol}root@{instance["ssh_host"]}:{instance["ssh_port"]}'
+class _Lz4Stream(object):
+    """lz4.frame's compressor with the zlib-style compress()/flush() interface."""
 
+    def __init__(self, level: int):
+        self._compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self._header = self._compressor.begin()
 
-def _get_instance(args, target_id) -> typing.Any:
-    req_url = apiurl(args, "/instances", {"owner": "me"}, add_rnd=True)
-    r = requests.get(req_url)
-    r.raise_for_status()
-    rows = r.json()["instances"]
-    instances = [r for r in rows if r['id'] == target_id]
-    if len(instances) == 0:
-        raise ValueError(f'No instances with ID {target_id}')
-    return instances[0]
+    def compress(self, data: bytes) -> bytes:
+        out, self._header = self._header + self._compressor.compress(data), b""
+        return out
 
+    def flush(self) -> bytes:
+        return self._header + self._compressor.flush()
 
-def _is_instance_running(args, target_id):
-    instance = _get_instance(args, target_id)
-    return instance['actual_status'] == 'running'
 
+def new_compressor(codec: str, level: typing.Optional[int] = None):
+    """Returns an object with compress(data) and flush() that produces one stream in the framing the codec's
+    command line decoder reads. level None means the codec's upload_codec_default_level."""
+    if codec not in upload_codec_default_level:
+        raise ValueError("unknown codec {}".format(codec))
+    if level is None:
+        level = upload_codec_default_level[codec]
+    if codec == "gzip":
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    return _Lz4Stream(level)
 
-def _is_instance_obj_running(instance):
-    return instance['actual_status'] == 'running'
 
+def measure_codecs(sample: bytes, codecs: typing.Iterable[str]) -> typing.List[typing.Tuple[str, int, float, float]]:
+    """Compresses sample with each level of each codec.
 
-def _wait_for_instance_running(args, target_id, timeout: float = 120):
-    print(f'Waiting for instance {target_id}...')
-    start_time = time.time()
-    pause_time = 45.0
-    while time.time() - start_time < timeout:
-        instance = _get_instance(args, target_id)
-        if _is_instance_obj_running(instance):
-            return instance
-        time.sleep(pause_time)
-    raise TimeoutError(f'Instance did not start in {time.time() - start_time:.1f} seconds')
+    :return: (codec, level, compressed/original size ratio, input bytes per second) for each.
+    """
+    results = []
+    for codec in codecs:
+        for level in upload_codec_levels[codec]:
+            start = time.perf_counter()
+            compressor = new_compressor(codec, level)
+            out = len(compressor.compress(sample)) + len(compressor.flush())
+            seconds = max(time.perf_counter() - start, 1e-6)
+            results.append((codec, level, out / max(len(sample), 1), len(sample) / seconds))
+    return results
+
+
+def choose_codec(measurements: typing.List[typing.Tuple[str, int, float, float]], link_throughput: float,
+                 workers: int = 1) -> typing.Tuple[typing.Optional[str], typing.Optional[int], float]:
+    """Picks the codec and level that get data across fastest. Compression runs on workers threads while the
+    network sends, so a stream goes at the slower of workers * speed and link / ratio; uncompressed at the
+    link's speed.
+
+    :return: codec (None for no compression), level and the estimated input bytes per second.
+    """
+    best: typing.Tuple[typing.Optional[str], typing.Optional[int], float] = (None, None, link_throughput)
+    for codec, level, ratio, speed in measurements:
+        estimate = min(speed * workers, link_throughput / ratio)
+        if estimate > best[2]:
+            best = (codec, level, estimate)
+    return best
+
+
+def _link_throughput_path() -> str:
+    return os.path.join(cache_dir, "link-throughput.json")
+
+
+def link_throughput(instance: typing.Dict) -> float:
+    """Last measured upload throughput to the instance's ssh host in bytes/s, or default_link_throughput."""
+    key = "{}:{}".format(*_ssh_host_port_for_instance(instance))
+    return _load_sync_cache(_link_throughput_path()).get(key, default_link_throughput)
+
+
+def _record_link_throughput(instance: typing.Dict, measured: float, lower_bound: bool = False):
+    """Folds a measurement into the stored estimate. A lower bound (from a stream the compressor may have
+    held back) only ever raises it."""
+    key = "{}:{}".format(*_ssh_host_port_for_instance(instance))
+    links = _load_sync_cache(_link_throughput_path())
+    old = links.get(key)
+    if old is None:
+        links[key] = measured
+    elif lower_bound:
+        links[key] = max(old, measured)
+    else:
+        links[key] = 0.5 * old + 0.5 * measured
+    _save_sync_cache(_link_throughput_path(), links)
 
 
-def _wait_for_connected_ssh_client(args, instance: any, timeout: float = 120):
-    start_time = time.time()
-    pause_time = 3.0
-    while time.time() - start_time < timeout:
-        try:
-            client = _get_connected_ssh_client(args, instance)
-            client.close()
-            return
-        except NoValidConnectionsError:
-            time.sleep(pause_time)
-    raise TimeoutError(f'Could not connect to instance in {time.time() - start_time:.1f} seconds')
+def _remote_commands(args, instance: typing.Dict, names: typing.Iterable[str]) -> typing.Set[str]:
+    """Returns which of the named commands the instance has."""
+    probe = "; ".join(f'command -v {n} > /dev/null && echo {n}' for n in names) + "; true"
+    out = get_ssh_pool(args).run(args, instance, lambda c: _exec_output(c, probe))
+    return set(out.decode(errors="replace").split())
 
 
-def _ssh_host_port(args, target_id: int):
-    instance = _get_instance(args, target_id)
-    ssh_host = instance['ssh_host']
-    ssh_port = instance['ssh_port']
-    return ssh_host, ssh_port,
+class _ChannelSink(object):
+    """Write end of an exec channel. Whatever the remote side prints is relayed as it arrives, so a chatty
+    command can't fill the window and stall the upload."""
 
+    def __init__(self, channel: Channel):
+        self.channel = channel
+        self.sent = 0
 
-def _ssh_host_port_for_instance(instance: any):
-    ssh_host = instance['ssh_host']
-    ssh_port = instance['ssh_port']
-    return ssh_host, ssh_port,
+    def relay(self):
+        while self.channel.recv_ready():
+            sys.stdout.buffer.write(self.channel.recv(32768))
+            sys.stdout.buffer.flush()
 
+    def write(self, data: bytes) -> int:
+        if self.channel.exit_status_ready():
+            raise OSError("remote command exited")
+        self.channel.sendall(data)
+        self.sent += len(data)
+        self.relay()
+        return len(data)
 
-def _get_connected_ssh_client(args, instance: typing.Any):
-    ssh_host, ssh_port = _ssh_host_port_for_instance(instance)
-    ssh_client = paramiko.SSHClient()
-    ssh_client.load_system_host_keys()
-    ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh_client.connect(hostname=ssh_host, username='root', port=ssh_port)
-    return ssh_client
 
+def _regular_file_size(path: str) -> int:
+    st = os.lstat(path)
+    return st.st_size if stat.S_ISREG(st.st_mode) else 0
 
-def _relative_paths(src_path: str):
-    file_paths = list(Path(src_path).rglob('*'))
-    return [str(p.relative_to(src_path)) for p in file_paths]
 
+def _tar_padding(n: int) -> bytes:
+    return tarfile.NUL * (-n % tarfile.BLOCKSIZE)
 
-def _scp_dowload(args, remote_path: str, local_path: str, instance: any, preserve_times: bool = True):
+
+def _tar_header(path: str, arcname: str) -> typing.Tuple[bytes, int]:
+    """Stats path and returns its GNU tar header and the size of the contents that follow it."""
+    st = os.lstat(path)
+    info = tarfile.TarInfo(arcname)
+    info.mode, info.mtime = stat.S_IMODE(st.st_mode), int(st.st_mtime)
+    if stat.S_ISDIR(st.st_mode):
+        info.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(st.st_mode):
+        info.type, info.linkname = tarfile.SYMTYPE, os.readlink(path)
+    elif stat.S_ISREG(st.st_mode):
+        info.size = st.st_size
+    else:
+        raise OSError(errno.EINVAL, "can't upload special file", path)
+    return info.tobuf(tarfile.GNU_FORMAT, tarfile.ENCODING, "surrogateescape"), info.size
+
+
+def _archive_tasks(src_path: str, rel_paths: typing.List[str], sizes: typing.List[int],
+                   extra_files: typing.Dict[str, bytes]) -> typing.Iterator[list]:
+    """Groups the members into units of work of about archive_batch_bytes each: a run of small files, or one
+    archive_chunk_bytes piece of a large file. Parts are ('file', path, arcname), ('piece', path, arcname,
+    offset, length, size) and ('extra', name, content)."""
+    batch: typing.List[tuple] = []
+    batch_bytes = 0
+    for rel_path, size in zip(rel_paths, sizes):
+        path, arcname = os.path.join(src_path, rel_path), Path(rel_path).as_posix()
+        if size > archive_chunk_bytes:
+            if batch:
+                yield batch
+                batch, batch_bytes = [], 0
+            for offset in range(0, size, archive_chunk_bytes):
+                yield [('piece', path, arcname, offset, min(archive_chunk_bytes, size - offset), size)]
+            continue
+        batch.append(('file', path, arcname))
+        batch_bytes += size + tarfile.BLOCKSIZE
+        if batch_bytes >= archive_batch_bytes or len(batch) >= 1024:
+            yield batch
+            batch, batch_bytes = [], 0
+    batch.extend(('extra', name, content) for name, content in extra_files.items())
+    if batch:
+        yield batch
+
+
+def _build_archive_part(task: list, codec: typing.Optional[str], level: typing.Optional[int]
+                        ) -> typing.Tuple[int, int, bytes]:
+    """Reads, stats and (with a codec) compresses one unit of work from _archive_tasks into a slice of the tar
+    stream. Compressed slices are complete gzip members / zstd or lz4 frames, which the decoders read back to
+    back as one stream.
+
+    :return: tar bytes, files completed and the bytes to send.
+    """
+    out = []
+    files = 0
+    for part in task:
+        if part[0] == 'file':
+            _, path, arcname = part
+            header, size = _tar_header(path, arcname)
+            out.append(header)
+            if size:
+                with open(path, 'rb') as f:
+                    data = f.read(size)
+                if len(data) != size:
+                    raise OSError(errno.EIO, "file changed while uploading", path)
+                out += [data, _tar_padding(size)]
+            files += 1
+        elif part[0] == 'piece':
+            _, path, arcname, offset, length, size = part
+            if offset == 0:
+                header, actual = _tar_header(path, arcname)
+                if actual != size:
+                    raise OSError(errno.EIO, "file changed while uploading", path)
+                out.append(header)
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                data = f.read(length)
+            if len(data) != length:
+                raise OSError(errno.EIO, "file changed while uploading", path)
+            out.append(data)
+            if offset + length == size:
+                out.append(_tar_padding(size))
+                files += 1
+        else:
+            _, name, content = part
+            info = tarfile.TarInfo(name)
+            info.size, info.mtime = len(content), int(time.time())
+            out += [info.tobuf(tarfile.GNU_FORMAT), content, _tar_padding(len(content))]
+            files += 1
+    raw = b"".join(out)
+    if codec is None:
+        return len(raw), files, raw
+    compressor = new_compressor(codec, level)
+    return len(raw), files, compressor.compress(raw) + compressor.flush()
+
+
+def _upload_tar(args, instance: typing.Dict, src_path: str, rel_paths: typing.List[str], remote_path: str,
+                extra_files: typing.Optional[typing.Dict[str, bytes]] = None, codec: typing.Optional[str] = None,
+                level: typing.Optional[int] = None) -> TarUpload:
+    """Streams rel_paths (and extra_files, {name: content}, last) as a tar straight into 'tar -x' running on
+    the instance: nothing is staged on local or remote disk and the remote extracts while bytes arrive. With
+    a codec the stream is compressed on the way and decompressed by the codec's command line tool in front
+    of tar.
+
+    The archive is built by upload_workers threads, which read, stat and compress batches of files (or
+    pieces of large files) concurrently. Their results are sent in order through a window of at most
+    2 * upload_workers pending batches, so archiving runs ahead of the network by a bounded amount of memory.
+
+    :return: the remote command's exit status (127 if the instance has no tar), the tar bytes sent, the bytes
+             that went over the wire and the seconds it took.
+    """
     ssh_host, ssh_port = _ssh_host_port_for_instance(instance)
-    with paramiko.SSHClient() as ssh_client:
-        ssh_client.load_system_host_keys()
-        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh_client.connect(hostname=ssh_host, username='root', port=ssh_port)
-        with SCPClient(ssh_client.get_transport()) as scp:
-            scp.get(remote_path, local_path, recursive=True, preserve_times=preserve_times)
+    extra_files = extra_files or {}
+    sizes = [_regular_file_size(os.path.join(src_path, p)) for p in rel_paths]
+    # stream size: a 512 byte header per member, contents padded to 512, two zero blocks, whole records
+    total = sum(tarfile.BLOCKSIZE + n + -n % tarfile.BLOCKSIZE for n in sizes + [len(b) for b in extra_files.values()])
+    total = -(-(total + 2 * tarfile.BLOCKSIZE) // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+    nfiles = len(rel_paths) + len(extra_files)
+    remote = shlex.quote(remote_path)
+    extract = f'tar -x -o -f - -C {remote}'
+    if codec is not None:
+        extract = f'{upload_codec_decoders[codec]} | {extract}'
+    command = f'command -v tar > /dev/null || exit 127; mkdir -p {remote} && {extract}'
+    desc = "Uploading" if codec is None else f"Uploading ({codec})"
+
+    def upload(ssh_client: SSHClient) -> TarUpload:
+        channel = ssh_client.get_transport().open_session()
+        pending: typing.Deque[Future] = deque()
+        with channel, tqdm(total=total, unit='B', unit_scale=True, desc=desc) as progress, \
+                ThreadPoolExecutor(max_workers=upload_workers) as executor:
+            channel.set_combine_stderr(True)
+            channel.exec_command(command)
+            start = time.perf_counter()
+            sink = _ChannelSink(channel)
+            tasks = _archive_tasks(src_path, rel_paths, sizes, extra_files)
+            sent = files = 0
+            with trace_span("ssh", "upload", target=f'{ssh_host}:{ssh_port}', bytes=total, codec=codec):
+                try:
+                    while True:
+                        while len(pending) < 2 * upload_workers:
+                            task = next(tasks, None)
+                            if task is None:
+                                break
+                            pending.append(executor.submit(_build_archive_part, task, codec, level))
+                        if not pending:
+                            break
+                        raw, done, blob = pending.popleft().result()
+                        sink.write(blob)
+                        sent, files = sent + raw, files + done
+                        progress.set_postfix_str(f'{files}/{nfiles} files', refresh=False)
+                        progress.update(raw)
+                    end = 2 * tarfile.BLOCKSIZE
+                    trailer = tarfile.NUL * (end + -(sent + end) % tarfile.RECORDSIZE)
+                    if codec is not None:
+                        compressor = new_compressor(codec, level)
+                        sink.write(compressor.compress(trailer) + compressor.flush())
+                    else:
+                        sink.write(trailer)
+                    sent += len(trailer)
+                    progress.update(len(trailer))
+                except OSError:
+                    # the remote side went away early (no tar, full disk); its exit status tells why
+                    if not channel.exit_status_ready() and not channel.closed:
+                        raise
+                finally:
+                    for future in pending:
+                        future.cancel()
+                channel.shutdown_write()
+                while not channel.exit_status_ready() or channel.recv_ready():
+                    sink.relay()
+                    time.sleep(0.01)
+                return TarUpload(channel.recv_exit_status(), sent, sink.sent, time.perf_counter() - start)
+
+    return get_ssh_pool(args).run(args, instance, upload)
+
+
+def _pick_upload_codec(args, instance: typing.Dict, src_path: str, rel_paths: typing.List[str],
+                       available: typing.Iterable[str]) -> typing.Tuple[typing.Optional[str], typing.Optional[int]]:
+    """Resolves args.compress (default auto) to a codec and level both ends support. auto measures each codec
+    on a sample of the files and weighs its speed against the link throughput measured on earlier uploads."""
+    available = [c for c in local_codecs() if c in available]
+    wanted = getattr(args, "compress", None) or "auto"
+    if wanted == "none":
+        return None, None
+    if wanted != "auto":
+        if wanted in available:
+            return wanted, upload_codec_default_level[wanted]
+        print(f'{wanted} is not available on both ends, sending uncompressed.')
+        return None, None
+    sample = b""
+    for rel_path in rel_paths:
+        path = os.path.join(src_path, rel_path)
+        if len(sample) >= codec_sample_bytes:
+            break
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                sample += f.read(min(65536, codec_sample_bytes - len(sample)))
+    if len(sample) < 4096:
+        # too little to be worth measuring, or compressing
+        return ("gzip", 1) if sample and "gzip" in available else (None, None)
+    codec, level, _ = choose_codec(measure_codecs(sample, available), link_throughput(instance), upload_workers)
+    return codec, level
+
+
+def _upload_journal_path(instance: typing.Dict, remote_file: str) -> str:
+    key = "{}:{}".format(instance["id"], remote_file)
+    return os.path.join(cache_dir, "uploads", hashlib.sha256(key.encode("utf-8")).hexdigest()[:16] + ".json")
 
 
-def _upload_zip(instance: typing.Any, src_zip_path: str, remote_path: str):
+def _send_chunk(ssh_client: SSHClient, part_path: str, index: int, chunk_bytes: int, data: bytes
+                ) -> typing.Optional[str]:
+    """Writes data at chunk index of part_path on the instance and reads it back.
+
+    :return: sha256 hex digest of what landed there, or None if the remote command failed.
+    """
+    part = shlex.quote(part_path)
+    command = (f'dd of={part} bs={chunk_bytes} seek={index} conv=notrunc 2>/dev/null && '
+               f'dd if={part} bs={chunk_bytes} skip={index} count=1 2>/dev/null | sha256sum')
+    with ssh_client.get_transport().open_session() as channel:
+        channel.exec_command(command)
+        channel.sendall(data)
+        channel.shutdown_write()
+        out = channel.makefile('rb').read()
+        if channel.recv_exit_status() != 0 or not out.split():
+            return None
+        return out.split()[0].decode()
+
+
+def _remote_chunk_sums(args, instance: typing.Dict, part_path: str, indices: typing.List[int],
+                       chunk_bytes: int) -> typing.Dict[int, str]:
+    """sha256 hex digests of the given chunks of part_path as they are on the instance, in one command."""
+    part = shlex.quote(part_path)
+    command = (f'for i in {" ".join(str(i) for i in indices)}; do printf "%s " $i; '
+               f'dd if={part} bs={chunk_bytes} skip=$i count=1 2>/dev/null | sha256sum; done')
+    out = get_ssh_pool(args).run(args, instance, lambda c: _exec_output(c, command))
+    sums = {}
+    for line in out.decode(errors="replace").splitlines():
+        fields = line.split()
+        if len(fields) >= 2 and fields[0].isdigit():
+            sums[int(fields[0])] = fields[1]
+    return sums
+
+
+def _upload_resumable(args, instance: typing.Dict, src_path: str, rel_path: str, remote_path: str,
+                      chunk_bytes: int = upload_chunk_bytes) -> TarUpload:
+    """Uploads one large file in chunk_bytes pieces, each written in place with dd and checked against its
+    sha256, into a .vast-part file that is renamed over the target once complete.
+
+    Confirmed chunks are recorded in a journal in ~/.cache/vast/uploads, so after a dropped connection,
+    error or Ctrl-C a later upload of the same (unchanged) file to the same instance checks which of them
+    really are on the instance and sends only the rest. A chunk whose connection drops is retried on a new
+    one, up to upload_chunk_retries times with backoff.
+    """
     ssh_host, ssh_port = _ssh_host_port_for_instance(instance)
-    file_size = os.path.getsize(src_zip_path)
-    print(f'Uploading zip file of {file_size / 1e6:.4g} Mb...')
-    with paramiko.SSHClient() as ssh_client:
-        ssh_client.load_system_host_keys()
-        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh_client.connect(hostname=ssh_host, username='root', port=ssh_port)
-        target_zip_path = '/tmp/vast-upload.zip'
+    path = os.path.join(src_path, rel_path)
+    st = os.stat(path)
+    size = st.st_size
+    remote_file = posixpath.join(remote_path, Path(rel_path).as_posix())
+    part_path = remote_file + '.vast-part'
+    journal_path = _upload_journal_path(instance, remote_file)
+    journal = _load_sync_cache(journal_path)
+    if (journal.get("size"), journal.get("mtime_ns"), journal.get("chunk")) != (size, st.st_mtime_ns, chunk_bytes):
+        journal = {"size": size, "mtime_ns": st.st_mtime_ns, "chunk": chunk_bytes, "sums": {}, "done": []}
+    pool = get_ssh_pool(args)
+    nchunks = max(1, -(-size // chunk_bytes))
+    done = set(journal["done"])
+    if done:
+        # the journal may be stale: the instance was recreated or the directory wiped since
+        landed = _remote_chunk_sums(args, instance, part_path, sorted(done), chunk_bytes)
+        done = {i for i in done if landed.get(i) == journal["sums"].get(str(i))}
+    prepare = f'mkdir -p {shlex.quote(posixpath.dirname(remote_file))}'
+    if not done:
+        prepare += f' && rm -f {shlex.quote(part_path)}'
+    if pool.run(args, instance, lambda c: _exec_output(c, prepare + ' && echo ok')).strip() != b'ok':
+        print(f'Error: could not create {posixpath.dirname(remote_file)} on the instance.')
+        return TarUpload(1, 0, 0, 0.0)
+    if done:
+        print(f'Resuming {rel_path}: {len(done)} of {nchunks} chunks already on the instance.')
+    journal["done"] = sorted(done)
+    _save_sync_cache(journal_path, journal)
+
+    sent = wire = 0
+    start = time.perf_counter()
+    initial = sum(min(chunk_bytes, size - i * chunk_bytes) for i in done)
+    with open(path, 'rb') as f, tqdm(total=size, initial=initial, unit='B', unit_scale=True,
+                                     desc=f"Uploading {os.path.basename(rel_path)}") as progress:
+        for index in range(nchunks):
+            if index in done:
+                continue
+            f.seek(index * chunk_bytes)
+            data = f.read(chunk_bytes)
+            digest = hashlib.sha256(data).hexdigest()
+            journal["sums"][str(index)] = digest
+            for attempt in range(upload_chunk_retries + 1):
+                try:
+                    with trace_span("ssh", "chunk", target=f'{ssh_host}:{ssh_port}', index=index, bytes=len(data)):
+                        landed = pool.run(args, instance,
+                                          lambda c: _send_chunk(c, part_path, index, chunk_bytes, data))
+                    wire += len(data)
+                    if landed == digest:
+                        break
+                    logging.info("chunk %d of %s did not verify, resending", index, rel_path)
+                except (paramiko.SSHException, EOFError, OSError) as e:
+                    if attempt == upload_chunk_retries:
+                        raise
+                    logging.info("chunk %d of %s failed (%s), retrying", index, rel_path, e)
+                    pool.discard(instance)
+                time.sleep(min(2 ** attempt, 30) * (0.75 + 0.5 * random()))
+            else:
+                raise OSError(errno.EIO, f"chunk {index} of {rel_path} did not verify after "
+                                         f"{upload_chunk_retries + 1} attempts")
+            done.add(index)
+            journal["done"] = sorted(done)
+            _save_sync_cache(journal_path, journal)
+            sent += len(data)
+            progress.update(len(data))
+
+    part, target = shlex.quote(part_path), shlex.quote(remote_file)
+    finish = (f'truncate -s {size} {part} && chmod {stat.S_IMODE(st.st_mode):o} {part} && '
+              f'{{ touch -d @{int(st.st_mtime)} {part} 2>/dev/null || true; }} && mv -f {part} {target} && echo ok')
+    if pool.run(args, instance, lambda c: _exec_output(c, finish)).strip() != b'ok':
+        return TarUpload(1, sent, wire, time.perf_counter() - start)
+    os.remove(journal_path)
+    return TarUpload(0, sent, wire, time.perf_counter() - start)
+
+
+def _upload_compressed(args, instance: typing.Dict, src_path: str, rel_paths: typing.List[str], remote_path: str,
+                       extra_files: typing.Dict[str, bytes], tools: typing.Set[str]) -> int:
+    """Sends files of resumable_min_bytes or more one by one with _upload_resumable (if the instance has dd
+    and sha256sum), then files that don't compress as a plain tar stream, then the rest (with extra_files
+    last) as a compressed one, and reports the effective throughput.
+
+    :return: exit status of the first upload that failed, or 0.
+    """
+    large: typing.List[str] = []
+    streamed = rel_paths
+    if {"dd", "sha256sum", "truncate"} <= tools:
+        large = [p for p in rel_paths if _regular_file_size(os.path.join(src_path, p)) >= resumable_min_bytes]
+        large_set = set(large)
+        streamed = [p for p in rel_paths if p not in large_set]
+    sent = wire = seconds = 0
+    for rel_path in large:
+        try:
+            result = _upload_resumable(args, instance, src_path, rel_path, remote_path)
+        except (paramiko.SSHException, EOFError, OSError) as e:
+            print(f'Error: uploading {rel_path} failed: {e}. Run the same copy again to resume it.')
+            return 1
+        if result.status:
+            return result.status
+        sent, wire, seconds = sent + result.sent, wire + result.wire, seconds + result.seconds
+    packed, stored = split_compressible(src_path, streamed)
+    codec, level = _pick_upload_codec(args, instance, src_path, packed, tools)
+    streams = ([(stored, None, None, None)] if stored else []) + [(packed, extra_files, codec, level)]
+    for paths, extra, stream_codec, stream_level in streams:
+        result = _upload_tar(args, instance, src_path, paths, remote_path, extra, stream_codec, stream_level)
+        if result.status:
+            return result.status
+        sent, wire, seconds = sent + result.sent, wire + result.wire, seconds + result.seconds
+        if result.wire >= 4 << 20:
+            _record_link_throughput(instance, result.wire / result.seconds, lower_bound=stream_codec is not None)
+    if seconds > 0:
+        how = "uncompressed" if codec is None else f'{codec} level {level} for {len(packed)} of {len(rel_paths)} files'
+        if large:
+            how += f', {len(large)} resumable'
+        print(f'Sent {sent / 1e6:.4g} MB as {wire / 1e6:.4g} MB in {seconds:.3g}s ({how}): '
+              f'{sent / seconds / 1e6:.4g} MB/s effective, {wire / seconds / 1e6:.4g} MB/s on the wire.')
+    return 0
 
-        with tqdm(total=file_size, unit='B', unit_scale=True, desc="Uploading") as progress:
-            def progress_fn(filename: bytes, size: int, sent: int, x):
-                progress.update(sent - progress.n)
 
-            try:
-                with SCPClient(ssh_client.get_transport(), progress4=progress_fn) as scp:
-                    scp.put([src_zip_path], target_zip_path)
-            except SCPException as scp_err:
-                print(f'Error: {scp_err}')
-                return 1
-        print('Installing zip package...')
-        _execute(ssh_client, 'apt-get install -y zip')
-        print('Unzipping uploaded files...')
-        _execute(ssh_client, f'unzip -o {target_zip_path} -d {remote_path}')
-
-
-def _scp_files(args, src_path: str, rel_src_paths: typing.List[str], instance: any, remote_path: str,
-               check_gitignore: bool):
-    gi_matches = None
-    if check_gitignore:
-        pattern_ignore_path = None
-        vast_ignore_path = os.path.join(src_path, '.vastignore')
-        if os.path.exists(vast_ignore_path):
-            pattern_ignore_path = vast_ignore_path
-        else:
-            git_ignore_path = os.path.join(src_path, '.gitignore')
-            if os.path.exists(git_ignore_path):
-                pattern_ignore_path = git_ignore_path
-        if pattern_ignore_path is not None:
-            gi_matches = parse_gitignore(pattern_ignore_path)
-    print('Building zip file...')
+def _upload_files_zip(args, instance: typing.Dict, src_path: str, rel_paths: typing.List[str], remote_path: str,
+                      extra_files: typing.Optional[typing.Dict[str, bytes]] = None) -> typing.Optional[int]:
+    """Uploads through a temporary zip and unzip on the instance, for images without tar. Files that
+    compress are deflated, the rest stored."""
     tmp_zip_file = tempfile.NamedTemporaryFile(prefix='vast-', suffix='.zip', delete=False)
     try:
-        count = 0
         with ZipFile(tmp_zip_file, 'w') as zip_object:
-            # Adding files that need to be zipped
-            for rel_path in rel_src_paths:
-                ignore = gi_matches is not None and gi_matches(rel_path)
-                if not ignore:
-                    src_file_path = os.path.join(src_path, rel_path)
-                    zip_object.write(src_file_path, arcname=rel_path)
-                    count += 1
-        print(f'Zipped {count} files. Excluded {len(rel_src_paths) - count}.')
-        _upload_zip(instance, tmp_zip_file.name, remote_path)
+            packed, stored = split_compressible(src_path, rel_paths)
+            for names, compress_type in ((packed, ZIP_DEFLATED), (stored, ZIP_STORED)):
+                for rel_path in names:
+                    zip_object.write(os.path.join(src_path, rel_path), arcname=rel_path, compress_type=compress_type)
+            for name, content in (extra_files or {}).items():
+                zip_object.writestr(name, content, compress_type=ZIP_DEFLATED)
+        tmp_zip_file.close()
+        return _upload_zip(args, instance, tmp_zip_file.name, remote_path)
     finally:
         try:
             os.remove(tmp_zip_file.name)
@@ -1135,11 +4388,14 @@ def _capture_channel_output(channel: Channel):
             time.sleep(1.0)
 
 
-def _execute(ssh_client: SSHClient, command: str, get_pty=False):
+def _execute(ssh_client: SSHClient, command: str, get_pty=False) -> int:
+    """Runs command on the instance, printing its output, and returns its exit status."""
     stdout: ChannelFile
-    stdin, stdout, stderr = ssh_client.exec_command(command, get_pty=get_pty)
-    stdout.channel.set_combine_stderr(True)
-    _capture_channel_output(stdout.channel)
+    with trace_span("ssh", "exec", command=command[:200]):
+        stdin, stdout, stderr = ssh_client.exec_command(command, get_pty=get_pty)
+        stdout.channel.set_combine_stderr(True)
+        _capture_channel_output(stdout.channel)
+        return stdout.channel.recv_exit_status()
 
 
 def _send_command(c: Channel, text: str, verbose: bool = False):
@@ -1158,68 +4414,75 @@ def _send_command(c: Channel, text: str, verbose: bool = False):
 
 
 def _wait_for_instance_ready_timeout(args, instance_id: int):
+    """Waits for the instance to run and accept ssh, within args.timeout in total.
+
+    :return: the instance and a connected SSHClient to it, which the caller should close.
+    """
     timeout = args.timeout
     time1 = time.time()
     instance = _wait_for_instance_running(args, instance_id, timeout=timeout)
     time2 = time.time()
     timeout -= (time2 - time1)
-    _wait_for_connected_ssh_client(args, instance, timeout=timeout)
-    return instance
+    ssh_client = _wait_for_connected_ssh_client(args, instance, timeout=timeout)
+    return instance, ssh_client
 
 
-def _launch_job_in_ready_instance(args, instance):
+def _launch_job_in_ready_instance(args, instance, ssh_client: typing.Optional[SSHClient] = None):
     src_path = '.'
-    rel_src_paths = _relative_paths(src_path)
+    walker = TreeWalker(src_path)
+    rel_src_paths = walker.walk()
     has_reqs = 'requirements.txt' in rel_src_paths
     remote_path = _app_path
-    _scp_files(args, src_path, rel_src_paths, instance, remote_path, check_gitignore=True)
-    with _get_connected_ssh_client(args, instance) as ssh_client:
-        path_script_file = '.vast-set-path.sh'
-        path_script = f'{remote_path}/{path_script_file}'
-        with ssh_client.invoke_shell() as shell:
-            _send_command(shell, f'rm -f {path_script} && touch {path_script}\n')
-            _send_command(shell, f'echo "export PYTHONUNBUFFERED=1" >> {path_script}\n')
-            _send_command(shell, f'echo "export PYTHONPATH={remote_path}" >> {path_script}\n')
-            _send_command(shell, f'echo "export PATH=\\"$PATH\\"" >> {path_script}\n')
-
-        def _full_command(cmd: str) -> str:
-            return f'cd {remote_path} && source {path_script_file} && {cmd}'
-
-        if has_reqs:
-            print('Installing requirements...')
-            _execute(ssh_client, _full_command('pip install -r requirements.txt'))
-        else:
-            print('No requirements.txt file found.')
-        print('===== command output follows =====')
-        _execute(ssh_client, _full_command(args.command))
-        print('===== end of command output ====')
-        artifacts_remote_path = (Path(remote_path) / 'vast-artifacts').as_posix()
-        try:
-            _scp_dowload(args, artifacts_remote_path, src_path, instance)
-            print('Artifacts downloaded.')
-        except SCPException:
-            print('No artifacts produced (or unable to download.)')
+    pool = get_ssh_pool(args)
+    if ssh_client is not None:
+        pool.adopt(instance, ssh_client)
+    _scp_files(args, walker, rel_src_paths, instance, remote_path)
+    ssh_client = pool.client(args, instance)
+    path_script_file = '.vast-set-path.sh'
+    path_script = f'{remote_path}/{path_script_file}'
+    with ssh_client.invoke_shell() as shell:
+        _send_command(shell, f'rm -f {path_script} && touch {path_script}\n')
+        _send_command(shell, f'echo "export PYTHONUNBUFFERED=1" >> {path_script}\n')
+        _send_command(shell, f'echo "export PYTHONPATH={remote_path}" >> {path_script}\n')
+        _send_command(shell, f'echo "export PATH=\\"$PATH\\"" >> {path_script}\n')
+
+    def _full_command(cmd: str) -> str:
+        return f'cd {remote_path} && source {path_script_file} && {cmd}'
+
+    if has_reqs:
+        print('Installing requirements...')
+        _execute(ssh_client, _full_command('pip install -r requirements.txt'))
+    else:
+        print('No requirements.txt file found.')
+    print('===== command output follows =====')
+    _execute(ssh_client, _full_command(args.command))
+    print('===== end of command output ====')
+    artifacts_remote_path = (Path(remote_path) / 'vast-artifacts').as_posix()
+    try:
+        _scp_dowload(args, artifacts_remote_path, src_path, instance)
+        print('Artifacts downloaded.')
+    except SCPException:
+        print('No artifacts produced (or unable to download.)')
 
 
 def _launch_job(args, instance_id: int):
-    instance = _wait_for_instance_ready_timeout(args, instance_id)
-    return _launch_job_in_ready_instance(args, instance)
+    instance, ssh_client = _wait_for_instance_ready_timeout(args, instance_id)
+    return _launch_job_in_ready_instance(args, instance, ssh_client)
 
 
 def _start_instance(args):
     instance_id = args.id
     url = apiurl(args, "/instances/{id}/".format(id=instance_id))
-    r = requests.put(url, json={
+    r = http_put(args, url, json={
         "state": "running"
     })
     r.raise_for_status()
-    instance = _wait_for_instance_ready_timeout(args, instance_id)
-    return instance
+    return _wait_for_instance_ready_timeout(args, instance_id)
 
 
 def _stop_instance(args):
     url = apiurl(args, "/instances/{id}/".format(id=args.id))
-    r = requests.put(url, json={
+    r = http_put(args, url, json={
         "state": "stopped"
     })
     r.raise_for_status()
@@ -1238,7 +4501,7 @@ def show__machines(args):
     :rtype:
     """
     req_url = apiurl(args, "/machines", {"owner": "me"});
-    r = requests.get(req_url);
+    r = http_get(args, req_url);
     r.raise_for_status()
     rows = r.json()["machines"]
     if args.raw:
@@ -1304,7 +4567,7 @@ def show__earnings(args):
 
 
     req_url = apiurl(args, "/users/me/machine-earnings", {"owner": "me", "sday": sday, "eday": eday, "machid" :args.machine_id});
-    r = requests.get(req_url)
+    r = http_get(args, req_url)
     r.raise_for_status()
     rows = r.json()
 
@@ -1330,7 +4593,7 @@ def show__invoices(args):
     :rtype:
     """
     req_url = apiurl(args, "/users/me/invoices", {"owner": "me", "inc_charges" : not args.only_credits});
-    r = requests.get(req_url)
+    r = http_get(args, req_url)
     r.raise_for_status()
     rows = r.json()["invoices"]
     # print("Timestamp for first row: ", rows[0]["timestamp"])
@@ -1344,9 +4607,11 @@ def show__invoices(args):
         print(json.dumps(rows, indent=1, sort_keys=True))
         # print("Current: ", current_charges)
     else:
-        print(filter_header)
-        display_table(rows, invoice_fields)
-        print("Current: ", current_charges)
+        # Keep machine-readable formats clean: the header and total go to stderr.
+        notes = sys.stdout if args.format == "table" else sys.stderr
+        print(filter_header, file=notes)
+        display_table(rows, invoice_fields, fmt=args.format)
+        print("Current: ", current_charges, file=notes)
 
 
 @parser.command(
@@ -1362,9 +4627,7 @@ def show__user(args):
     :rtype:
     """
     req_url = apiurl(args, "/users/current", {"owner": "me"});
-    print(f"URL: {req_url}")
-    print("HHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHh\n")
-    r = requests.get(req_url);
+    r = http_get(args, req_url);
     r.raise_for_status()
     user_blob = r.json()
     user_blob.pop("api_key")
@@ -1372,7 +4635,7 @@ def show__user(args):
     if args.raw:
         print(json.dumps(user_blob, indent=1, sort_keys=True))
     else:
-        display_table([user_blob], user_fields)
+        display_table([user_blob], user_fields, fmt=args.format)
 
 
 def filter_invoice_items(args: argparse.Namespace, rows: typing.List) -> typing.Dict:
@@ -1505,13 +4768,13 @@ def generate__pdf_invoices(args):
         package called Borb to make the PDF files. To install this package do 'pip3 install borb'.\n""")
 
     req_url_inv = apiurl(args, "/users/me/invoices", {"owner": "me"})
-    r_inv = requests.get(req_url_inv)
+    r_inv = http_get(args, req_url_inv)
     r_inv.raise_for_status()
     rows_inv = r_inv.json()["invoices"]
     invoice_filter_data = filter_invoice_items(args, rows_inv)
     rows_inv = invoice_filter_data["rows"]
     req_url = apiurl(args, "/users/current", {"owner": "me"})
-    r = requests.get(req_url)
+    r = http_get(args, req_url)
     r.raise_for_status()
     user_blob = r.json()
     user_blob = translate_null_strings_to_blanks(user_blob)
@@ -1545,7 +4808,7 @@ def list__machine(args):
     :rtype:
     """
     req_url = apiurl(args, "/machines/create_asks/")
-    r = requests.put(req_url, json={'machine': args.id, 'price_gpu': args.price_gpu,
+    r = http_put(args, req_url, json={'machine': args.id, 'price_gpu': args.price_gpu,
                                     'price_disk': args.price_disk, 'price_inetu': args.price_inetu,
                                     'price_inetd': args.price_inetd, 'min_chunk': args.min_chunk,
                                     'end_date': args.end_date})
@@ -1581,7 +4844,7 @@ def unlist__machine(args):
     :rtype:
     """
     req_url = apiurl(args, "/machines/{machine_id}/asks/".format(machine_id=args.id));
-    r = requests.delete(req_url)
+    r = http_delete(args, req_url)
     if (r.status_code == 200):
         rj = r.json();
         if (rj["success"]):
@@ -1606,7 +4869,7 @@ def remove__defjob(args):
     """
     req_url = apiurl(args, "/machines/{machine_id}/defjob/".format(machine_id=args.id));
     # print(req_url);
-    r = requests.delete(req_url);
+    r = http_delete(args, req_url);
 
     if (r.status_code == 200):
         rj = r.json();
@@ -1628,9 +4891,82 @@ def set_ask(args):
     print("set asks!\n");
 
 
+bulk_arguments = (
+    argument("--label-match", help="also act on every instance whose label matches this glob pattern, e.g. 'sweep-*'", type=str),
+    argument("--concurrency", help="maximum number of requests in flight at once. default: 8", type=int, default=8),
+)
+
+
+def _resolve_instance_ids(args: argparse.Namespace) -> typing.List[int]:
+    """Collects the instance ids a bulk command should act on: the ids given on the command line, ids read
+    from stdin when one of them is '-', and the ids of instances whose label matches --label-match.
+
+    :param argparse.Namespace args: should supply all the command-line options
+    :rtype List[int]: ids in the order given, without duplicates.
+    """
+    tokens: typing.List[str] = []
+    for x in args.ids:
+        if x == "-":
+            tokens.extend(sys.stdin.read().replace(",", " ").split())
+        else:
+            tokens.append(x)
+    ids = []
+    for x in tokens:
+        try:
+            ids.append(int(x))
+        except ValueError:
+            raise ValueError("Instance id must be an integer: {}".format(x))
+    if args.label_match:
+        ids.extend(row["id"] for row in get_client(args).instances.all(max_age=0)
+                   if row.get("label") is not None and fnmatch.fnmatchcase(row["label"], args.label_match))
+    return list(dict.fromkeys(ids))
+
+
+def _run_bulk(args: argparse.Namespace, action: str, done_fmt: str, confirm: bool = False, **kwargs) -> int:
+    """Runs one of the AsyncVastClient bulk actions over the ids selected by args, printing each outcome as it
+    completes and a summary when more than one instance was involved.
+
+    :param argparse.Namespace args: should supply all the command-line options
+    :param str action: name of the AsyncVastClient method to call, e.g. "stop_instances".
+    :param str done_fmt: message printed for each success, formatted with the instance id and kwargs.
+    :param bool confirm: when --label-match selected instances, list them and act only if --yes was given.
+    :rtype int: 0 if every item succeeded, 1 otherwise.
+    """
+    try:
+        ids = _resolve_instance_ids(args)
+    except ValueError as e:
+        print("Error: ", e)
+        return 1
+    if not ids:
+        print("No matching instances.")
+        return 1
+    if confirm and args.label_match:
+        print("Selected {} instance(s): {}".format(len(ids), " ".join(str(x) for x in ids)))
+        if not args.yes:
+            print("Pass --yes to {} them.".format(action.split("_")[0]))
+            return 1
+
+    def report(result: BulkResult):
+        if result.ok:
+            print(done_fmt.format(id=result.id, **kwargs))
+        else:
+            print("instance {id}: {msg}".format(id=result.id, msg=result.msg))
+
+    client = AsyncVastClient(concurrency=args.concurrency, client=get_client(args))
+    try:
+        results = asyncio.run(getattr(client, action)(ids, on_result=report, **kwargs))
+    finally:
+        client.close()
+    failed = [x for x in results if not x.ok]
+    if len(results) > 1:
+        print("{} succeeded, {} failed.".format(len(results) - len(failed), len(failed)))
+    return 1 if failed else 0
+
+
 @parser.command(
-    argument("id", help="id of instance to reboot", type=int),
-    usage="./vast reboot instance <id> [--raw]",
+    argument("ids", metavar="id", help="ids of instances to reboot, '-' reads ids from stdin", nargs="*"),
+    *bulk_arguments,
+    usage="./vast reboot instance <id>... [--label-match PATTERN] [--raw]",
     help="Reboot (stop/start) an instance",
 )
 def reboot__instance(args):
@@ -1638,24 +4974,13 @@ def reboot__instance(args):
     :param argparse.Namespace args: should supply all the command-line options
     :rtype:
     """
-    url = apiurl(args, "/instances/reboot/{id}/".format(id=args.id))
-    r = requests.put(url, json={})
-    r.raise_for_status()
-
-    if (r.status_code == 200):
-        rj = r.json();
-        if (rj["success"]):
-            print("Rebooting instance {args.id}.".format(**(locals())));
-        else:
-            print(rj["msg"]);
-    else:
-        print(r.text);
-        print("failed with error {r.status_code}".format(**locals()));
+    return _run_bulk(args, "reboot_instances", "Rebooting instance {id}.")
 
 
 @parser.command(
-    argument("id", help="id of instance to start/restart", type=int),
-    usage="./vast start instance <id> [--raw]",
+    argument("ids", metavar="id", help="ids of instances to start/restart, '-' reads ids from stdin", nargs="*"),
+    *bulk_arguments,
+    usage="./vast start instance <id>... [--label-match PATTERN] [--raw]",
     help="Start a stopped instance",
 )
 def start__instance(args):
@@ -1664,26 +4989,13 @@ def start__instance(args):
     :param argparse.Namespace args: should supply all the command-line options
     :rtype:
     """
-    url = apiurl(args, "/instances/{id}/".format(id=args.id))
-    r = requests.put(url, json={
-        "state": "running"
-    })
-    r.raise_for_status()
-
-    if (r.status_code == 200):
-        rj = r.json();
-        if (rj["success"]):
-            print("starting instance {args.id}.".format(**(locals())));
-        else:
-            print(rj["msg"]);
-    else:
-        print(r.text);
-        print("failed with error {r.status_code}".format(**locals()));
+    return _run_bulk(args, "start_instances", "starting instance {id}.")
 
 
 @parser.command(
-    argument("id", help="id of instance to stop", type=int),
-    usage="./vast stop instance [--raw] <id>",
+    argument("ids", metavar="id", help="ids of instances to stop, '-' reads ids from stdin", nargs="*"),
+    *bulk_arguments,
+    usage="./vast stop instance [--raw] <id>... [--label-match PATTERN]",
     help="Stop a running instance",
 )
 def stop__instance(args):
@@ -1692,27 +5004,14 @@ def stop__instance(args):
     :param argparse.Namespace args: should supply all the command-line options
     :rtype:
     """
-    url = apiurl(args, "/instances/{id}/".format(id=args.id))
-    r = requests.put(url, json={
-        "state": "stopped"
-    })
-    r.raise_for_status()
-
-    if (r.status_code == 200):
-        rj = r.json();
-        if (rj["success"]):
-            print("stopping instance {args.id}.".format(**(locals())));
-        else:
-            print(rj["msg"]);
-    else:
-        print(r.text);
-        print("failed with error {r.status_code}".format(**locals()));
+    return _run_bulk(args, "stop_instances", "stopping instance {id}.")
 
 
 @parser.command(
-    argument("id", help="id of instance to label", type=int),
+    argument("ids", metavar="id", help="ids of instances to label, '-' reads ids from stdin", nargs="*"),
     argument("label", help="label to set", type=str),
-    usage="./vast label instance <id> <label>",
+    *bulk_arguments,
+    usage="./vast label instance <id>... <label> [--label-match PATTERN]",
     help="Assign a string label to an instance",
 )
 def label__instance(args):
@@ -1721,40 +5020,79 @@ def label__instance(args):
     :param argparse.Namespace args: should supply all the command-line options
     :rtype:
     """
-    url = apiurl(args, "/instances/{id}/".format(id=args.id))
-    r = requests.put(url, json={
-        "label": args.label
-    })
-    r.raise_for_status()
-
-    rj = r.json();
-    if rj["success"]:
-        print("label for {args.id} set to {args.label}.".format(**(locals())));
-    else:
-        print(rj["msg"]);
+    return _run_bulk(args, "label_instances", "label for {id} set to {label}.", label=args.label)
 
 
 @parser.command(
-    argument("id", help="id of instance to delete", type=int),
-    usage="./vast destroy instance id [-h] [--api-key API_KEY] [--raw]",
+    argument("ids", metavar="id", help="ids of instances to delete, '-' reads ids from stdin", nargs="*"),
+    *bulk_arguments,
+    argument("--yes", help="destroy the instances selected by --label-match without stopping to list them", action="store_true"),
+    usage="./vast destroy instance id... [-h] [--label-match PATTERN [--yes]] [--api-key API_KEY] [--raw]",
     help="Destroy an instance (irreversible, deletes data)",
 )
 def destroy__instance(args):
     """Perfoms the same action as pressing the "DESTROY" button on the website at https://console.vast.ai/instances/.
 
+    With --label-match, the selected ids are printed and nothing is destroyed unless --yes is given.
+
     :param argparse.Namespace args: should supply all the command-line options
     """
-    r = _destroy_instance(args)
-    if (r.status_code == 200):
-        rj = r.json();
-        if (rj["success"]):
-            print("destroying instance {args.id}.".format(**(locals())));
-        else:
-            print(rj["msg"]);
-    else:
-        print(r.text);
-        print("failed with error {r.status_code}".format(**locals()));
+    return _run_bulk(args, "destroy_instances", "destroying instance {id}.", confirm=True)
+
+
+wait_fields = (
+    ("id", "ID", "{}", None, True),
+    ("status", "Status", "{}", None, True),
+    ("seconds", "Seconds", "{:0.1f}", None, False),
+    ("msg", "Result", "{}", None, True),
+)
+
+
+@parser.command(
+    argument("ids", help="ids of the instances to wait for; '-' reads ids from stdin", metavar="id", nargs="*"),
+    argument("--until", choices=["running", "ssh"], default="running", help="wait until the instances are running, or also accept ssh connections. default: running"),
+    argument("--timeout", type=float, default=600.0, help="give up after this many seconds. default: 600"),
+    bulk_arguments[0],
+    usage="./vast wait ID [ID...] [--until running|ssh] [--timeout SECONDS]",
+    help="Wait for instances to be ready",
+    epilog=deindent("""
+        Polls /instances once per tick for all the instances at once, starting with short intervals and backing off,
+        and prints how long each instance took to become ready. Exits with status 1 if any instance didn't get
+        ready in time.
+
+        Examples:
+         vast wait 1234567 --until ssh
+         vast wait --label-match 'sweep-*' --timeout 900
+    """),
+)
+def wait(args):
+    """Waits for one or more instances to be running (or reachable over ssh) and reports time to ready.
+
+    :param argparse.Namespace args: should supply all the command-line options
+    """
+    try:
+        ids = _resolve_instance_ids(args)
+    except ValueError as e:
+        print("Error: ", e)
+        return 1
+    if not ids:
+        print("Error: no instances to wait for.")
+        return 1
+
+    def report(result: WaitResult):
+        if not args.raw:
+            print(f'Instance {result.id}: {result.msg}' + (f' after {result.seconds:.1f}s' if result.ready else ''))
+            sys.stdout.flush()
 
+    results = wait_for_instances(args, ids, args.until, timeout=args.timeout, on_result=report)
+    rows = [{"id": r.id, "ready": r.ready, "seconds": r.seconds, "msg": r.msg,
+             "status": r.instance.get("actual_status") if r.instance else None} for r in results]
+    if args.raw:
+        print(json.dumps(rows, indent=1, sort_keys=True))
+    elif len(rows) > 1:
+        print()
+        display_table(rows, wait_fields, fmt=args.format)
+    return 0 if all(r.ready for r in results) else 1
 
 
 
@@ -1782,7 +5120,7 @@ def execute(args):
     :param argparse.Namespace args: should supply all the command-line options
     """
     url = apiurl(args, "/instances/command/{id}/".format(id=args.ID))
-    r = requests.put(url, json={"command": args.COMMAND} )
+    r = http_put(args, url, json={"command": args.COMMAND} )
     r.raise_for_status()
 
     if (r.status_code == 200):
@@ -1795,7 +5133,7 @@ def execute(args):
                 #url = "https://s3.amazonaws.com/vast.ai/instance_logs/" + args.api_key + str(args.ID) + "C.log"
                 url = "https://s3.amazonaws.com/vast.ai/instance_logs/" + api_key_id_h + "C.log"
                 #print(url)
-                r = requests.get(url);
+                r = http_get(args, url);
                 if (r.status_code == 200):
                     filtered_text = r.text.replace(rj["writeable_path"], '');
                     print(filtered_text)
@@ -1823,7 +5161,7 @@ def logs(args):
     json = {}
     if (args.tail):
         json['tail'] = args.tail
-    r = requests.put(url, json=json )
+    r = http_put(args, url, json=json )
     r.raise_for_status()
 
     if (r.status_code == 200):
@@ -1835,7 +5173,7 @@ def logs(args):
             api_key_id_h = hashlib.md5( (args.api_key + str(args.INSTANCE_ID)).encode('utf-8') ).hexdigest()
             url = "https://s3.amazonaws.com/vast.ai/instance_logs/" + api_key_id_h + ".log"
             print(f"waiting on logs for instance {args.INSTANCE_ID} fetching from {url}")
-            r = requests.get(url);
+            r = http_get(args, url);
             if (r.status_code == 200):
                 print(r.text)
                 break
@@ -1864,7 +5202,7 @@ def set__defjob(args):
     """
     req_url = apiurl(args, "/machines/create_bids/");
     print(f"URL:{req_url}")
-    r = requests.put(req_url, json={'machine': args.id, 'price_gpu': args.price_gpu, 'price_inetu': args.price_inetu, 'price_inetd': args.price_inetd, 'image': args.image, 'args': args.args});
+    r = http_put(args, req_url, json={'machine': args.id, 'price_gpu': args.price_gpu, 'price_inetu': args.price_inetu, 'price_inetd': args.price_inetd, 'image': args.image, 'args': args.args});
 
     if (r.status_code == 200):
 
@@ -1931,7 +5269,7 @@ def _create_instance(args):
         runtype = 'ssh_direct ssh_proxy' if args.direct else 'ssh_proxy'
 
     url = apiurl(args, "/asks/{id}/".format(id=args.id))
-    r = requests.put(url, json={
+    r = http_put(args, url, json={
         "client_id": "me",
         "image": args.image,
         "args": args.args,
@@ -1956,7 +5294,7 @@ def _create_instance(args):
 
 def _destroy_instance(args):
     url = apiurl(args, "/instances/{id}/".format(id=args.id))
-    r = requests.delete(url, json={})
+    r = http_delete(args, url, json={})
     r.raise_for_status()
     return r
 
@@ -2020,7 +5358,7 @@ def change__bid(args: argparse.Namespace):
     """
     url = apiurl(args, "/instances/bid_price/{id}/".format(id=args.id))
     print(f"URL: {url}")
-    r = requests.put(url, json={
+    r = http_put(args, url, json={
         "client_id": "me",
         "price": args.price,
     })
@@ -2058,11 +5396,11 @@ def set__min_bid(args):
     url = apiurl(args, "/machines/{id}/minbid/".format(id=args.id))
     print(url)
 
-    req = requests.put(url, json={"client_id": "me", "price": args.price,})
+    req = http_put(args, url, json={"client_id": "me", "price": args.price,})
     #prepared = req.prepare()
     #pretty_print_POST(prepared)
 
-    r = requests.put(url, json={"client_id": "me", "price": args.price,})
+    r = http_put(args, url, json={"client_id": "me", "price": args.price,})
 
     print(r.request.url)
     print(r.request.body)
@@ -2083,7 +5421,7 @@ def reset__api_key(args):
     print('fml')
     #url = apiurl(args, "/users/current/reset-apikey/", {"owner": "me"})
     url = apiurl(args, "/commands/reset_apikey/" )
-    r = requests.put(url, json={"client_id": "me",})
+    r = http_put(args, url, json={"client_id": "me",})
     r.raise_for_status()
     print("api-key reset ".format(r.json()))
 
@@ -2103,6 +5441,308 @@ def set__api_key(args):
     print("Your api key has been saved in {}".format(api_key_file_base))
 
 
+def _percentile(sorted_values: typing.List[float], p: float) -> float:
+    """Nearest-rank percentile of an already sorted, non-empty list."""
+    idx = max(0, min(len(sorted_values) - 1, int(math.ceil(p / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[idx]
+
+
+trace_summary_fields = (
+    ("type", "Type", "{}", None, True),
+    ("name", "Endpoint/Op", "{}", None, True),
+    ("count", "Count", "{}", None, False),
+    ("errors", "Errors", "{}", None, False),
+    ("cached", "Cached", "{}", None, False),
+    ("p50", "p50 ms", "{:0.1f}", lambda x: x * 1000, False),
+    ("p90", "p90 ms", "{:0.1f}", lambda x: x * 1000, False),
+    ("p99", "p99 ms", "{:0.1f}", lambda x: x * 1000, False),
+    ("max", "max ms", "{:0.1f}", lambda x: x * 1000, False),
+    ("total", "total s", "{:0.2f}", None, False),
+    ("ttfb_p50", "TTFB p50 ms", "{:0.1f}", lambda x: x * 1000, False),
+    ("kb", "KB avg", "{:0.1f}", lambda x: x / 1000, False),
+)
+
+
+@parser.command(
+    argument("file", help="trace file written with --trace", type=str),
+    usage="./vast trace summarize FILE [--raw]",
+    help="Summarize a --trace file: latency percentiles per endpoint and operation",
+)
+def trace__summarize(args):
+    """Groups the records of a trace file by HTTP endpoint (method and path, ids collapsed) or by SSH/wait
+    operation, and prints counts and duration percentiles for each group, slowest total first.
+
+    :param argparse.Namespace args: should supply all the command-line options
+    """
+    groups = {}
+    with open(args.file, "r") as reader:
+        for line in reader:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("type") == "http":
+                name = "{} {}".format(record.get("method"), record.get("endpoint"))
+            else:
+                name = record.get("op")
+            groups.setdefault((record.get("type"), name), []).append(record)
+
+    rows = []
+    for (kind, name), records in groups.items():
+        totals = sorted(r.get("total", 0.0) for r in records)
+        ttfb = sorted(r["phases"]["first_byte"] for r in records if "first_byte" in r.get("phases", {}))
+        sizes = [r["bytes"] for r in records if r.get("bytes") is not None]
+        rows.append({
+            "type": kind,
+            "name": name,
+            "count": len(records),
+            "errors": sum(1 for r in records if r.get("error") or (r.get("status") or 0) >= 400),
+            "cached": sum(1 for r in records if r.get("cached")),
+            "p50": _percentile(totals, 50),
+            "p90": _percentile(totals, 90),
+            "p99": _percentile(totals, 99),
+            "max": totals[-1],
+            "total": sum(totals),
+            "ttfb_p50": _percentile(ttfb, 50) if ttfb else None,
+            "kb": sum(sizes) / len(sizes) if sizes else None,
+        })
+    rows.sort(key=lambda r: -r["total"])
+    if args.raw:
+        print(json.dumps(rows, indent=1, sort_keys=True))
+    else:
+        display_table(rows, trace_summary_fields, fmt=args.format)
+
+
+# Gauges exported by 'vast exporter': (metric name, field, help, conversion). Rows missing a field are skipped.
+instance_metrics = (
+    ("vast_instance_gpu_util", "gpu_util", "GPU utilization, percent.", None),
+    ("vast_instance_dph_total", "dph_total", "Total price of the instance, $/hr.", None),
+    ("vast_instance_inet_up_mbps", "inet_up", "Upload bandwidth of the machine, Mb/s.", None),
+    ("vast_instance_inet_down_mbps", "inet_down", "Download bandwidth of the machine, Mb/s.", None),
+    ("vast_instance_reliability", "reliability2", "Reliability score of the machine, 0 to 1.", None),
+    ("vast_instance_num_gpus", "num_gpus", "Number of GPUs in the instance.", None),
+    ("vast_instance_cpu_ram_gb", "cpu_ram", "RAM of the instance, GB.", lambda x: x / 1000),
+    ("vast_instance_disk_space_gb", "disk_space", "Disk space of the instance, GB.", None),
+)
+instance_metric_labels = ("id", "machine_id", "gpu_name", "label")
+
+machine_metrics = (
+    ("vast_machine_num_gpus", "num_gpus", "Number of GPUs in the machine.", None),
+    ("vast_machine_reliability", "reliability2", "Reliability score of the machine, 0 to 1.", None),
+    ("vast_machine_listed", "listed", "1 if the machine is listed for rent.", None),
+    ("vast_machine_rentals_running", "current_rentals_running", "Rentals currently running on the machine.", None),
+    ("vast_machine_rentals_on_demand", "current_rentals_on_demand", "On-demand rentals on the machine.", None),
+    ("vast_machine_gpu_occupancy_ratio", "gpu_occupancy", "Fraction of the machine's GPUs rented.", None),
+    ("vast_machine_earn_hour", "earn_hour", "Current earnings of the machine, $/hr.", None),
+)
+machine_metric_labels = ("id", "hostname", "gpu_name")
+
+
+def _metric_label_value(val) -> str:
+    return str(val).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _metric_family(lines: typing.List[str], name: str, help_text: str, samples: typing.List[typing.Tuple[str, float]]):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} gauge")
+    for labels, value in samples:
+        lines.append(f"{name}{{{labels}}} {value!r}" if labels else f"{name} {value!r}")
+
+
+def _metric_samples(rows: typing.List[typing.Dict], label_names: typing.Sequence[str], field: str, conv) -> typing.List[typing.Tuple[str, float]]:
+    samples = []
+    for row in rows:
+        val = row.get(field)
+        if isinstance(val, bool):
+            val = float(val)
+        if not isinstance(val, (int, float)):
+            continue
+        labels = ",".join(f'{k}="{_metric_label_value(row[k])}"' for k in label_names if row.get(k) is not None)
+        samples.append((labels, float(conv(val) if conv is not None else val)))
+    return samples
+
+
+class MetricsExporter(object):
+    """Prometheus exporter for the account's instances and hosted machines. A background thread fetches
+    /instances and /machines every interval seconds and renders the whole text exposition once; every scrape
+    then just writes out the latest rendering, so scrapes cost the same however many Prometheus servers ask and
+    never touch the vast api themselves. If a refresh fails, the last good data keeps being served and vast_up
+    drops to 0.
+    """
+
+    def __init__(self, args: argparse.Namespace, interval: float = 60.0, machines: bool = True):
+        self.args = args
+        self.interval = interval
+        self.machines = machines
+        self.payload = b""
+        self.refreshes = 0
+        self.errors = 0
+        self._instances: typing.List[typing.Dict] = []
+        self._machines: typing.List[typing.Dict] = []
+        self._last_success: typing.Optional[float] = None
+        self._stop = threading.Event()
+
+    def refresh(self):
+        started = time.monotonic()
+        ok = True
+        try:
+            instances = get_client(self.args).instances.all(max_age=0)
+            machines = self._machines
+            if self.machines:
+                r = http_get(self.args, apiurl(self.args, "/machines", {"owner": "me"}), max_age=0)
+                r.raise_for_status()
+                machines = r.json()["machines"]
+            # Only swap in a complete pair, so a failed /machines fetch doesn't mix new instances with old machines.
+            self._instances, self._machines = instances, machines
+            self._last_success = time.time()
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            ok = False
+            self.errors += 1
+            print("Warning: refresh failed: {}".format(e), file=sys.stderr)
+        self.refreshes += 1
+        self.payload = self.render(ok, time.monotonic() - started).encode("utf-8")
+
+    def render(self, ok: bool, duration: float) -> str:
+        lines: typing.List[str] = []
+        _metric_family(lines, "vast_up", "1 if the last refresh from the vast api succeeded.", [("", 1.0 if ok else 0.0)])
+        _metric_family(lines, "vast_exporter_refresh_duration_seconds", "Time the last refresh took.", [("", duration)])
+        _metric_family(lines, "vast_exporter_refresh_errors", "Failed refreshes since the exporter started.", [("", float(self.errors))])
+        if self._last_success is not None:
+            _metric_family(lines, "vast_exporter_last_success_timestamp_seconds", "Unix time of the last successful refresh.",
+                           [("", self._last_success)])
+        _metric_family(lines, "vast_instances", "Number of instances rented by the account.", [("", float(len(self._instances)))])
+        statuses = Counter(row.get("actual_status") or "unknown" for row in self._instances)
+        _metric_family(lines, "vast_instance_status", "1 for the current status of each instance.",
+                       _metric_samples([dict(row, status=row.get("actual_status") or "unknown", one=1) for row in self._instances],
+                                       instance_metric_labels + ("status",), "one", None))
+        _metric_family(lines, "vast_instances_by_status", "Number of instances in each status.",
+                       [(f'status="{_metric_label_value(k)}"', float(v)) for k, v in sorted(statuses.items())])
+        for name, field, help_text, conv in instance_metrics:
+            _metric_family(lines, name, help_text, _metric_samples(self._instances, instance_metric_labels, field, conv))
+        if self.machines:
+            _metric_family(lines, "vast_machines", "Number of machines hosted by the account.", [("", float(len(self._machines)))])
+            for name, field, help_text, conv in machine_metrics:
+                samples = _metric_samples(self._machines, machine_metric_labels, field, conv)
+                if samples:
+                    _metric_family(lines, name, help_text, samples)
+        return "\n".join(lines) + "\n"
+
+    def run_refresher(self):
+        while not self._stop.wait(self.interval):
+            started = time.monotonic()
+            try:
+                self.refresh()
+            except Exception:
+                # Keep the thread alive whatever goes wrong; scrapes go on seeing the last data with vast_up 0.
+                logging.exception("metrics refresh failed")
+                self.errors += 1
+                self.payload = self.render(False, time.monotonic() - started).encode("utf-8")
+
+    def stop(self):
+        self._stop.set()
+
+    def make_server(self, address: typing.Tuple[str, int]) -> ThreadingHTTPServer:
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    body = b'<html><body><a href="/metrics">/metrics</a></body></html>\n'
+                    self.send_response(200 if self.path == "/" else 404)
+                    self.send_header("Content-Type", "text/html")
+                else:
+                    body = exporter.payload
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(address, Handler)
+        server.daemon_threads = True
+        return server
+
+
+@parser.command(
+    argument("--port", help="port to serve /metrics on. default: 9733", type=int, default=9733),
+    argument("--host", help="address to listen on, 0.0.0.0 for all interfaces. default: 127.0.0.1", type=str, default="127.0.0.1"),
+    argument("--interval", help="seconds between refreshes from the vast api. default: 60", type=float, default=60.0),
+    argument("--no-machines", action="store_true", help="don't fetch /machines (for accounts that don't host)"),
+    usage="./vast exporter [--host HOST] [--port PORT] [--interval SECONDS]",
+    help="Serve Prometheus metrics about your instances and machines",
+    epilog=deindent("""
+        Runs until interrupted, serving the metrics of your rented instances (gpu_util, dph_total, status,
+        inet_up/down, reliability and more, labelled by instance id, machine_id, gpu_name and label) and hosted
+        machines on http://HOST:PORT/metrics. The data is refreshed in the background every --interval seconds,
+        so scrapes are answered immediately from memory.
+
+        Example prometheus.yml scrape config:
+            - job_name: vast
+              static_configs:
+                - targets: ['localhost:9733']
+    """),
+)
+def exporter(args):
+    """Runs a MetricsExporter in the foreground.
+
+    :param argparse.Namespace args: should supply all the command-line options
+    """
+    metrics = MetricsExporter(args, interval=max(1.0, args.interval), machines=not args.no_machines)
+    metrics.refresh()
+    server = metrics.make_server((args.host, args.port))
+    threading.Thread(target=metrics.run_refresher, daemon=True).start()
+    print("Serving metrics on http://{}:{}/metrics".format(args.host or "0.0.0.0", server.server_address[1]), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        metrics.stop()
+        server.server_close()
+
+
+@parser.command(
+    argument("--host", help="address to listen on. default: 127.0.0.1", type=str, default="127.0.0.1"),
+    argument("--port", help="port to listen on. default: 8089", type=int, default=8089),
+    argument("--cassette", help="cassette file recorded with --record. May be repeated.", type=str, action="append"),
+    argument("--offers", help="serve this many offers, cloned from recorded ones or synthesized. default: the recorded offers, or 200", type=int, default=0),
+    argument("--latency", help="delay added to every response, in milliseconds", type=float, default=0.0),
+    argument("--error-rate", help="fraction of requests that fail with --error-status", type=float, default=0.0),
+    argument("--error-status", help="HTTP status for injected errors; 429 also sends Retry-After. default: 500", type=int, default=500),
+    argument("--ready-after", help="seconds a rented or started instance stays 'loading'. default: 5", type=float, default=5.0),
+    argument("--seed", help="random seed for synthesized data and error injection", type=int, default=0),
+    argument("--ssh-port", help="also run a stand-in sshd on this port (0: any free one) and point instances at it. It runs commands on this machine for your own ~/.ssh keys", type=int, default=None),
+    argument("--ssh-drop-after", help="cut each stand-in ssh connection after it has received this many bytes", type=int, default=0),
+    argument("--ssh-max-drops", help="stop cutting connections after this many. default: no limit", type=int, default=0),
+    usage="./vast dev serve [--port PORT] [--cassette FILE]... [OPTIONS]",
+    help="Run a local stand-in for the vast api, for offline testing and benchmarks",
+    epilog=deindent("""
+        Serves recorded responses (see the global --record option) and synthesized data from a local HTTP
+        server. Point any command at it with --url to run it offline.
+
+        Examples:
+         vast show instances --record cassette.jsonl
+         vast dev serve --cassette cassette.jsonl --offers 50000 --latency 80
+         vast search offers --url http://127.0.0.1:8089
+         vast dev serve --ssh-port 2222 --ssh-drop-after 50000000 --ssh-max-drops 3
+    """),
+)
+def dev__serve(args):
+    """Runs vast_dev.StandInServer in the foreground.
+
+    :param argparse.Namespace args: should supply all the command-line options
+    """
+    try:
+        import vast_dev
+    except ImportError:
+        print("Error: 'dev serve' needs vast_dev.py, found alongside vast.py in the vast-python github repository.")
+        return 1
+    return vast_dev.serve(args)
+
+
 login_deprecated_message = """
 login via the command line is no longer supported.
 go to https://console.vast.ai/cli in a web browser to get your api key, then run:
@@ -2127,9 +5767,15 @@ def login(args):
 """
 
 def main():
+    global tracer
     parser.add_argument("--url", help="server REST api url", default=server_url_default)
     parser.add_argument("--raw", action="store_true", help="output machine-readable json");
+    parser.add_argument("--format", choices=output_formats, default="table", help="how to print tables: aligned 'table' (default), 'csv', 'tsv', 'ndjson' or 'markdown'. --raw takes precedence")
     parser.add_argument("--api-key", help="api key. defaults to using the one stored in {}".format(api_key_file_base), type=str, required=False, default=api_key_guard)
+    parser.add_argument("--no-cache", action="store_true", help="do not use or update the response cache in {}".format(cache_dir_base))
+    parser.add_argument("--record", metavar="CASSETTE", type=str, default=None, help="dev mode: append every API request and response to this cassette file, for replay with 'dev serve'")
+    parser.add_argument("--trace", metavar="FILE", type=str, default=None, help="append timing of every HTTP request and SSH operation to FILE as JSON lines. See 'trace summarize'")
+    parser.add_argument("--max-age", type=float, default=None, help="accept cached responses up to this many seconds old, overriding per-endpoint defaults. 0 always revalidates")
 
 
     args = parser.parse_args()
@@ -2139,6 +5785,12 @@ def main():
                 args.api_key = reader.read().strip()
         else:
             args.api_key = None
+    cache = None if args.no_cache else ResponseCache(cache_dir, args.api_key)
+    tracer = Tracer(args.trace) if args.trace else None
+    args.client = VastClient(args.url, args.api_key, cache=cache, max_age=args.max_age, tracer=tracer)
+    if args.record:
+        import vast_dev
+        args.client.recorder = vast_dev.CassetteRecorder(args.record)
     try:
         sys.exit(args.func(args) or 0)
     except requests.exceptions.HTTPError as e:
@@ -2150,6 +5802,16 @@ def main():
             else:
                 errmsg = "(no detail message supplied)"
         print("failed with error {e.response.status_code}: {errmsg}".format(**locals()));
+    finally:
+        args.client.close()
+        if getattr(args, "ssh_pool", None) is not None:
+            args.ssh_pool.close()
+        if tracer is not None:
+            tracer.close()
+        throttle = args.client.limiter.stats()
+        if throttle["throttled_requests"]:
+            print("Rate limited: {throttled_requests} requests waited {throttled_seconds:.1f}s in total "
+                  "({responses_429} HTTP 429 responses).".format(**throttle), file=sys.stderr)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,551 @@
+#!/usr/bin/env python3
+
+# vast_dev: Developer tools for working on vast.py without the real console. Records API responses to
+# cassette files and serves them (or synthesized data) back from a local stand-in for the REST api, so
+# that commands can be benchmarked and regression-tested offline by pointing --url at it. A stand-in sshd
+# lets the commands that ssh into instances (copy2, launch, wait --until ssh) run against this machine.
+import glob
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+import typing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+import paramiko
+import requests
+
+## Globals
+api_prefix = "/api/v0"
+gpu_names = ["RTX 3090", "RTX 4090", "RTX A6000", "A100 PCIE", "A100 SXM4", "Tesla V100", "RTX 3080 Ti"]
+driver_versions = ["470.86", "510.39.01", "525.60.13", "535.54.03", "535.104.05"]
+countries = ["US", "CA", "DE", "FR", "NL", "SE", "JP"]
+
+
+def _normalize_query(query: str) -> typing.List:
+    """Query args as a sorted list of pairs, without the api key or the '.r' cache-buster, and with JSON values
+    re-serialized with sorted keys so equivalent queries compare equal.
+    """
+    out = []
+    for k, v in parse_qsl(query, keep_blank_values=True):
+        if k in ("api_key", ".r"):
+            continue
+        try:
+            v = json.dumps(json.loads(v), sort_keys=True)
+        except ValueError:
+            pass
+        out.append([k, v])
+    return sorted(out)
+
+
+def _redact(obj):
+    if isinstance(obj, dict):
+        return {k: ("redacted" if k == "api_key" else _redact(v)) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_redact(x) for x in obj]
+    return obj
+
+
+class CassetteRecorder(object):
+    """Appends every API interaction made through a VastClient to a cassette file, one JSON object per line:
+    method, path, normalized query, status, content type and body. Api keys are stripped from URLs and
+    bodies. The client records the response it hands back, so cache hits are recorded like fresh responses,
+    and while recording it reads streamed bodies in full first.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, method: str, url: str, r: requests.Response):
+        self._write(method, url, r, r.content)
+
+    def _write(self, method: str, url: str, r: requests.Response, body: bytes):
+        parsed = urlparse(url)
+        text = body.decode("utf-8", errors="replace")
+        try:
+            text = json.dumps(_redact(json.loads(text)))
+        except ValueError:
+            pass
+        entry = {
+            "method": method,
+            "path": parsed.path,
+            "query": _normalize_query(parsed.query),
+            "status": r.status_code,
+            "content_type": r.headers.get("Content-Type", "application/json"),
+            "body": text,
+        }
+        with self._lock:
+            with open(self.path, "a") as writer:
+                writer.write(json.dumps(entry) + "\n")
+
+
+def load_cassettes(paths: typing.Iterable[str]) -> typing.List[typing.Dict]:
+    entries = []
+    for path in paths:
+        with open(path, "r") as reader:
+            for line in reader:
+                line = line.strip()
+                if line:
+                    entries.append(json.loads(line))
+    return entries
+
+
+def synthesize_offers(count: int, templates: typing.Optional[typing.List[typing.Dict]] = None,
+                      seed: int = 0) -> typing.List[typing.Dict]:
+    """Makes count offers, either by cloning recorded offers with new ids and jittered prices or, with no
+    templates, from scratch with plausible values for every field that search offers displays.
+
+    :param int count: number of offers to return.
+    :param List[Dict] templates: recorded offers to scale up from.
+    :param int seed: random seed, so a given configuration always serves the same data.
+    :rtype List[Dict]:
+    """
+    rng = random.Random(seed)
+    offers = []
+    for i in range(count):
+        if templates:
+            offer = dict(templates[i % len(templates)])
+            offer["dph_total"] = round(offer.get("dph_total", 1.0) * rng.uniform(0.8, 1.2), 4)
+        else:
+            num_gpus = rng.choice([1, 1, 2, 4, 8])
+            offer = {
+                "cuda_max_good": rng.choice([11.4, 11.8, 12.0, 12.2]),
+                "num_gpus": num_gpus,
+                "gpu_name": rng.choice(gpu_names),
+                "gpu_ram": rng.choice([12000, 24000, 48000, 80000]),
+                "pcie_bw": rng.uniform(3, 25),
+                "cpu_cores": 4 * num_gpus * rng.choice([2, 4]),
+                "cpu_cores_effective": 4.0 * num_gpus,
+                "cpu_ram": rng.choice([32000, 64000, 128000, 256000]),
+                "disk_space": rng.uniform(50, 2000),
+                "disk_bw": rng.uniform(200, 3000),
+                "dph_total": round(num_gpus * rng.uniform(0.1, 2.0), 4),
+                "dlperf": num_gpus * rng.uniform(5, 80),
+                "total_flops": num_gpus * rng.uniform(10, 80),
+                "driver_version": rng.choice(driver_versions),
+                "inet_up": rng.uniform(10, 2000),
+                "inet_down": rng.uniform(10, 2000),
+                "reliability2": rng.uniform(0.9, 1.0),
+                "duration": rng.uniform(1, 90) * 24 * 60 * 60,
+                "verification": "verified",
+                "verified": True,
+                "rentable": True,
+                "rented": False,
+                "external": False,
+                "direct_port_count": rng.choice([0, 10, 100]),
+                "geolocation": rng.choice(countries),
+                "min_bid": 0.0,
+                "compute_cap": rng.choice([700, 750, 800, 860, 890]),
+            }
+            offer["min_bid"] = round(offer["dph_total"] * rng.uniform(0.3, 0.7), 4)
+        offer["id"] = 1000000 + i
+        offer["machine_id"] = 10000 + i // 3
+        offer["dlperf_per_dphtotal"] = offer.get("dlperf", 0) / offer["dph_total"] if offer.get("dph_total") else 0
+        offers.append(offer)
+    return offers
+
+
+def _compare(value, op: str, target) -> bool:
+    if op == "in":
+        return value in target
+    if op == "notin":
+        return value not in target
+    if value is None:
+        return False
+    if isinstance(value, bool) or isinstance(target, bool):
+        target = target if isinstance(target, bool) else str(target).lower() in ("true", "1")
+    elif isinstance(value, (int, float)):
+        try:
+            target = float(target)
+        except (TypeError, ValueError):
+            return False
+    return {
+        "eq": lambda: value == target,
+        "neq": lambda: value != target,
+        "gt": lambda: value > target,
+        "gte": lambda: value >= target,
+        "lt": lambda: value < target,
+        "lte": lambda: value <= target,
+    }.get(op, lambda: True)()
+
+
+def filter_offers(offers: typing.List[typing.Dict], q: typing.Dict) -> typing.List[typing.Dict]:
+    """Applies a /bundles query dict (as made by vast.parse_query) to offers, roughly as the server would."""
+    conds = [(field, op, target) for field, ops in q.items() if isinstance(ops, dict) for op, target in ops.items()]
+    rows = [o for o in offers if all(_compare(o.get(f), op, t) for f, op, t in conds)]
+    for field, direction in reversed(q.get("order") or []):
+        rows.sort(key=lambda o: (o.get(field) is None, o.get(field) or 0), reverse=(direction == "desc"))
+    return rows
+
+
+class StandInServer(ThreadingHTTPServer):
+    """Local stand-in for the vast.ai REST api.
+
+    Serves recorded cassette responses where the method, path and query match, and otherwise keeps enough
+    state to behave like the real thing. /bundles filters and orders offers, /asks/<id>/ rents an offer,
+    and /instances reports rented instances (which go from 'loading' to 'running' after ready_after seconds)
+    and accepts state, label, reboot and delete requests. Every response carries an ETag and honors
+    If-None-Match. latency adds a delay to every request. error_rate makes that fraction of requests fail with
+    error_status; a 429 also sends Retry-After. connections counts accepted TCP connections. With ssh_address
+    every instance's ssh_host and ssh_port point there, e.g. at an SSHStandIn.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0), cassettes: typing.Iterable[str] = (), offers: int = 0,
+                 latency: float = 0.0, error_rate: float = 0.0, error_status: int = 500,
+                 ready_after: float = 5.0, seed: int = 0,
+                 ssh_address: typing.Optional[typing.Tuple[str, int]] = None):
+        super().__init__(address, StandInHandler)
+        self.ssh_address = ssh_address
+        self.lock = threading.Lock()
+        self.rng = random.Random(seed)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.ready_after = ready_after
+        self.connections = 0
+        self.requests = 0
+        self.recorded = {}
+        self.instances = {}
+        self.next_instance_id = 9000000
+        recorded_offers = []
+        for entry in load_cassettes(cassettes):
+            key = (entry["method"], entry["path"], json.dumps(entry["query"]))
+            self.recorded[key] = entry
+            if entry["method"] == "GET" and entry["path"] == api_prefix + "/instances":
+                for inst in json.loads(entry["body"]).get("instances", []):
+                    self.instances[inst["id"]] = dict(inst, _ready_at=0.0)
+            if entry["method"] == "GET" and entry["path"] == api_prefix + "/bundles":
+                recorded_offers.extend(json.loads(entry["body"]).get("offers", []))
+        if offers or not recorded_offers:
+            self.offers = synthesize_offers(offers or 200, recorded_offers or None, seed)
+        else:
+            self.offers = recorded_offers
+        self.offers_by_id = {o["id"]: o for o in self.offers}
+        if ssh_address is not None:
+            for inst in self.instances.values():
+                inst["ssh_host"], inst["ssh_port"] = ssh_address
+
+    @property
+    def url(self) -> str:
+        return "http://{}:{}".format(*self.server_address[:2])
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections += 1
+        super().process_request(request, client_address)
+
+    def handle_error(self, request, client_address):
+        # Clients that stop reading early close keep-alive connections mid-request; that is not an error here.
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+    def instance_rows(self) -> typing.List[typing.Dict]:
+        now = time.time()
+        rows = []
+        for inst in self.instances.values():
+            if inst["actual_status"] == "loading" and now >= inst["_ready_at"]:
+                inst["actual_status"] = "running"
+            rows.append({k: v for k, v in inst.items() if not k.startswith("_")})
+        return rows
+
+    def rent(self, offer_id: int, body: typing.Dict) -> typing.Dict:
+        offer = self.offers_by_id.get(offer_id)
+        if offer is None:
+            return {"success": False, "error": "invalid_args", "msg": "Offer {} not found.".format(offer_id)}
+        instance_id = self.next_instance_id
+        self.next_instance_id += 1
+        self.instances[instance_id] = dict(offer, id=instance_id, actual_status="loading", intended_status="running",
+                                           label=body.get("label"), image_uuid=body.get("image"), gpu_util=0.0,
+                                           ssh_host=(self.ssh_address or ("127.0.0.1",))[0],
+                                           ssh_port=(self.ssh_address or (None, 22))[1],
+                                           _ready_at=time.time() + self.ready_after)
+        return {"success": True, "new_contract": instance_id}
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *a):
+        pass
+
+    def _body(self) -> typing.Dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError:
+            return {}
+
+    def _send(self, status: int, payload, content_type: str = "application/json", extra_headers=()):
+        body = payload.encode("utf-8") if isinstance(payload, str) else json.dumps(payload).encode("utf-8")
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if status == 200 and self.headers.get("If-None-Match") == etag:
+            status, body = 304, b""
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        for k, v in extra_headers:
+            self.send_header(k, v)
+        self.end_headers()
+        try:
+            for i in range(0, len(body), 1 << 16):
+                self.wfile.write(body[i:i + (1 << 16)])
+        except (BrokenPipeError, ConnectionResetError):
+            # Clients stop reading early, e.g. search offers --max.
+            self.close_connection = True
+
+    def _handle(self, method: str):
+        server = typing.cast(StandInServer, self.server)
+        parsed = urlparse(self.path)
+        body = self._body() if method != "GET" else {}
+        with server.lock:
+            server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+        if server.error_rate and server.rng.random() < server.error_rate:
+            extra = [("Retry-After", "1")] if server.error_status == 429 else []
+            return self._send(server.error_status, {"msg": "injected error"}, extra_headers=extra)
+        self._send(*self._route(server, method, parsed.path, parsed.query, body))
+
+    def _route(self, server: "StandInServer", method: str, full_path: str, query: str,
+               body: typing.Dict) -> typing.Tuple[int, typing.Any, str]:
+        """Status, payload and content type of the response. server.lock is only held to read or change the
+        instances; offers never change once the server is up.
+        """
+        recorded = server.recorded.get((method, full_path, json.dumps(_normalize_query(query))))
+        path = full_path[len(api_prefix):] if full_path.startswith(api_prefix) else full_path
+        if method == "GET" and path == "/bundles":
+            q = json.loads(dict(parse_qsl(query)).get("q", "{}"))
+            return 200, {"offers": filter_offers(server.offers, q)}, "application/json"
+        if method == "GET" and path == "/instances":
+            with server.lock:
+                rows = server.instance_rows()
+            return 200, {"instances": rows}, "application/json"
+        if recorded is not None:
+            return recorded["status"], recorded["body"], recorded.get("content_type", "application/json")
+        m = re.match(r"^/asks/(\d+)/$", path)
+        if m and method == "PUT":
+            with server.lock:
+                result = server.rent(int(m.group(1)), body)
+            return 200, result, "application/json"
+        m = re.match(r"^/instances/(?:reboot/)?(\d+)/$", path)
+        if m:
+            with server.lock:
+                inst = server.instances.get(int(m.group(1)))
+                if inst is None:
+                    return 200, {"success": False, "msg": "No such instance."}, "application/json"
+                if method == "DELETE":
+                    del server.instances[inst["id"]]
+                elif "/reboot/" in path:
+                    inst.update(actual_status="loading", _ready_at=time.time() + server.ready_after)
+                elif body.get("state") == "stopped":
+                    inst.update(actual_status="stopped", intended_status="stopped")
+                elif body.get("state") == "running":
+                    inst.update(actual_status="loading", intended_status="running",
+                                _ready_at=time.time() + server.ready_after)
+                if "label" in body:
+                    inst["label"] = body["label"]
+            return 200, {"success": True}, "application/json"
+        if method == "GET" and path == "/machines":
+            return 200, {"machines": []}, "application/json"
+        if method == "GET" and path == "/users/current":
+            return 200, {"id": 1, "username": "standin", "email": "standin@localhost",
+                         "balance": 0.0, "credit": 10.0, "api_key": "redacted"}, "application/json"
+        if method == "GET" and path == "/users/me/invoices":
+            return 200, {"invoices": [], "current": {"charges": 0.0}}, "application/json"
+        return 404, {"msg": "No recorded response for {} {}".format(method, full_path)}, "application/json"
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+
+def _user_public_keys() -> typing.Set[str]:
+    """Base64 blobs of the keys in ~/.ssh/*.pub and ~/.ssh/authorized_keys."""
+    keys = set()
+    paths = glob.glob(os.path.expanduser("~/.ssh/*.pub")) + [os.path.expanduser("~/.ssh/authorized_keys")]
+    for path in paths:
+        try:
+            with open(path) as f:
+                for line in f:
+                    fields = line.split()
+                    for i, field in enumerate(fields[:-1]):
+                        if field.startswith(("ssh-", "ecdsa-", "sk-")):
+                            keys.add(fields[i + 1])
+                            break
+        except OSError:
+            continue
+    return keys
+
+
+class _SSHStandInInterface(paramiko.ServerInterface):
+    def __init__(self, server: "SSHStandIn", connection: typing.Dict):
+        self.server = server
+        self.connection = connection
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL if key.get_base64() in self.server.keys else paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == "session" else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        self.server.start_command(channel, command.decode("utf-8", errors="replace"), self.connection)
+        return True
+
+    def check_channel_shell_request(self, channel):
+        self.server.start_command(channel, "bash", self.connection)
+        return True
+
+
+class SSHStandIn(object):
+    """Local stand-in for an instance's sshd. Accepts the user's own keys (~/.ssh/*.pub, authorized_keys) for
+    any user name and runs exec and shell requests with bash on this machine, so only ever bind it to a
+    loopback address.
+
+    drop_after > 0 injects disconnects: a connection is cut once its channels have received that many bytes
+    from the client, up to max_drops times (0: no limit). The command on the other end sees its input end
+    early, as it would on a real network failure. connections and drops count what happened.
+    """
+
+    def __init__(self, address=("127.0.0.1", 0), drop_after: int = 0, max_drops: int = 0):
+        self.keys = _user_public_keys()
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.drop_after = drop_after
+        self.max_drops = max_drops
+        self.connections = 0
+        self.drops = 0
+        self.lock = threading.Lock()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(address)
+        self.socket.listen(64)
+        self.address = self.socket.getsockname()[:2]
+
+    def serve_forever(self):
+        while True:
+            try:
+                sock, _ = self.socket.accept()
+            except OSError:
+                return
+            with self.lock:
+                self.connections += 1
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(self.host_key)
+            connection = {"transport": transport, "received": 0}
+            try:
+                transport.start_server(server=_SSHStandInInterface(self, connection))
+            except (paramiko.SSHException, EOFError, OSError):
+                transport.close()
+
+    def shutdown(self):
+        self.socket.close()
+
+    def _received(self, connection: typing.Dict, n: int) -> bool:
+        """Counts n bytes received on the connection; returns False if that is where it gets cut."""
+        with self.lock:
+            connection["received"] += n
+            if not self.drop_after or connection["received"] < self.drop_after:
+                return True
+            if self.max_drops and self.drops >= self.max_drops:
+                return True
+            self.drops += 1
+        connection["transport"].close()
+        return False
+
+    def start_command(self, channel: paramiko.Channel, command: str, connection: typing.Dict):
+        threading.Thread(target=self._run, args=(channel, command, connection), daemon=True).start()
+
+    def _run(self, channel: paramiko.Channel, command: str, connection: typing.Dict):
+        proc = subprocess.Popen(["bash", "-c", command], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        stdout = typing.cast(io.BufferedReader, proc.stdout)
+        stderr = typing.cast(io.BufferedReader, proc.stderr)
+
+        def pump_input():
+            try:
+                while True:
+                    data = channel.recv(65536)
+                    if not data or not self._received(connection, len(data)):
+                        break
+                    proc.stdin.write(data)
+                    proc.stdin.flush()
+            except (OSError, EOFError):
+                pass
+            finally:
+                try:
+                    proc.stdin.close()
+                except OSError:
+                    pass
+
+        def pump_stderr():
+            for data in iter(lambda: stderr.read1(65536), b""):
+                try:
+                    channel.sendall_stderr(data)
+                except OSError:
+                    return
+
+        pumps = [threading.Thread(target=pump_input, daemon=True), threading.Thread(target=pump_stderr, daemon=True)]
+        for t in pumps:
+            t.start()
+        try:
+            for data in iter(lambda: stdout.read1(65536), b""):
+                channel.sendall(data)
+            pumps[1].join()
+            channel.send_exit_status(proc.wait())
+        except OSError:
+            proc.kill()
+        finally:
+            channel.close()
+
+
+def serve(args) -> int:
+    """Runs a StandInServer until interrupted, as configured by the 'dev serve' command line options, with an
+    SSHStandIn alongside if --ssh-port is given."""
+    ssh = None
+    if args.ssh_port is not None:
+        ssh = SSHStandIn((args.host, args.ssh_port), drop_after=args.ssh_drop_after, max_drops=args.ssh_max_drops)
+        threading.Thread(target=ssh.serve_forever, daemon=True).start()
+    server = StandInServer((args.host, args.port), cassettes=args.cassette or (), offers=args.offers,
+                           latency=args.latency / 1000.0, error_rate=args.error_rate,
+                           error_status=args.error_status, ready_after=args.ready_after, seed=args.seed,
+                           ssh_address=ssh.address if ssh is not None else None)
+    print("Serving stand-in vast api at {} ({} offers). Use --url {}".format(server.url, len(server.offers),
+                                                                               server.url))
+    if ssh is not None:
+        print("Stand-in sshd at {}:{}, running commands on this machine for {} key(s) from ~/.ssh".format(
+            ssh.address[0], ssh.address[1], len(ssh.keys)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if ssh is not None:
+            ssh.shutdown()
+    return 0